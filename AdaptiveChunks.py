@@ -0,0 +1,210 @@
+'''
+Adaptive chunk sizing from the measured memory and throughput of each dataset.
+
+The peak resident memory of a chunk grows with its number of events, at a
+rate that depends on the sample (object multiplicities, events passing the
+preselection and thus the derived fields attached to them). For every
+dataset the controller keeps a smoothed estimate of the memory per event
+and of the events per second, and sets the size of the next chunks of that
+dataset so that the worker peak stays within `headroom` of the memory
+budget. Growth is limited to `max_growth` per update, and a growth that
+lowered the throughput is taken back. Every change of size is logged with
+its reason and kept in `history`.
+
+`AdaptiveChunker` cuts the files of the datasets into chunks on demand, so
+that each new chunk uses the latest size of its dataset.
+'''
+import logging
+import os
+import time
+
+from ChunkPlanner import Chunk, cost_per_entry
+from DatasetCatalog import file_site
+
+logger = logging.getLogger(__name__)
+
+
+def reset_peak_rss():
+    '''
+    Resets the high-water mark of the resident memory of this process
+    (Linux); returns False when it is not supported.
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    '''
+    Resident memory of this process in bytes.
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _DatasetState:
+    def __init__(self, entries):
+        self.entries = entries
+        self.bytes_per_event = None
+        self.events_per_s = None
+        self.previous = None
+
+
+class ChunkSizeController:
+    def __init__(self, memory_budget=2 * 2**30, initial_entries=100_000, min_entries=5_000,
+                 max_entries=2_000_000, headroom=0.8, max_growth=2., smoothing=0.5,
+                 throughput_tolerance=0.1):
+        self.memory_budget = memory_budget
+        self.initial_entries = initial_entries
+        self.min_entries = min_entries
+        self.max_entries = max_entries
+        self.headroom = headroom
+        self.max_growth = max_growth
+        self.smoothing = smoothing
+        self.throughput_tolerance = throughput_tolerance
+        self._states = {}
+        self.history = []
+
+    def _state(self, dataset):
+        if dataset not in self._states:
+            self._states[dataset] = _DatasetState(self.initial_entries)
+        return self._states[dataset]
+
+    def entries(self, dataset):
+        return self._state(dataset).entries
+
+    def _smooth(self, old, new):
+        return new if old is None else self.smoothing * new + (1 - self.smoothing) * old
+
+    def update(self, dataset, nevents, seconds, peak_rss, base_rss):
+        '''
+        Records a completed chunk of `dataset` and returns the entries of
+        its next chunks.
+        '''
+        state = self._state(dataset)
+        if nevents <= 0:
+            return state.entries
+        rate = nevents / max(seconds, 1e-9)
+        throughput_drop = (
+            state.previous is not None and state.events_per_s is not None
+            and rate < (1 - self.throughput_tolerance) * state.events_per_s
+        )
+        state.bytes_per_event = self._smooth(state.bytes_per_event, max(peak_rss - base_rss, 0) / nevents)
+        state.events_per_s = self._smooth(state.events_per_s, rate)
+
+        available = self.headroom * self.memory_budget - base_rss
+        if available <= 0:
+            entries, reason = self.min_entries, f"baseline RSS {base_rss / 2**20:.0f} MB leaves no room"
+        elif peak_rss > self.memory_budget:
+            entries = int(available / max(state.bytes_per_event, 1.))
+            reason = f"peak RSS {peak_rss / 2**20:.0f} MB over the budget"
+        elif throughput_drop and state.previous < state.entries:
+            entries = state.previous
+            reason = f"throughput fell to {rate:.0f} events/s after growing"
+        else:
+            entries = int(available / max(state.bytes_per_event, 1.))
+            entries = min(entries, int(state.entries * self.max_growth))
+            reason = (f"{state.bytes_per_event / 1024:.1f} kB/event, "
+                      f"{state.events_per_s:.0f} events/s, peak {peak_rss / 2**20:.0f} MB")
+        entries = max(self.min_entries, min(self.max_entries, entries))
+        if entries != state.entries:
+            self.history.append({
+                "time": time.time(),
+                "dataset": dataset,
+                "from": state.entries,
+                "to": entries,
+                "reason": reason,
+            })
+            logger.info("%s: chunk size %d -> %d (%s)", dataset, state.entries, entries, reason)
+            state.previous = state.entries
+            state.entries = entries
+        return entries
+
+
+class AdaptiveChunker:
+    '''
+    Yields the chunks of `datasets` ({name: {"metadata", "files"}}) one at
+    a time, sized by the controller, taking next the dataset that is
+    furthest behind in fraction of its entries. `take(site)` restricts the
+    choice to the files of one storage endpoint.
+    '''
+    def __init__(self, datasets, entry_counts, controller, treename="Events"):
+        self.controller = controller
+        self.treename = treename
+        self._todo = {}
+        self._total = {}
+        self._done = {}
+        self._metadata = {}
+        for dataset, content in datasets.items():
+            infos = entry_counts.scan(content["files"])
+            files = [(f, infos[f]) for f in content["files"] if infos[f]["entries"] > 0]
+            self._todo[dataset] = [[f, 0, info["entries"], info["uuid"], file_site(f)] for f, info in files]
+            self._total[dataset] = sum(info["entries"] for _, info in files) or 1
+            self._done[dataset] = 0
+            self._metadata[dataset] = content["metadata"]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.take()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def take(self, site=None):
+        '''
+        Next chunk, from a file of `site` if given; None when there is none left.
+        '''
+        candidates = {
+            d: next(i for i, item in enumerate(todo) if site is None or item[4] == site)
+            for d, todo in self._todo.items()
+            if any(site is None or item[4] == site for item in todo)
+        }
+        if not candidates:
+            return None
+        dataset = min(candidates, key=lambda d: self._done[d] / self._total[d])
+        todo = self._todo[dataset]
+        position = candidates[dataset]
+        filename, start, stop, uuid, _ = todo[position]
+        end = min(stop, start + self.controller.entries(dataset))
+        # Do not leave a tail much smaller than a chunk behind
+        if stop - end < self.controller.min_entries:
+            end = stop
+        if end == stop:
+            todo.pop(position)
+        else:
+            todo[position][1] = end
+        self._done[dataset] += end - start
+        metadata = self._metadata[dataset]
+        return Chunk(dataset, filename, start, end, (end - start) * cost_per_entry(metadata),
+                     self.treename, uuid, metadata)
+
+    def remaining_by_site(self):
+        remaining = {}
+        for todo in self._todo.values():
+            for _, start, stop, _, site in todo:
+                remaining[site] = remaining.get(site, 0) + stop - start
+        return remaining
+
+    @property
+    def remaining(self):
+        return sum(self._total[d] - self._done[d] for d in self._todo)
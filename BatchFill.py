@@ -0,0 +1,180 @@
+'''
+Batched filling of the 1D histograms of a configuration.
+
+The HistConfs are grouped by the collection (and object position) they
+read. For every group and category the collection is masked, the fields are
+flattened and the weights broadcast to the objects once; then the bin
+indices of all the histograms of the group are stacked and filled with a
+single weighted bincount, directly into the histogram storage. The weight
+variations are stacked as the columns of one weight matrix per category and
+filled along the variation axis in the same bincount, so the masking, the
+flattening and the binning are shared by all the systematics.
+
+Only 1D histograms with a regular, variable or integer axis and without
+per-sample, per-category or per-variation options are supported; the
+processor falls back to the standard pocket_coffea filling otherwise.
+'''
+from collections import defaultdict
+
+import awkward as ak
+import numpy as np
+
+SUPPORTED_AXES = ("regular", "variable", "int")
+
+
+def _axis_type(axis):
+    return getattr(axis, "type", "regular") or "regular"
+
+
+def supported(hist_conf):
+    if len(hist_conf.axes) != 1 or not getattr(hist_conf, "autofill", True):
+        return False
+    # Per-sample, per-category and per-variation restrictions stay with pocket_coffea
+    for option in ("only_variations", "only_samples", "exclude_samples",
+                   "only_categories", "exclude_categories"):
+        if getattr(hist_conf, option, None):
+            return False
+    if not getattr(hist_conf, "variations", True) or getattr(hist_conf, "no_weights", False):
+        return False
+    axis = hist_conf.axes[0]
+    return (
+        _axis_type(axis) in SUPPORTED_AXES
+        and getattr(axis, "transform", None) is None
+        and getattr(axis, "underflow", True)
+        and getattr(axis, "overflow", True)
+    )
+
+
+def hist_axis(axis):
+    import hist
+
+    name = axis.name or (axis.field if axis.coll == "events" else f"{axis.coll}.{axis.field}")
+    axis_type = _axis_type(axis)
+    if axis_type == "variable":
+        return hist.axis.Variable(axis.bins, name=name, label=axis.label)
+    if axis_type == "int":
+        return hist.axis.Integer(axis.start, axis.stop, name=name, label=axis.label)
+    return hist.axis.Regular(axis.bins, axis.start, axis.stop, name=name, label=axis.label)
+
+
+def nbins_with_flow(axis):
+    axis_type = _axis_type(axis)
+    if axis_type == "variable":
+        return len(axis.bins) + 1
+    if axis_type == "int":
+        return int(axis.stop - axis.start) + 2
+    return axis.bins + 2
+
+
+def bin_index(axis, values):
+    '''
+    Index in the flow view of the histogram axis: 0 is the underflow and
+    the last index the overflow, where NaN values go as in boost-histogram.
+    '''
+    overflow = nbins_with_flow(axis) - 1
+    values = np.where(np.isnan(values), np.inf, values)
+    axis_type = _axis_type(axis)
+    if axis_type == "variable":
+        return np.searchsorted(np.asarray(axis.bins, dtype=np.float64), values, side="right")
+    if axis_type == "int":
+        index = np.floor(values - axis.start) + 1
+    else:
+        index = np.floor((values - axis.start) / (axis.stop - axis.start) * axis.bins) + 1
+    return np.clip(index, 0, overflow).astype(np.int64)
+
+
+class BatchedHistFiller:
+    def __init__(self, hist_confs, categories, variations):
+        self.categories = list(categories)
+        self.variations = list(variations)
+        self.groups = defaultdict(list)
+        self.unsupported = []
+        for name, hist_conf in hist_confs.items():
+            if not supported(hist_conf):
+                self.unsupported.append(name)
+                continue
+            axis = hist_conf.axes[0]
+            self.groups[(axis.coll, axis.pos)].append((name, axis))
+
+    def empty_histograms(self):
+        import hist
+
+        histograms = {}
+        for members in self.groups.values():
+            for name, axis in members:
+                histograms[name] = hist.Hist(
+                    hist.axis.StrCategory(self.categories, name="cat"),
+                    hist.axis.StrCategory(self.variations, name="variation"),
+                    hist_axis(axis),
+                    storage=hist.storage.Weight(),
+                )
+        return histograms
+
+    @staticmethod
+    def _group_values(events, coll, pos, fields, mask):
+        '''
+        Flat values of each field for the selected events, the index of the
+        event each value belongs to and the masks of the missing values.
+        '''
+        if coll == "events":
+            selected = events[mask]
+            event_index = np.arange(len(selected))
+            values = {field: selected[field] for field in fields}
+        else:
+            objects = events[coll][mask]
+            if pos is not None:
+                objects = ak.pad_none(objects, pos + 1, axis=1)[:, pos]
+                event_index = np.arange(len(objects))
+                values = {field: objects[field] for field in fields}
+            else:
+                counts = ak.to_numpy(ak.num(objects, axis=1))
+                event_index = np.repeat(np.arange(len(counts)), counts)
+                values = {field: ak.flatten(objects[field], axis=1) for field in fields}
+        missing = {field: ak.to_numpy(ak.is_none(array)) for field, array in values.items()}
+        values = {
+            field: ak.to_numpy(ak.fill_none(array, 0)).astype(np.float64) for field, array in values.items()
+        }
+        return event_index, values, missing
+
+    def fill(self, histograms, events, category_masks, weights, variations=None):
+        '''
+        Adds one chunk into `histograms`.
+
+        `category_masks` maps each category to a boolean event mask and
+        `weights` maps each category to a (n_events, n_variations) weight
+        matrix whose columns are `variations` (all the variations of the
+        filler by default).
+        '''
+        variations = self.variations if variations is None else list(variations)
+        nvar = len(self.variations)
+        columns = np.array([self.variations.index(v) for v in variations], dtype=np.int64)
+        views = {name: h.view(flow=True) for name, h in histograms.items()}
+        for (coll, pos), members in self.groups.items():
+            fields = sorted({axis.field for _, axis in members})
+            sizes = [nbins_with_flow(axis) for _, axis in members]
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            for icat, category in enumerate(self.categories):
+                mask = np.asarray(category_masks[category], dtype=bool)
+                if not mask.any():
+                    continue
+                event_index, values, missing = self._group_values(events, coll, pos, fields, mask)
+                # Stacked global bin index of every histogram of the group,
+                # -1 where the value is missing
+                stacked = np.empty((len(members), event_index.size), dtype=np.int64)
+                for i, (_, axis) in enumerate(members):
+                    stacked[i] = np.where(missing[axis.field], -1, bin_index(axis, values[axis.field]) + offsets[i])
+                valid = stacked >= 0
+                w = np.asarray(weights[category], dtype=np.float64).reshape(len(mask), -1)
+                w = w[mask][event_index]
+                w = np.broadcast_to(w, (len(members), *w.shape))[valid]
+                # One bincount over (bin, variation) for every variation at once
+                index = (stacked[valid][:, None] * nvar + columns).ravel()
+                size = offsets[-1] * nvar
+                sumw = np.bincount(index, weights=w.ravel(), minlength=size).reshape(-1, nvar)
+                sumw2 = np.bincount(index, weights=(w * w).ravel(), minlength=size).reshape(-1, nvar)
+                for i, (name, _) in enumerate(members):
+                    view = views[name]
+                    # The flow view of the variation axis ends with its overflow bin
+                    view.value[icat, :nvar] += sumw[offsets[i]:offsets[i + 1]].T
+                    view.variance[icat, :nvar] += sumw2[offsets[i]:offsets[i + 1]].T
+        return histograms
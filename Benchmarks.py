@@ -0,0 +1,398 @@
+'''
+Throughput benchmarks of the processor stages and of the CommonSelectors
+cuts on synthetic NanoAOD-like events.
+
+For each benchmark the events per second (best of `--repeat` runs) and the
+peak memory allocated during one run are reported. Results can be stored as
+a baseline and later runs compared against it; a slowdown or a memory
+increase beyond the tolerance is reported as a regression and makes the
+script exit with a non-zero status. The merge benchmarks compare merging
+pickled chunk outputs in the parent with the shared memory slabs of
+SharedAccumulator, and report the bytes each sends to the parent.
+
+    python Benchmarks.py --nevents 200000 --save-baseline bench_baseline.json
+    python Benchmarks.py --nevents 200000 --baseline bench_baseline.json
+'''
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import awkward as ak
+import numpy as np
+
+import FastKernels
+from BatchFill import BatchedHistFiller
+from ChunkCache import chunk_cache
+from CutChain import CutChain
+from SharedAccumulator import SlabAccumulator, reduce_slabs
+from SyntheticEvents import synthetic_events
+from WorkerState import clear_worker_state
+
+PROCESSOR_STAGES = [
+    "apply_object_preselection",
+    "count_objects",
+    "define_common_variables_before_presel",
+    "define_common_variables_after_presel",
+]
+
+# (benchmark name, cut object name in CommonSelectors)
+CUTS = [
+    ("mtw", "req_mtw"),
+    ("JetMuPtratio", "ptratiobtv"),
+    ("dilepveto", "req_dilepveto"),
+    ("MuonSelBTV", "mujetselbtv"),
+    ("reqmu", "reqmuon"),
+    ("JetSelBTV", "jetselbtv"),
+    ("reqsoftmu", "reqsoftmuon"),
+    ("dilepmass", "req_dilepmass"),
+    ("QCDVetoratio", "qcdvetoratio"),
+]
+
+WC_CHAIN = [cut for _, cut in CUTS[:8]]
+
+# Cuts with a compiled fast path in FastKernels
+FAST_CUTS = ["mtw", "dilepveto", "MuonSelBTV", "dilepmass"]
+
+# Weight variations of config_Wc, with random weights in the fill benchmarks
+FILL_VARIATIONS = ["nominal"] + [f"{w}{d}" for w in ("pileup", "sf_mu_id", "sf_mu_iso") for d in ("Up", "Down")]
+
+# Chunk outputs merged in the merge benchmarks, spread over this many workers
+MERGE_CHUNKS = 16
+MERGE_WORKERS = 4
+
+
+def measure(function, nevents, repeat=3):
+    '''
+    Best wall time over `repeat` runs and the peak traced memory of one
+    additional run.
+    The per-chunk cache is cleared before every run so that cached
+    quantities are not credited to the benchmark.
+    '''
+    times = []
+    for _ in range(repeat):
+        chunk_cache.clear()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # Memory tracing slows allocations down, so it gets a run of its own
+    chunk_cache.clear()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(times)
+    return {
+        "events_per_s": nevents / best if best > 0 else float("inf"),
+        "seconds": best,
+        "peak_mb": peak / 2**20,
+    }
+
+
+def cut_mask(cut, events, fast=False):
+    FastKernels.set_enabled(fast)
+    try:
+        return cut.get_mask(events, year="2017", sample="synthetic", isMC=True)
+    finally:
+        FastKernels.set_enabled(False)
+
+
+def validate_fast_kernels(events):
+    '''
+    Number of events where the compiled and the awkward implementation of
+    each fast cut disagree.
+    '''
+    import CommonSelectors
+
+    mismatches = {}
+    for name, cut_name in CUTS:
+        if name not in FAST_CUTS:
+            continue
+        cut = getattr(CommonSelectors, cut_name)
+        chunk_cache.clear()
+        reference = np.asarray(ak.to_numpy(cut_mask(cut, events)), dtype=bool)
+        fast = np.asarray(ak.to_numpy(cut_mask(cut, events, fast=True)), dtype=bool)
+        mismatches[name] = int(np.count_nonzero(reference != fast))
+    return mismatches
+
+
+def fill_per_histogram(histograms, hist_confs, events, category_masks, weights):
+    '''
+    Reference filling, one histogram, category and variation at a time like
+    the standard pocket_coffea filling.
+    '''
+    for name, h in histograms.items():
+        axis = hist_confs[name].axes[0]
+        for category, mask in category_masks.items():
+            for ivar, variation in enumerate(h.axes["variation"]):
+                selected = events[mask]
+                w = ak.Array(weights[category][mask, ivar])
+                if axis.coll == "events":
+                    values = selected[axis.field]
+                else:
+                    objects = selected[axis.coll]
+                    if axis.pos is not None:
+                        objects = ak.pad_none(objects, axis.pos + 1, axis=1)[:, axis.pos]
+                    values = objects[axis.field]
+                    if values.ndim > 1:
+                        w = ak.flatten(ak.broadcast_arrays(w, values)[0], axis=1)
+                        values = ak.flatten(values, axis=1)
+                present = ~ak.is_none(values)
+                h.fill(cat=category, variation=variation,
+                       **{h.axes[2].name: ak.to_numpy(values[present])},
+                       weight=ak.to_numpy(w[present]))
+    return histograms
+
+
+def fill_inputs(events, seed=0):
+    '''
+    Categories of config_Wc and a random weight matrix for every category,
+    with one column per variation.
+    '''
+    import CommonSelectors
+
+    rng = np.random.default_rng(seed)
+    chain = CutChain("added_cuts_wc[fill]", [getattr(CommonSelectors, c) for c in WC_CHAIN], reorder=False)
+    category_masks = {
+        "baseline_Wc": np.ones(len(events), dtype=bool),
+        "Added cuts Wc": chain(events, year="2017", sample="synthetic", isMC=True),
+    }
+    weights = {
+        category: rng.normal(1., 0.1, (len(events), len(FILL_VARIATIONS))) for category in category_masks
+    }
+    return category_masks, weights
+
+
+def validate_batched_fill(hist_confs, events):
+    '''
+    Histograms whose batched filling differs from the reference filling.
+    '''
+    category_masks, weights = fill_inputs(events)
+    filler = BatchedHistFiller(hist_confs, category_masks, FILL_VARIATIONS)
+    batched = filler.fill(filler.empty_histograms(), events, category_masks, weights)
+    reference = fill_per_histogram(filler.empty_histograms(), hist_confs, events, category_masks, weights)
+    return [
+        name for name in batched
+        if not np.allclose(batched[name].view(flow=True).value, reference[name].view(flow=True).value)
+    ]
+
+
+def chunk_output(hist_confs, events, seed=0):
+    '''
+    Output of a chunk shaped like the processor's: every histogram of the
+    config for each category and variation, the cutflows and the sums of
+    generator weights.
+    '''
+    category_masks, weights = fill_inputs(events, seed)
+    filler = BatchedHistFiller(hist_confs, category_masks, FILL_VARIATIONS)
+    histograms = filler.fill(filler.empty_histograms(), events, category_masks, weights)
+    return {
+        "variables": {name: {"synthetic": h} for name, h in histograms.items()},
+        "cutflow": {category: {"synthetic": int(mask.sum())} for category, mask in category_masks.items()},
+        "sum_genweights": {"synthetic": float(len(events))},
+    }
+
+
+def merge_pickled(payloads):
+    '''
+    Parent side of the usual merging: every chunk output is unpickled and
+    accumulated in turn.
+    '''
+    from coffea.processor import accumulate
+
+    output = None
+    for payload in payloads:
+        result = pickle.loads(payload)
+        output = result if output is None else accumulate([output, result])
+    return output
+
+
+def fill_slabs(outputs, nworkers):
+    '''
+    Worker side of the shared merging: the outputs are added to the slabs of
+    `nworkers` accumulators in turn.
+    '''
+    accumulators = [SlabAccumulator() for _ in range(nworkers)]
+    for i, output in enumerate(outputs):
+        accumulators[i % nworkers].add(output)
+    return accumulators
+
+
+def make_processor(config_path, outdir):
+    from ColumnPruning import load_config
+
+    cfg = load_config(config_path)
+    processor_instance = cfg.workflow(cfg)
+    processor_instance.ntuple_options["outdir"] = outdir
+    return processor_instance
+
+
+def preselected_events(nevents, seed, directory, config_path="config_Wc.py", multiplicities=None):
+    '''
+    Synthetic events run once through the processor stages, so that the cuts
+    see post-preselection events; returns the processor and the events. The
+    ntuple writer of the processor is left open.
+    '''
+    events = synthetic_events(nevents, seed, multiplicities, directory=directory)
+    processor_instance = make_processor(config_path, os.path.join(directory, "ntuples"))
+    processor_instance.events = events
+    # The saved variables go to a writer of this benchmark run
+    processor_instance.start_ntuples({"dataset": "synthetic", "filename": "synthetic"})
+    for stage in PROCESSOR_STAGES:
+        getattr(processor_instance, stage)("nominal")
+    return processor_instance, processor_instance.events
+
+
+def run_benchmarks(nevents, seed=0, repeat=3, config_path="config_Wc.py",
+                   multiplicities=None, only=None, validate=False):
+    import CommonSelectors
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        processor_instance, events = preselected_events(nevents, seed, tmpdir, config_path, multiplicities)
+
+        benchmarks = {}
+        for stage in PROCESSOR_STAGES:
+            benchmarks[f"stage:{stage}"] = (lambda s=stage: getattr(processor_instance, s)("nominal"))
+        for name, cut_name in CUTS:
+            cut = getattr(CommonSelectors, cut_name)
+            benchmarks[f"cut:{name}"] = (lambda c=cut: cut_mask(c, events))
+            if name in FAST_CUTS and FastKernels.numba is not None:
+                benchmarks[f"cut:{name}[fast]"] = (lambda c=cut: cut_mask(c, events, fast=True))
+
+        def wc_chain():
+            mask = None
+            for cut_name in WC_CHAIN:
+                cut = cut_mask(getattr(CommonSelectors, cut_name), events)
+                mask = cut if mask is None else mask & cut
+            return ak.to_numpy(mask)
+        benchmarks["chain:Added cuts Wc"] = wc_chain
+
+        # Fresh chain so that the warm-up and reordering happen in the benchmark
+        clear_worker_state("CutChain.added_cuts_wc[benchmark]")
+        short_circuit = CutChain("added_cuts_wc[benchmark]", [getattr(CommonSelectors, c) for c in WC_CHAIN])
+        benchmarks["chain:Added cuts Wc[short-circuit]"] = (
+            lambda: short_circuit(events, year="2017", sample="synthetic", isMC=True)
+        )
+
+        hist_confs = processor_instance.cfg.variables
+        filler = BatchedHistFiller(hist_confs, ["baseline_Wc", "Added cuts Wc"], FILL_VARIATIONS)
+        category_masks, weights = fill_inputs(events, seed)
+        benchmarks["fill:per-histogram"] = (
+            lambda: fill_per_histogram(filler.empty_histograms(), hist_confs, events, category_masks, weights)
+        )
+        benchmarks["fill:batched"] = (
+            lambda: filler.fill(filler.empty_histograms(), events, category_masks, weights)
+        )
+        # Cost of the systematics: the same fill with the nominal weights only
+        nominal = {category: w[:, :1] for category, w in weights.items()}
+        benchmarks["fill:batched[nominal only]"] = (
+            lambda: filler.fill(filler.empty_histograms(), events, category_masks, nominal, ["nominal"])
+        )
+
+        # Merging of the chunk outputs: pickled to the parent and accumulated one
+        # at a time, or added to per-worker slabs and reduced once
+        outputs = [chunk_output(hist_confs, events, seed + i) for i in range(MERGE_CHUNKS)]
+        payloads = [pickle.dumps(output) for output in outputs]
+        benchmarks["merge:accumulate[parent]"] = lambda: merge_pickled(payloads)
+
+        def slabs_worker():
+            for accumulator in fill_slabs(outputs, MERGE_WORKERS):
+                accumulator.close(unlink=True)
+        benchmarks["merge:shared[workers]"] = slabs_worker
+        slabs = fill_slabs(outputs, MERGE_WORKERS)
+        descriptions = [accumulator.describe() for accumulator in slabs]
+        benchmarks["merge:shared[parent]"] = lambda: reduce_slabs(descriptions, unlink=False)
+
+        if validate:
+            for name, n in validate_fast_kernels(events).items():
+                results[f"validate:{name}"] = {"mismatches": n}
+            results["validate:batched_fill"] = {"mismatches": len(validate_batched_fill(hist_confs, events))}
+
+        for name, function in benchmarks.items():
+            if only and not any(pattern in name for pattern in only):
+                continue
+            # Events of all the merged chunks for the merge benchmarks
+            results[name] = measure(function, nevents * MERGE_CHUNKS if name.startswith("merge:") else nevents,
+                                    repeat)
+        # What crosses the process boundaries for the merge
+        for name, nbytes in (("merge:accumulate[parent]", sum(len(p) for p in payloads)),
+                             ("merge:shared[parent]", sum(len(pickle.dumps(d)) for d in descriptions))):
+            if name in results:
+                results[name]["kb_to_parent"] = nbytes / 2**10
+        for accumulator in slabs:
+            accumulator.close(unlink=True)
+        processor_instance.finish_ntuples()
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Returns the list of (benchmark, metric, baseline, current) regressions.
+    '''
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get(name)
+        if reference is None or "events_per_s" not in current:
+            continue
+        if current["events_per_s"] < reference["events_per_s"] * (1 - tolerance):
+            regressions.append((name, "events_per_s", reference["events_per_s"], current["events_per_s"]))
+        if current["peak_mb"] > reference["peak_mb"] * (1 + tolerance):
+            regressions.append((name, "peak_mb", reference["peak_mb"], current["peak_mb"]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    baseline = baseline or {}
+    print(f"{'benchmark':<50} {'events/s':>14} {'peak MB':>10} {'vs baseline':>12}")
+    for name, r in results.items():
+        if "mismatches" in r:
+            status = "OK" if r["mismatches"] == 0 else f"{r['mismatches']} mismatches"
+            print(f"{name:<50} {status}")
+            continue
+        ratio = ""
+        if name in baseline:
+            ratio = f"{r['events_per_s'] / baseline[name]['events_per_s']:.2f}x"
+        sent = f" {r['kb_to_parent']:.0f} kB to the parent" if "kb_to_parent" in r else ""
+        print(f"{name:<50} {r['events_per_s']:14.0f} {r['peak_mb']:10.1f} {ratio:>12}{sent}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the processor stages and cuts on synthetic events")
+    parser.add_argument("--nevents", type=int, default=100_000, help="Events per chunk")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_Wc.py"))
+    parser.add_argument("--mult", nargs="*", default=[], help="Mean multiplicities, e.g. Jet=6 Muon=2")
+    parser.add_argument("--only", nargs="*", help="Run only benchmarks whose name contains one of these")
+    parser.add_argument("--baseline", help="Compare against this baseline JSON")
+    parser.add_argument("--save-baseline", help="Store the results as a baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--validate-kernels", action="store_true",
+                        help="Check that the fast kernels and the batched filling match the reference implementations")
+    args = parser.parse_args()
+
+    multiplicities = {k: float(v) for k, v in (m.split("=") for m in args.mult)}
+    results = run_benchmarks(args.nevents, args.seed, args.repeat, args.config, multiplicities,
+                             args.only, args.validate_kernels)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, reference, current in regressions:
+            print(f"REGRESSION {name}: {metric} {reference:.1f} -> {current:.1f}")
+    mismatching = [name for name, r in results.items() if r.get("mismatches")]
+    sys.exit(1 if regressions or mismatching else 0)
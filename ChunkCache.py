@@ -0,0 +1,82 @@
+import awkward as ak
+
+
+class ChunkCache:
+    '''
+    Memoizes derived quantities (leading objects, four-vector sums, ΔR, ...)
+    for the chunk currently being processed. Entries are keyed by the events
+    array they were built from and by an expression key, so the processor
+    methods and the cut functions share every quantity they both need.
+    The store is emptied at the end of each chunk by the processor.
+    '''
+    def __init__(self):
+        self._stores = {}
+
+    def _store(self, events):
+        # Keep a reference to the events array: an id alone could be reused
+        # by a later array once the original has been garbage collected
+        entry = self._stores.get(id(events))
+        if entry is None or entry[0] is not events:
+            entry = (events, {})
+            self._stores[id(events)] = entry
+        return entry[1]
+
+    def get(self, events, key, builder):
+        store = self._store(events)
+        if key not in store:
+            store[key] = builder()
+        return store[key]
+
+    def discard(self, events):
+        '''
+        Drops what was cached for `events`, e.g. a slice that is no longer used.
+        '''
+        entry = self._stores.get(id(events))
+        if entry is not None and entry[0] is events:
+            del self._stores[id(events)]
+
+    def clear(self):
+        self._stores.clear()
+
+    def __len__(self):
+        return sum(len(store) for _, store in self._stores.values())
+
+    def __getstate__(self):
+        # Never ship cached arrays to the workers
+        return {"_stores": {}}
+
+
+chunk_cache = ChunkCache()
+
+
+def leading(events, coll):
+    return chunk_cache.get(events, ("leading", coll), lambda: ak.firsts(events[coll]))
+
+
+def leading_sum(events, coll1, coll2):
+    return chunk_cache.get(
+        events, ("leading_sum",) + tuple(sorted((coll1, coll2))),
+        lambda: leading(events, coll1) + leading(events, coll2)
+    )
+
+
+def leading_delta_r(events, coll1, coll2):
+    return chunk_cache.get(
+        events, ("leading_delta_r",) + tuple(sorted((coll1, coll2))),
+        lambda: leading(events, coll1).delta_r(leading(events, coll2))
+    )
+
+
+def leading_ptratio(events, num, den):
+    return chunk_cache.get(
+        events, ("leading_ptratio", num, den),
+        lambda: leading(events, num).pt / leading(events, den).pt
+    )
+
+
+def sum_with_met(events, coll):
+    # Every object of the collection plus the event MET
+    return chunk_cache.get(
+        events, ("sum_with_met", coll),
+        lambda: events[coll] + events.MET
+    )
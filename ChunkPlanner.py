@@ -0,0 +1,306 @@
+'''
+Size-aware chunk planning and work balancing.
+
+The dataset JSONs carry the number of events and the size in bytes of every
+sample. Together with the number of entries of each file (scanned once and
+cached in `entry_counts.json`) they give an estimated cost per entry, which
+is used to cut every file into chunks of roughly equal cost rather than of
+equal size. Chunks of all the datasets are interleaved so that every dataset
+progresses at the same relative rate and the tail of the job is not made of
+a single large sample.
+
+`WorkQueue` dispatches the chunks to an executor and re-splits straggler
+chunks: a chunk running much longer than its expected duration is split in
+halves which are resubmitted; whichever covers the entries first wins.
+LocalRunner uses it, on a plan from `plan_chunks`, with
+`resplit_stragglers=True`.
+'''
+import json
+import os
+import statistics
+import time
+import uuid as uuidlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+
+import uproot
+
+
+@dataclass(frozen=True)
+class Chunk:
+    dataset: str
+    filename: str
+    entrystart: int
+    entrystop: int
+    cost: float
+    treename: str = "Events"
+    fileuuid: str = ""
+    metadata: dict = field(default_factory=dict, compare=False, hash=False)
+
+    @property
+    def nevents(self):
+        return self.entrystop - self.entrystart
+
+    @property
+    def key(self):
+        return (self.filename, self.entrystart, self.entrystop)
+
+    def split(self, n=2):
+        bounds = [self.entrystart + (self.nevents * i) // n for i in range(n + 1)]
+        return [
+            replace(self, entrystart=start, entrystop=stop,
+                    cost=self.cost * (stop - start) / self.nevents)
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+        ]
+
+    def to_work_item(self):
+        from coffea.processor.executor import WorkItem
+        return WorkItem(
+            self.dataset, self.filename, self.treename, self.entrystart, self.entrystop,
+            uuidlib.UUID(self.fileuuid).bytes if self.fileuuid else b"",
+            self.metadata,
+        )
+
+
+class EntryCounts:
+    '''
+    Number of entries and UUID of each file, scanned on first use and cached
+    on disk for the following runs.
+    '''
+    def __init__(self, path="entry_counts.json", treename="Events"):
+        self.path = path
+        self.treename = treename
+        self._counts = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._counts = json.load(f)
+
+    def _scan_file(self, filename):
+        with uproot.open(filename) as f:
+            return {"entries": f[self.treename].num_entries, "uuid": f.file.uuid.hex}
+
+    def scan(self, filenames, max_workers=16):
+        missing = [f for f in dict.fromkeys(filenames) if f not in self._counts]
+        if missing:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for filename, info in zip(missing, pool.map(self._scan_file, missing)):
+                    self._counts[filename] = info
+            self.save()
+        return {f: self._counts[f] for f in filenames}
+
+    def get(self, filename):
+        return self._counts.get(filename)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._counts, f)
+        os.replace(tmp_path, self.path)
+
+
+def cost_per_entry(metadata):
+    # Compressed bytes per event of the sample, 1 if the catalog does not know
+    try:
+        return float(metadata["size"]) / float(metadata["nevents"])
+    except (KeyError, ValueError, ZeroDivisionError):
+        return 1.
+
+
+def plan_chunks(datasets, entry_counts=None, target_cost=100 * 2**20,
+                max_entries=None, scan=True, treename="Events"):
+    '''
+    Cuts every file of `datasets` ({name: {"metadata": ..., "files": [...]}},
+    as in the dataset JSONs) into chunks of roughly `target_cost` bytes and
+    returns them interleaved across datasets.
+    '''
+    if entry_counts is None:
+        entry_counts = EntryCounts(treename=treename)
+    per_dataset = {}
+    for dataset, content in datasets.items():
+        metadata = content["metadata"]
+        files = content["files"]
+        unit_cost = cost_per_entry(metadata)
+        if scan:
+            infos = entry_counts.scan(files)
+        else:
+            # Without a scan the catalog's events are shared evenly among the files
+            guess = int(metadata.get("nevents", 0)) // max(len(files), 1)
+            infos = {f: entry_counts.get(f) or {"entries": guess, "uuid": ""} for f in files}
+        chunks = []
+        for filename in files:
+            entries = infos[filename]["entries"]
+            if entries == 0:
+                continue
+            nchunks = max(1, round(entries * unit_cost / target_cost))
+            if max_entries:
+                nchunks = max(nchunks, -(-entries // max_entries))
+            whole = Chunk(dataset, filename, 0, entries, entries * unit_cost,
+                          treename, infos[filename]["uuid"], metadata)
+            chunks.extend(whole.split(nchunks))
+        per_dataset[dataset] = chunks
+    return interleave(per_dataset)
+
+
+def interleave(per_dataset):
+    '''
+    Orders the chunks so that each dataset advances at the same fraction of
+    its total cost; larger chunks go first among ties.
+    '''
+    keyed = []
+    for chunks in per_dataset.values():
+        total = sum(c.cost for c in chunks) or 1.
+        done = 0.
+        for chunk in chunks:
+            keyed.append(((done + chunk.cost / 2) / total, -chunk.cost, chunk))
+            done += chunk.cost
+    keyed.sort(key=lambda item: item[:2])
+    return [chunk for *_, chunk in keyed]
+
+
+def summarize(chunks):
+    summary = {}
+    for chunk in chunks:
+        s = summary.setdefault(chunk.dataset, {"chunks": 0, "events": 0, "cost": 0.})
+        s["chunks"] += 1
+        s["events"] += chunk.nevents
+        s["cost"] += chunk.cost
+    return summary
+
+
+class WorkQueue:
+    '''
+    Runs `process_chunk(chunk)` for every chunk of `chunks` (a plan or a
+    chunker, pulled as slots free up) on an executor with `workers` workers.
+
+    A running chunk whose elapsed time exceeds `straggler_factor` times the
+    median time per unit cost of the completed chunks is split and its
+    halves are submitted next; the original keeps running, as a running
+    future cannot be cancelled. Whichever finishes first wins: once the
+    original is accepted its halves are dropped, and once a half is accepted
+    the original is, so each entry is counted once.
+
+    At most `workers` chunks are submitted at a time, so that every one of
+    them is running from its submission and its elapsed time is its own.
+    '''
+    def __init__(self, chunks, workers, straggler_factor=3., min_split_entries=10_000,
+                 min_completed=5, poll_interval=1.):
+        self._source = iter(chunks)
+        self.pending = deque()
+        self.workers = workers
+        self.straggler_factor = straggler_factor
+        self.min_split_entries = min_split_entries
+        self.min_completed = min_completed
+        self.poll_interval = poll_interval
+        self._accepted = {}
+        self._rates = []
+        # Split chunk key -> keys of its halves, and the keys not to accept
+        self._halves = {}
+        self._dropped = set()
+        self.nresplit = 0
+        self.ndropped = 0
+
+    def _covered(self, chunk):
+        return chunk.key in self._dropped or any(
+            start < chunk.entrystop and chunk.entrystart < stop
+            for start, stop in self._accepted.get(chunk.filename, ())
+        )
+
+    def _next_chunk(self):
+        while self.pending:
+            chunk = self.pending.popleft()
+            if not self._covered(chunk):
+                return chunk
+        for chunk in self._source:
+            if not self._covered(chunk):
+                return chunk
+        return None
+
+    def _accept(self, chunk):
+        self._accepted.setdefault(chunk.filename, []).append((chunk.entrystart, chunk.entrystop))
+        # The other copy of these entries is dropped whatever its state
+        self._dropped.update(self._halves.get(chunk.key, ()))
+        for original, halves in self._halves.items():
+            if chunk.key in halves:
+                self._dropped.add(original)
+
+    def _stragglers(self, running, now):
+        if len(self._rates) < self.min_completed:
+            return []
+        limit = self.straggler_factor * statistics.median(self._rates)
+        return [
+            chunk for future, (chunk, started) in running.items()
+            if chunk.nevents >= 2 * self.min_split_entries
+            and (now - started) > limit * chunk.cost
+        ]
+
+    def results(self, executor, process_chunk, max_inflight=None):
+        '''
+        Yields (chunk, result) for every accepted chunk, as they complete.
+        '''
+        # A chunk waiting in the executor queue would look like a straggler
+        max_inflight = min(max_inflight or self.workers, self.workers)
+        running = {}
+        while True:
+            while len(running) < max_inflight:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                running[executor.submit(process_chunk, chunk)] = (chunk, time.monotonic())
+            if not running:
+                return
+            done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in done:
+                chunk, started = running.pop(future)
+                result = future.result()
+                if self._covered(chunk):
+                    self.ndropped += 1
+                    continue
+                self._accept(chunk)
+                self._rates.append((now - started) / max(chunk.cost, 1e-9))
+                yield chunk, result
+            for chunk in self._stragglers(running, now):
+                if chunk.key in self._halves:
+                    continue
+                halves = chunk.split(2)
+                self._halves[chunk.key] = {half.key for half in halves}
+                self.nresplit += 1
+                # The halves jump the queue; the original keeps running
+                self.pending.extendleft(reversed(halves))
+            # Stop waiting for the copies that lost; running ones finish unused
+            for future in [f for f, (c, _) in running.items() if self._covered(c)]:
+                future.cancel()
+                running.pop(future)
+                self.ndropped += 1
+
+    def run(self, executor, process_chunk, merge, max_inflight=None):
+        '''
+        Merges the results of all the accepted chunks with `merge(a, b)`.
+        '''
+        output = None
+        for _, result in self.results(executor, process_chunk, max_inflight):
+            output = result if output is None else merge(output, result)
+        return output
+
+    def summary(self):
+        return {"resplit": self.nresplit, "dropped": self.ndropped}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Plan equal-cost chunks for the dataset JSONs")
+    parser.add_argument("jsons", nargs="+")
+    parser.add_argument("--target-mb", type=float, default=100.)
+    parser.add_argument("--counts", default="entry_counts.json")
+    parser.add_argument("--no-scan", action="store_true", help="Estimate entries from the catalog")
+    args = parser.parse_args()
+
+    datasets = {}
+    for path in args.jsons:
+        with open(path) as f:
+            datasets.update(json.load(f))
+    chunks = plan_chunks(datasets, EntryCounts(args.counts), args.target_mb * 2**20, scan=not args.no_scan)
+    for dataset, s in summarize(chunks).items():
+        print(f"{dataset:>60}: {s['chunks']:6d} chunks {s['events']:12d} events {s['cost'] / 2**30:9.2f} GB")
@@ -1,9 +1,9 @@
+import warnings
+
 import awkward as ak
 import numpy as np
-import warnings
-import os
+import pyarrow as pa
 import uproot
-import pandas as pd
 
 from pocket_coffea.workflows.base import BaseProcessorABC
 from pocket_coffea.utils.configurator import Configurator
@@ -17,6 +17,39 @@ from pocket_coffea.lib.objects import (
     get_dilepton
 )
 
+from BatchFill import BatchedHistFiller, supported
+from CutBits import accumulate_cutflow
+from CutScan import accumulate_check, accumulate_scan
+from ChunkCache import (
+    chunk_cache,
+    leading_delta_r,
+    leading_ptratio,
+    sum_with_met,
+)
+import FastKernels
+from Instrumentation import start_recording, stop_recording
+from NtupleWriter import NTUPLE_DEFAULTS, chunk_writer, compact, consolidate, to_narrow_table
+from Preview import preview_report, preview_sum_genweights, preview_summary
+from ResultStore import ResultStore, chunk_key
+from SkimWriter import SKIM_DEFAULTS, skim_sum_genweights, skim_summary, write_skim_chunk, write_skim_datasets
+
+# Processor methods timed when the instrumentation is switched on
+INSTRUMENTED_STAGES = [
+    "load_metadata",
+    "skim_events",
+    "apply_object_preselection",
+    "count_objects",
+    "define_common_variables_before_presel",
+    "apply_preselections",
+    "define_common_variables_after_presel",
+    "process_extra_after_presel",
+    "define_categories",
+    "compute_weights",
+    "fill_histograms",
+    "fill_histograms_extra",
+    "fill_column_accumulators",
+]
+
 
 class CommBTVBaseProcessor(BaseProcessorABC):
     def __init__(self, cfg: Configurator):
@@ -25,7 +58,219 @@ class CommBTVBaseProcessor(BaseProcessorABC):
         # self.proc_type = self.params["proc_type"]
         # self.isArray=self.cfg["isArray"]
         #  self.campaign["run_options]/
-        print(self.params,self.cfg)
+        workflow_options = self.workflow_options or {}
+        self.ntuple_options = {**NTUPLE_DEFAULTS, **workflow_options.get("ntuples", {})}
+        self.instrumentation = workflow_options.get("instrumentation", False)
+        self.fast_kernels = workflow_options.get("fast_kernels", False)
+        self.bit_cutflows = workflow_options.get("bit_cutflows", [])
+        self.scans = workflow_options.get("scans", [])
+        self.batched_fill = workflow_options.get("batched_fill", False)
+        if self.batched_fill:
+            unsupported = [name for name, conf in self.cfg.variables.items() if not supported(conf)]
+            if unsupported:
+                warnings.warn(f"Batched filling disabled, unsupported histograms: {unsupported}")
+                self.batched_fill = False
+        # {"directory": ..., "config_hash": ...} to save and reuse the chunk results
+        self.checkpoint = workflow_options.get("checkpoint")
+        if self.checkpoint:
+            self.result_store.warn_stale()
+        # Write the events passing the skim and the preselection to local files
+        skim = workflow_options.get("skim")
+        self.skim = {**SKIM_DEFAULTS, **skim} if skim else None
+        if self.skim and not self.skim["columns"]:
+            raise ValueError("The skim needs the branches to keep, e.g. from ColumnPruning.load_columns")
+
+    @property
+    def result_store(self):
+        return ResultStore(self.checkpoint["directory"], self.checkpoint["config_hash"])
+
+    def start_ntuples(self, metadata):
+        '''
+        Opens the ntuple writer of a chunk; its parts are named after the
+        chunk, so that a rerun replaces them. With checkpointing the tables
+        are kept with the chunk result instead.
+        '''
+        self._ntuple_tables = []
+        self._ntuple_writer = None
+        self._variables_to_save = None
+        if not self.checkpoint:
+            self._ntuple_writer = chunk_writer(chunk_key(metadata), **self.ntuple_options)
+
+    def finish_ntuples(self):
+        '''
+        Closes the ntuple writer of the chunk, raising any write failure, and
+        returns {dataset: [part paths]}.
+        '''
+        writer, self._ntuple_writer = self._ntuple_writer, None
+        return writer.close() if writer is not None else {}
+
+    def abort_ntuples(self):
+        writer, self._ntuple_writer = self._ntuple_writer, None
+        if writer is not None:
+            writer.abort()
+
+    def process(self, events):
+        if self.checkpoint:
+            key = chunk_key(events.metadata)
+            saved = self.result_store.load(key)
+            if saved is not None:
+                return saved["accumulator"]
+        self.start_ntuples(events.metadata)
+        if self.skim:
+            # Position in the chunk, to find the surviving events in the input file
+            events["skim_index"] = np.arange(len(events))
+            self._skimmed = (np.zeros(0, dtype=np.int64), None)
+        FastKernels.set_enabled(self.fast_kernels)
+        recorder = None
+        if self.instrumentation:
+            recorder = start_recording(keep_trace=self.instrumentation != "summary")
+            restore = recorder.instrument_methods(self, INSTRUMENTED_STAGES)
+        self._batched_histograms = {}
+        try:
+            output = super().process(events)
+        except BaseException:
+            # The partial ntuple of a failed chunk is not kept
+            self.abort_ntuples()
+            raise
+        finally:
+            # Derived quantities are only valid for the chunk they were built from
+            chunk_cache.clear()
+            if recorder is not None:
+                restore()
+                stop_recording()
+        parts = self.finish_ntuples()
+        if parts:
+            output["ntuples"] = parts
+        if recorder is not None:
+            output.update(recorder.output())
+        for name, histogram in self._batched_histograms.items():
+            output.setdefault("variables", {}).setdefault(name, {})[self._sample] = histogram
+        if self.skim:
+            output.setdefault("skimmed", {})[events.metadata["dataset"]] = skim_summary(events, *self._skimmed)
+        # Chunks of a preview run (see Preview.PreviewChunker)
+        if "preview" in events.metadata:
+            output.setdefault("preview", {})[events.metadata["dataset"]] = preview_summary(events)
+        if self.checkpoint:
+            dataset = events.metadata["dataset"]
+            output.setdefault("checkpoint", {}).setdefault(dataset, {})[key] = len(events)
+            ntuple = pa.concat_tables(self._ntuple_tables) if self._ntuple_tables else None
+            self.result_store.save(key, events.metadata, output, ntuple)
+        return output
+
+    def postprocess(self, accumulator):
+        # Skimmed datasets are normalized with the generator weights of the original events
+        for dataset, sum_genweights in skim_sum_genweights(self.cfg.filesets).items():
+            if dataset in accumulator.get("sum_genweights", {}):
+                accumulator["sum_genweights"][dataset] = sum_genweights
+        # A preview of a skim only processed part of the original sum
+        previewed = accumulator.get("preview", {})
+        for dataset, sum_genweights in preview_sum_genweights(self.cfg.filesets, previewed).items():
+            if dataset in accumulator.get("sum_genweights", {}):
+                accumulator["sum_genweights"][dataset] = sum_genweights
+        accumulator = super().postprocess(accumulator)
+        if "preview" in accumulator:
+            accumulator["preview"] = preview_report(accumulator, self.cfg.filesets)
+        # Index the parts written by the chunks of this job only
+        parts = accumulator.get("ntuples", {})
+        writer_options = {k: v for k, v in self.ntuple_options.items() if k not in ("background", "max_pending")}
+        if self.checkpoint:
+            parts = self.result_store.export_ntuples(accumulator.pop("checkpoint", {}), **writer_options)
+        elif parts:
+            # One small part per chunk is merged into files of the configured size
+            parts = compact(writer_options.pop("outdir"), parts, **writer_options)
+            accumulator["ntuples"] = parts
+        consolidate(self.ntuple_options["outdir"], parts)
+        if self.skim:
+            write_skim_datasets(self.skim["outdir"], self.cfg.filesets, accumulator.get("skimmed", {}))
+        return accumulator
+
+    def process_extra_after_presel(self, variation):
+        if self.skim and variation == "nominal":
+            index = ak.to_numpy(self.events.skim_index)
+            path = None
+            if len(index):
+                path = write_skim_chunk(self.skim["outdir"], self.events.metadata, self.skim["columns"],
+                                        index, self.skim["compression"])
+            self._skimmed = (index, path)
+
+    def histogram_variations(self):
+        '''
+        Weight variations of the sample ("nominal" first) and shape variations.
+        '''
+        if not self._isMC:
+            return ["nominal"], []
+        weights = getattr(self.cfg, "available_weights_variations", {}).get(self._sample, [])
+        shapes = getattr(self.cfg, "available_shape_variations", {}).get(self._sample, [])
+        return ["nominal"] + [v for v in weights if v != "nominal"], [v for v in shapes if v != "nominal"]
+
+    def fill_histograms(self, variation):
+        if not self.batched_fill:
+            return super().fill_histograms(variation)
+        weight_variations, shape_variations = self.histogram_variations()
+        filler = BatchedHistFiller(
+            self.cfg.variables, self._categories.keys(), weight_variations + shape_variations
+        )
+        if not self._batched_histograms:
+            self._batched_histograms = filler.empty_histograms()
+        category_masks = {
+            category: ak.to_numpy(self._categories.get_mask(category)) for category in filler.categories
+        }
+        # Weight variations are filled for the nominal shape only, shape
+        # variations with the nominal weights
+        if variation == "nominal":
+            modifiers = {label: None if label == "nominal" else label for label in weight_variations}
+        else:
+            modifiers = {variation: None}
+        weights = {}
+        for category in filler.categories:
+            if not self._isMC:
+                weights[category] = np.ones((len(self.events), len(modifiers)))
+                continue
+            weights[category] = np.stack([
+                ak.to_numpy(self.weights_manager.get_weight(category, modifier))
+                for modifier in modifiers.values()
+            ], axis=1)
+        filler.fill(self._batched_histograms, self.events, category_masks, weights, list(modifiers))
+
+    def save_ntuple(self, weights):
+        '''
+        Appends the saved variables to the per-dataset Parquet ntuples, with
+        the nominal event weight (lumi x XS and the corrections, before the
+        division by the sum of generator weights; 1 for data). With
+        checkpointing they are saved with the chunk and exported at the end.
+        '''
+        variables, self._variables_to_save = self._variables_to_save, None
+        if variables is None:
+            return
+        weight = np.ones(len(variables)) if weights is None else ak.to_numpy(weights)
+        variables = ak.with_field(variables, weight, "weight")
+        if self.checkpoint:
+            self._ntuple_tables.append(to_narrow_table(variables))
+        else:
+            self._ntuple_writer.write(self.events.metadata["dataset"], variables)
+
+    def fill_histograms_extra(self, variation):
+        # The ntuples, bit cutflows and threshold scans are filled once, with
+        # the nominal inclusive weights
+        if variation != "nominal":
+            return
+        weights = self.weights_manager.get_weight() if self._isMC else None
+        self.save_ntuple(weights)
+        # One-pass sequential/N-1 cutflows from the packed cut bits
+        for bitmask in self.bit_cutflows:
+            bits = bitmask.bits(self.events, year=self._year, sample=self._sample, isMC=self._isMC)
+            accumulate_cutflow(self.output, bitmask, self._sample, bitmask.cutflow(bits, weights))
+        for scan in self.scans:
+            cells = scan.fill(self.events, weights, year=self._year, sample=self._sample, isMC=self._isMC)
+            if scan.nominal is not None and scan.category is not None:
+                mask = ak.to_numpy(self._categories.get_mask(scan.category))
+                if weights is not None:
+                    category_yield = float(np.sum(ak.to_numpy(weights)[mask]))
+                else:
+                    category_yield = float(np.sum(mask))
+                accumulate_check(self.output, scan, self._sample, scan.check_nominal(cells, category_yield))
+            accumulate_scan(self.output, scan, self._sample, cells)
+
     def apply_object_preselection(self, variation):
         '''
         
@@ -99,21 +344,22 @@ class CommBTVBaseProcessor(BaseProcessorABC):
         self.events["Z"] = get_dilepton(
             self.events.SoftMuonGood , self.events.MuonGood
         )
+        lep_met = sum_with_met(self.events, "MuonGood")
         self.events["W"] = ak.zip(
                 {
-                    "pt": (self.events.MuonGood + self.events.MET).pt,
-                    "eta": (self.events.MuonGood + self.events.MET).eta,
-                    "phi": (self.events.MuonGood + self.events.MET).phi,
-                    "mass": (self.events.MuonGood + self.events.MET).mass,
+                    "pt": lep_met.pt,
+                    "eta": lep_met.eta,
+                    "phi": lep_met.phi,
+                    "mass": lep_met.mass,
                 },
                 with_name="PtEtaPhiMLorentzVector",
             )
         
-        self.events["hl_ptratio"] = ak.firsts(self.events.MuonGood.pt)/ak.firsts(self.events.JetGood.pt)
-        self.events["soft_l_ptratio"] = ak.firsts(self.events.SoftMuonGood.pt)/ak.firsts(self.events.JetGood.pt)
-        self.events["dr_soft_l_jet"] = ak.firsts(self.events.JetGood).delta_r(ak.firsts(self.events.SoftMuonGood))
-        self.events["dr_l_jet"] = ak.firsts(self.events.JetGood).delta_r(ak.firsts(self.events.MuonGood))
-        self.events["dr_l_soft_l"] = ak.firsts(self.events.MuonGood).delta_r(ak.firsts(self.events.SoftMuonGood))
+        self.events["hl_ptratio"] = leading_ptratio(self.events, "MuonGood", "JetGood")
+        self.events["soft_l_ptratio"] = leading_ptratio(self.events, "SoftMuonGood", "JetGood")
+        self.events["dr_soft_l_jet"] = leading_delta_r(self.events, "JetGood", "SoftMuonGood")
+        self.events["dr_l_jet"] = leading_delta_r(self.events, "JetGood", "MuonGood")
+        self.events["dr_l_soft_l"] = leading_delta_r(self.events, "MuonGood", "SoftMuonGood")
         self.events["Z_pt"] = self.events.Z.pt
         self.events["Z_mass"] = self.events.Z.mass
         self.events["Z_eta"] = self.events.Z.eta
@@ -150,20 +396,7 @@ class CommBTVBaseProcessor(BaseProcessorABC):
         
         self.events["JetGood_pt"] = self.events.JetGood.pt
         # self.events["dilep_deltaR"] = self.events.ll.deltaR
-        with warnings.catch_warnings():
-            # Suppress FutureWarning
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            
-            # Check if the directory exists
-            if not os.path.exists(f"Saved_root_files/{self.events.metadata['dataset']}"):
-                # If not, create it
-                os.system(f"mkdir -p Saved_root_files/{self.events.metadata['dataset']}")
-            
-            df = ak.to_pandas(variables_to_save)    
-            # Write the events to a ROOT file
-            #with uproot.recreate(f"Saved_root_files/{self.events.metadata['dataset']}/{self.events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(self.events.metadata['entrystart'])}_{int(self.events.metadata['entrystop'])}.root") as f: 
-            #    for col in df.columns:
-            #        f[col] = np.array(df[col])
-
-            # Write the events to a Parquet file
-            df.to_parquet(f"Saved_root_files/{self.events.metadata['dataset']}/{self.events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(self.events.metadata['entrystart'])}_{int(self.events.metadata['entrystop'])}_vars.parquet")
+        # Saved with their weight once the weights are computed (nominal
+        # variation only, the other variations would repeat the events)
+        if variation == "nominal":
+            self._variables_to_save = variables_to_save
@@ -0,0 +1,201 @@
+'''
+Column-dependency analysis for the W+c workflow.
+
+The processor of a configuration (object preselection, skim, preselection
+and category cuts, weights and the `variables` histograms) is run on a
+small chunk of one dataset of every sample, data and MC, while NanoEvents
+logs every branch that gets materialized. A branch is only read when some
+events reach the code using it, so a trace chunk left without events after
+the preselection is an error rather than a shorter list; an empty category
+is only warned about, as rare categories are expected to be empty in small
+chunks.
+The union of the branches is written to a JSON report, together with the
+fraction of the file it represents, and `load_events` reads only those
+branches so that anything outside of the set fails loudly instead of being
+fetched silently.
+
+    python ColumnPruning.py config_Wc.py --output pruned_columns.json
+'''
+import importlib.util
+import json
+import os
+import tempfile
+import warnings
+from collections import defaultdict
+from urllib.parse import unquote
+
+import uproot
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+
+
+def load_config(config_path):
+    spec = importlib.util.spec_from_file_location("config", config_path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config.cfg
+
+
+def _branch_name(key):
+    # Log entries may be full source keys, e.g. "<uuid>/Events/Muon_pt%2C%21load"
+    name = unquote(key.split("/")[-1])
+    return name.split(",")[0]
+
+
+def _count(cutflow):
+    # Cutflow entries are per dataset, and per subsample for some categories
+    if isinstance(cutflow, dict):
+        return sum(_count(value) for value in cutflow.values())
+    return cutflow
+
+
+def check_trace(output, dataset):
+    '''
+    Raises if the trace chunk of `dataset` had no events after the
+    preselection, so that the branches used past it were not read; warns
+    about the empty categories.
+    '''
+    cutflow = output["cutflow"]
+    if not _count(cutflow.get("presel", {}).get(dataset, 0)):
+        raise RuntimeError(f"The trace chunk of {dataset} has no events after the preselection: "
+                           f"the branches used there would be dropped, trace more events")
+    empty = [
+        step for step, counts in cutflow.items()
+        if step not in ("initial", "skim", "presel") and not _count(counts.get(dataset, 0))
+    ]
+    if empty:
+        warnings.warn(f"The trace chunk of {dataset} has no events in {', '.join(empty)}: "
+                      f"the branches only used there are missing")
+
+
+def trace_datasets(cfg):
+    '''
+    One dataset per sample and data/MC type, so that the sample-specific
+    code and the weights of the MC are all traced.
+    '''
+    datasets = {}
+    for dataset, fileset in cfg.filesets.items():
+        metadata = fileset["metadata"]
+        datasets.setdefault((metadata.get("sample"), metadata.get("isMC")), dataset)
+    return list(datasets.values())
+
+
+def trace_columns(cfg, dataset=None, filename=None, entry_stop=1000, treepath="Events"):
+    '''
+    Runs the configured processor on the first `entry_stop` events of one
+    file and returns the sorted list of branches it read.
+    '''
+    if dataset is None:
+        dataset = next(iter(cfg.filesets))
+    fileset = cfg.filesets[dataset]
+    if filename is None:
+        filename = fileset["files"][0]
+    metadata = {
+        **fileset["metadata"],
+        "dataset": dataset,
+        "filename": filename,
+        "entrystart": 0,
+        "entrystop": entry_stop,
+    }
+    access_log = []
+    events = NanoEventsFactory.from_root(
+        filename,
+        treepath=treepath,
+        entry_stop=entry_stop,
+        schemaclass=NanoAODSchema,
+        metadata=metadata,
+        access_log=access_log,
+    ).events()
+    processor_instance = cfg.workflow(cfg)
+    # The ntuples of the trace chunk are thrown away
+    with tempfile.TemporaryDirectory() as outdir:
+        processor_instance.ntuple_options["outdir"] = outdir
+        output = processor_instance.process(events)
+    check_trace(output, dataset)
+    return sorted({_branch_name(key) for key in access_log})
+
+
+def trace_all_columns(cfg, datasets=None, entry_stop=1000, treepath="Events"):
+    '''
+    Union of the branches read by the traces of `datasets` (default: one per
+    sample and type); returns it with the traced files.
+    '''
+    columns, traced = set(), {}
+    for dataset in datasets or trace_datasets(cfg):
+        filename = cfg.filesets[dataset]["files"][0]
+        columns.update(trace_columns(cfg, dataset, filename, entry_stop, treepath))
+        traced[dataset] = filename
+    return sorted(columns), traced
+
+
+def pruning_report(columns, filename, treepath="Events"):
+    with uproot.open(filename) as f:
+        tree = f[treepath]
+        branches = {branch.name: branch for branch in tree.branches}
+    missing = [c for c in columns if c not in branches]
+    total_bytes = sum(b.compressed_bytes for b in branches.values())
+    kept_bytes = sum(branches[c].compressed_bytes for c in columns if c in branches)
+    by_collection = defaultdict(list)
+    for column in columns:
+        by_collection[column.split("_")[0]].append(column)
+    return {
+        "file": filename,
+        "columns": list(columns),
+        "by_collection": dict(by_collection),
+        "missing": missing,
+        "n_columns": len(columns),
+        "n_branches": len(branches),
+        "kept_bytes": kept_bytes,
+        "total_bytes": total_bytes,
+        "kept_fraction": kept_bytes / total_bytes if total_bytes else 0.,
+    }
+
+
+def save_columns(report, path="pruned_columns.json"):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_columns(path="pruned_columns.json"):
+    with open(path) as f:
+        return json.load(f)["columns"]
+
+
+def load_events(filename, columns, entry_start=None, entry_stop=None,
+                treepath="Events", metadata=None):
+    '''
+    Builds NanoEvents that only know about the pruned branches.
+    '''
+    return NanoEventsFactory.from_root(
+        filename,
+        treepath=treepath,
+        entry_start=entry_start,
+        entry_stop=entry_stop,
+        schemaclass=NanoAODSchema,
+        metadata=metadata,
+        iteritems_options={"filter_name": list(columns)},
+    ).events()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Derive the minimal NanoAOD branch set of a configuration")
+    parser.add_argument("config", help="Configuration file defining `cfg`")
+    parser.add_argument("--dataset", nargs="+", default=None,
+                        help="Datasets used for the trace (default: one per sample, data and MC)")
+    parser.add_argument("--nevents", type=int, default=1000)
+    parser.add_argument("-o", "--output", default="pruned_columns.json")
+    args = parser.parse_args()
+
+    cfg = load_config(os.path.abspath(args.config))
+    columns, traced = trace_all_columns(cfg, args.dataset, entry_stop=args.nevents)
+    report = pruning_report(columns, next(iter(traced.values())))
+    report["traced"] = traced
+    save_columns(report, args.output)
+    print(f"Traced {', '.join(traced)}")
+    print(f"Kept {report['n_columns']}/{report['n_branches']} branches, "
+          f"{100 * report['kept_fraction']:.1f}% of the compressed bytes")
+    for collection, names in sorted(report["by_collection"].items()):
+        print(f"  {collection}: {', '.join(names)}")
+    if report["missing"]:
+        print(f"  not in file: {', '.join(report['missing'])}")
@@ -1,7 +1,39 @@
 import awkward as ak
 import numpy as np
 from pocket_coffea.lib.cut_definition import Cut
+from pocket_coffea.lib.hist_manager import Axis
+
+from ChunkCache import chunk_cache, leading, leading_ptratio, leading_sum
+from Instrumentation import instrumented_cut
+import FastKernels
+from CutChain import CutChain
+from CutBits import CutBitmask
+from CutScan import CutScan, ScanParameter
+
+# Continuous variables behind the W+c cuts, shared with the threshold scans
+
+def mtw_value(events):
+    muon = leading(events, "MuonGood")
+    return chunk_cache.get(
+        events, ("mtw",),
+        lambda: np.sqrt(2 * muon.pt * events.MET.pt * (1 - np.cos(muon.delta_phi(events.MET))))
+    )
+
+def dilep_mass_value(events):
+    return leading_sum(events, "MuonGood", "SoftMuonGood").mass
+
+def soft_muon_jet_ptratio_value(events):
+    return leading_ptratio(events, "SoftMuonGood", "JetGood")
 
+def muon_jet_min_ef_value(events):
+    # Smallest muEF + neEmEF among the jets matched to a muon, None without any
+    def build():
+        jets = events.JetGood
+        matched = (jets.muonIdx1 != -1) | (jets.muonIdx2 != -1)
+        return ak.min((jets.muEF + jets.neEmEF)[matched], axis=1)
+    return chunk_cache.get(events, ("muon_jet_min_ef",), build)
+
+@instrumented_cut
 def diLepton(events, params, year, sample, **kwargs):
 
     # Masks for same-flavor (SF) and opposite-sign (OS)
@@ -20,18 +52,22 @@ def diLepton(events, params, year, sample, **kwargs):
     # Pad None values with False
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def TwoMuons(events, **kwargs):
     mask = (events.nMuonGood >= 2)
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def TwoElectrons(events, **kwargs):
     mask = (events.nElectronGood >= 2)
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def TwoJets(events, **kwargs):
     mask = (events.nJetGood >= 2)
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def TwoLepTwoJets(events, params, **kwargs):
     mask = ( (events.nJetGood >= 2)
              & ( ( (params["lep_flav"]=="mu") & (events.nMuonGood>=2) ) |
@@ -44,6 +80,7 @@ def TwoLepTwoJets(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def OneLeptonPlusMet(events, params, **kwargs):
     #mask = (events.nLeptonGood == 1 )
     mask = ( (events.nLeptonGood == 1 )
@@ -52,6 +89,7 @@ def OneLeptonPlusMet(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def LepMetTwoJets(events, params, **kwargs):
     mask = ( (events.nLeptonGood == 1 )
              & (ak.firsts(events.LeptonGood.pt) > params["pt_lep"])
@@ -60,6 +98,7 @@ def LepMetTwoJets(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def MetTwoJetsNoLep(events, params, **kwargs):    
     mask = ( (events.nLeptonGood == 0 )
              & (events.MET.pt > params["pt_met"])
@@ -69,6 +108,7 @@ def MetTwoJetsNoLep(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def WLNuTwoJets(events, params, **kwargs):
 
     fields = {
@@ -90,6 +130,7 @@ def WLNuTwoJets(events, params, **kwargs):
         )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def ctag(events, params, **kwargs):
     #print(events.JetsCvsL.btagDeepFlavCvL[:, 0]>0.2)
     mask = (events.JetsCvsL.btagDeepFlavCvL[:,0]>0.2)
@@ -98,6 +139,7 @@ def ctag(events, params, **kwargs):
 def CvsLsorted(jets, ctag):
     return jets[ak.argsort(jets[ctag["tagger"]], axis=1, ascending=False)]
 
+@instrumented_cut
 def DiJetPtCut(events, params, **kwargs):
     mask = (  (events.nJetGood >= 2)
               & (events.dijet.pt > params["pt_dijet"])
@@ -105,79 +147,96 @@ def DiJetPtCut(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def DeltaPhiJetMetCut(events, params, **kwargs):
     mask = ( (events['deltaPhi_jet1_MET'] > params["jet_met_dphi_cut"])
              & (events['deltaPhi_jet2_MET'] > params["jet_met_dphi_cut"])
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def MuonSelBTV(events, params, **kwargs):
+    if FastKernels.enabled():
+        return FastKernels.muon_jet_selection(events, params["ef_max"])
     mask = ak.num(events.JetGood[( ((events.JetGood.muonIdx1 != -1) | (events.JetGood.muonIdx2 != -1))
-                & ((events.JetGood.muEF + events.JetGood.neEmEF) < 0.7)
+                & ((events.JetGood.muEF + events.JetGood.neEmEF) < params["ef_max"])
             )].pt, axis=1) >= 1
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def JetSelBTV(events, params, **kwargs):
     mask = (ak.num(events.JetGood.pt) >= 1) & (ak.num(events.JetGood.pt) <= 3)
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def reqmu(events, params, **kwargs):
     mask = ak.count(events.MuonGood.pt, axis=1) == 1
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def reqsoftmu(events, params, **kwargs):
     mask = ak.count(events.SoftMuonGood.pt, axis=1) >= 1
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def JetMuPtratio(events, params, **kwargs):
-    first_muon_pt = ak.firsts(events.SoftMuonGood.pt)
-    first_jet_pt = ak.firsts(events.JetGood.pt)
-    mask = (first_muon_pt / first_jet_pt) < 0.4
+    mask = leading_ptratio(events, "SoftMuonGood", "JetGood") < params["ptratio_max"]
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def QCDVetoratio(events, params, **kwargs):
-    first_muon_pt = ak.firsts(events.MuonGood.pt)
-    first_jet_pt = ak.firsts(events.JetGood.pt)
-    
-    mask = (  (first_muon_pt / first_jet_pt > 0.75))
+    mask = (  (leading_ptratio(events, "MuonGood", "JetGood") > 0.75))
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def QCDVeto(events, params, **kwargs):
     mask = (  (events.MuonGood.pfRelIso04_all < 0.05) 
            & (abs(events.MuonGood.dz) < 0.01) & (abs(events.MuonGood.dxy) < 0.002) & (events.MuonGood.sip3d < 2))
     print(mask)
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def dimuonBTV(events, params, **kwargs):
     mask = ( (events.MuonGood.pt > 12) 
             & (abs(events.MuonGood.eta) < 2.4) & (events.MuonGood.tightId > 0.5) & (events.MuonGood.pfRelIso04_all <= 0.15))
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def dieleBTV(events, params, **kwargs):
     mask = ( (events.ElectronGood.pt > 12) 
             & (abs(events.ElectronGood.eta) < 1.4442) | ((events.ElectronGood.eta < 2.5) & (events.ElectronGood.eta > 1.566)) & (events.ElectronGood.mvaFall17V2Iso_WP80 > 0.5))
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def dilepveto(events, params, **kwargs):
+    if FastKernels.enabled():
+        return FastKernels.dilepton_veto(events)
     mask = ak.count( events.Electron[(events.ElectronGood.pt > 12) 
             & (abs(events.ElectronGood.eta) < 1.4442) | ((events.ElectronGood.eta < 2.5) & (events.ElectronGood.eta > 1.566)) & 
             (events.ElectronGood.mvaFall17V2Iso_WP80 > 0.5)].pt, axis = 1) + ak.count( events.MuonGood[(events.MuonGood.pt > 12) 
             & (abs(events.MuonGood.eta) < 2.4) & (events.MuonGood.tightId > 0.5) & (events.MuonGood.pfRelIso04_all <= 0.15)].pt, axis = 1) != 2
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def dilepmass(events, params, **kwargs):
-    mask = ((ak.firsts(events.MuonGood) + ak.firsts(events.SoftMuonGood)).mass > 12) & (((ak.firsts(events.MuonGood) + ak.firsts(events.SoftMuonGood)).mass < 80) | ((ak.firsts(events.MuonGood) + ak.firsts(events.SoftMuonGood)).mass > 100))
+    if FastKernels.enabled():
+        return FastKernels.dilepton_mass_cut(events, params["mll_min"], params["mz_low"], params["mz_high"])
+    mass = dilep_mass_value(events)
+    mask = (mass > params["mll_min"]) & ((mass < params["mz_low"]) | (mass > params["mz_high"]))
     return ak.where(ak.is_none(mask), False, mask)
 
+@instrumented_cut
 def mtw(events, params, **kwargs):
-    mask = (np.sqrt(2 * ak.firsts(events.MuonGood).pt * events.MET.pt * (1 - np.cos(ak.firsts(events.MuonGood).delta_phi(events.MET)))) > 55)
+    if FastKernels.enabled():
+        return FastKernels.transverse_mass_cut(events, params["mtw_min"])
+    mask = mtw_value(events) > params["mtw_min"]
     return ak.where(ak.is_none(mask), False, mask)        
 
 
 mujetselbtv = Cut(
     name = 'mujetselbtv',
     function=MuonSelBTV,
-    params=None
+    params={"ef_max": 0.7}
 )
 
 jetselbtv = Cut(
@@ -201,7 +260,7 @@ reqsoftmuon = Cut(
 ptratiobtv = Cut(
     name = 'ptratiobtv',
     function=JetMuPtratio,
-    params=None
+    params={"ptratio_max": 0.4}
 )
 
 qcdveto = Cut(
@@ -236,13 +295,20 @@ req_dilepveto = Cut(
 req_dilepmass = Cut(
     name = 'req_dilepmass',
     function=dilepmass,
-    params=None
+    params={"mll_min": 12, "mz_low": 80, "mz_high": 100}
+)
+
+# The 80-100 GeV Z window of req_dilepmass alone, without the lower mll bound
+req_zveto = Cut(
+    name = 'req_zveto',
+    function=dilepmass,
+    params={"mll_min": -np.inf, "mz_low": 80, "mz_high": 100}
 )
 
 req_mtw = Cut(
     name = 'req_mtw',
     function=mtw,
-    params=None
+    params={"mtw_min": 55}
 )
 
 
@@ -366,3 +432,39 @@ ee_2j = Cut(
             "mll": {'low': 70, 'high': 120}
         }
 )
+
+# The W+c selection, evaluated cut after cut on the surviving events only
+added_cuts_wc = CutChain(
+    name='added_cuts_wc',
+    cuts=[req_mtw, ptratiobtv, req_dilepveto, mujetselbtv, reqmuon, jetselbtv, reqsoftmuon, req_dilepmass],
+).as_cut()
+
+# The same cuts packed as bits, for N-1 categories and one-pass cutflows
+wc_bits = CutBitmask(
+    name='wc',
+    cuts=[req_mtw, ptratiobtv, req_dilepveto, mujetselbtv, reqmuon, jetselbtv, reqsoftmuon, req_dilepmass],
+)
+
+# Grid of W+c thresholds, filled in a single pass when the scan is enabled
+wc_threshold_scan = CutScan(
+    name='wc_thresholds',
+    parameters=[
+        ScanParameter("mtw_min", mtw_value, ">", [40, 45, 50, 55, 60, 65, 70]),
+        ScanParameter("ptratio_max", soft_muon_jet_ptratio_value, "<", [0.2, 0.3, 0.4, 0.5, 0.6]),
+        ScanParameter("ef_max", muon_jet_min_ef_value, "<", [0.5, 0.6, 0.7, 0.8, 0.9]),
+        ScanParameter("mll_min", dilep_mass_value, ">", [8, 10, 12, 15, 20]),
+    ],
+    base_cuts=[req_dilepveto, reqmuon, jetselbtv, reqsoftmuon, req_zveto],
+    # The thresholds of "Added cuts Wc": its yield is checked against this cell
+    nominal={
+        "mtw_min": req_mtw.params["mtw_min"],
+        "ptratio_max": ptratiobtv.params["ptratio_max"],
+        "ef_max": mujetselbtv.params["ef_max"],
+        "mll_min": req_dilepmass.params["mll_min"],
+    },
+    category="Added cuts Wc",
+    histograms={
+        "W_mass": Axis(field="W_mass", bins=30, start=0, stop=150, label=r"$m_{l\nu}"),
+        "Z_mass": Axis(field="Z_mass", bins=30, start=0, stop=150, label=r"$m_{ll}"),
+    },
+)
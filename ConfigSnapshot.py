@@ -0,0 +1,243 @@
+'''
+Frozen, pre-resolved configuration for fast worker startup.
+
+Importing a config file imports pocket_coffea and the cut and histogram
+libraries, merges the parameter files, filters the dataset JSONs and builds
+the processor. `freeze` does all of that once and writes a versioned
+snapshot holding the merged parameters, the filtered filesets and the
+processor (with its Configurator, cuts and workflow) pickled by cloudpickle.
+Loading a snapshot reads the parameters and filesets only; the processor is
+unpickled, and the modules it needs imported, on first use. The pickled
+processor is also the payload shipped as is to every worker, so it is
+serialized once per configuration rather than once per job.
+
+    python ConfigSnapshot.py config_Wc.py -o config_Wc.snapshot
+    python LocalRunner.py config_Wc.snapshot --workers 8
+
+The snapshot records the hash of every source it was resolved from: the
+modules of the configuration directory, shipped by value, and every file
+read while the configuration was loaded (parameter YAMLs, dataset JSONs,
+column lists). A snapshot built with another snapshot version, or whose
+sources changed since, is refused; one built with other versions of the
+packages is loaded with a warning.
+'''
+import hashlib
+import os
+import pickle
+import site
+import sys
+import time
+import warnings
+
+SNAPSHOT_VERSION = 2
+PACKAGES = ("coffea", "pocket_coffea", "awkward", "numpy", "uproot", "cloudpickle")
+
+_opened = None
+_hook_installed = False
+
+
+def _record_open(event, args):
+    if event != "open" or _opened is None:
+        return
+    path = args[0]
+    if isinstance(path, (str, bytes, os.PathLike)):
+        _opened.add(os.path.abspath(os.fsdecode(path)))
+
+
+def _installed(path):
+    # Files of the interpreter and of the installed packages
+    prefixes = {sys.prefix, sys.base_prefix, sys.exec_prefix, *site.getsitepackages(), site.getusersitepackages()}
+    prefixes.update(("/proc", "/sys", "/dev"))
+    return any(path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep) for prefix in prefixes)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_hashes(config_path, opened=()):
+    '''
+    Hashes of the modules of the configuration directory and of the files
+    in `opened`, outside of the installed packages.
+    '''
+    directory = os.path.dirname(os.path.abspath(config_path))
+    sources = {os.path.abspath(config_path), *opened}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.endswith(".py") and os.path.dirname(os.path.abspath(path)) == directory:
+            sources.add(os.path.abspath(path))
+    return {
+        path: file_hash(path) for path in sorted(sources)
+        if os.path.isfile(path) and not _installed(path)
+    }
+
+
+def package_versions():
+    from importlib.metadata import PackageNotFoundError, version
+
+    versions = {}
+    for package in PACKAGES:
+        try:
+            versions[package] = version(package.replace("_", "-"))
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def freeze(config_path, output):
+    '''
+    Resolves the configuration of `config_path` and writes its snapshot to
+    `output`; returns the snapshot with the time the resolution took.
+    '''
+    global _opened, _hook_installed
+    import cloudpickle
+    from omegaconf import OmegaConf
+
+    from ColumnPruning import load_config
+    from ResultStore import config_hash
+
+    if not _hook_installed:
+        sys.addaudithook(_record_open)
+        _hook_installed = True
+    start = time.perf_counter()
+    # Every file read while resolving the configuration is one of its sources
+    _opened = set()
+    try:
+        cfg = load_config(os.path.abspath(config_path))
+        processor_instance = cfg.workflow(cfg)
+    finally:
+        opened, _opened = _opened, None
+    resolve_seconds = time.perf_counter() - start
+    snapshot = ConfigSnapshot({
+        "version": SNAPSHOT_VERSION,
+        "config_path": os.path.abspath(config_path),
+        "config_hash": config_hash(config_path, cfg.parameters),
+        "sources": source_hashes(config_path, opened),
+        "packages": package_versions(),
+        "created": time.time(),
+        "parameters": OmegaConf.to_container(cfg.parameters, resolve=True),
+        "filesets": cfg.filesets,
+        "payload": cloudpickle.dumps(processor_instance),
+    })
+    snapshot.save(output)
+    return snapshot, resolve_seconds
+
+
+class ConfigSnapshot:
+    def __init__(self, content):
+        self.content = content
+        self._processor = None
+
+    @classmethod
+    def load(cls, path, strict=True):
+        with open(path, "rb") as f:
+            content = pickle.load(f)
+        if content.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot {path} has version {content.get('version')}, "
+                             f"expected {SNAPSHOT_VERSION}: freeze the configuration again")
+        snapshot = cls(content)
+        changed = snapshot.check()
+        if changed:
+            message = f"Snapshot {path} is stale, {', '.join(changed)} changed: freeze the configuration again"
+            if strict:
+                raise ValueError(message)
+            warnings.warn(message)
+        return snapshot
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self.content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def changed_sources(self):
+        changed = []
+        for path, digest in self.content["sources"].items():
+            if not os.path.isfile(path) or file_hash(path) != digest:
+                changed.append(path)
+        return changed
+
+    def check(self):
+        '''
+        Warns about changed package versions; returns the changed sources.
+        '''
+        current = package_versions()
+        changed = {
+            package: (frozen, current.get(package))
+            for package, frozen in self.content["packages"].items()
+            if frozen != current.get(package)
+        }
+        if changed:
+            warnings.warn(f"Snapshot frozen with other package versions (frozen, current): {changed}")
+        return self.changed_sources()
+
+    @property
+    def config_hash(self):
+        return self.content["config_hash"]
+
+    @property
+    def parameters(self):
+        return self.content["parameters"]
+
+    @property
+    def filesets(self):
+        return self.content["filesets"]
+
+    @property
+    def payload(self):
+        return self.content["payload"]
+
+    def processor(self):
+        if self._processor is None:
+            import cloudpickle
+
+            self._processor = cloudpickle.loads(self.payload)
+        return self._processor
+
+
+def startup_seconds(code, repeat=3):
+    '''
+    Best wall time of running `code` in a fresh interpreter, as a worker would.
+    '''
+    import subprocess
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Freeze a configuration into a snapshot")
+    parser.add_argument("config", help="Configuration file defining `cfg`")
+    parser.add_argument("-o", "--output", help="Snapshot path (default: <config>.snapshot)")
+    parser.add_argument("--compare", action="store_true",
+                        help="Time a worker startup from the config and from the snapshot")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.config)[0] + ".snapshot"
+    snapshot, resolve_seconds = freeze(args.config, output)
+    nfiles = sum(len(fileset["files"]) for fileset in snapshot.filesets.values())
+    print(f"Snapshot {output} ({snapshot.config_hash}): {len(snapshot.filesets)} datasets, {nfiles} files")
+    print(f"{len(snapshot.content['sources'])} source files")
+    print(f"Resolved in {resolve_seconds:.2f} s, snapshot {os.path.getsize(output) / 2**10:.0f} kB, "
+          f"worker payload {len(snapshot.payload) / 2**10:.0f} kB")
+    if args.compare:
+        from_config = startup_seconds(
+            "from ColumnPruning import load_config; import cloudpickle; "
+            f"cfg = load_config({os.path.abspath(args.config)!r}); cloudpickle.dumps(cfg.workflow(cfg))"
+        )
+        from_snapshot = startup_seconds(
+            f"from ConfigSnapshot import ConfigSnapshot; ConfigSnapshot.load({os.path.abspath(output)!r}).processor()"
+        )
+        print(f"Worker startup: {from_config:.2f} s from the config, {from_snapshot:.2f} s from the snapshot")
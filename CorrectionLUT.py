@@ -0,0 +1,273 @@
+'''
+Per-worker dense lookup tables for the pileup and muon ID/ISO corrections.
+
+Each correctionlib correction is read once per worker and evaluated on the
+midpoints of its bins for every systematic, giving a dense array indexed by
+(bin of each real input, systematic). The weight of a chunk is then one
+`searchsorted` per input and one gather returning nominal, up and down
+together. Tables are kept in an LRU over (file, correction, fixed inputs),
+i.e. over campaigns and years, which lives in the worker process (see
+WorkerState.py) and so is shared by all the chunks the worker processes.
+
+Values beyond the outermost bin edges follow the flow of the correction:
+with "clamp" everywhere they take the first/last bin, otherwise ("error" or
+a default value) they are evaluated with correctionlib, so the tables agree
+with correctionlib everywhere.
+
+Corrections containing formulas are not piecewise constant in their bins:
+they are evaluated with correctionlib directly (still loaded only once).
+
+In the configuration the weights are replaced by custom weights with the
+same names:
+
+    weights = {"common": {"inclusive": [..., *correction_weights(parameters)]}}
+'''
+import gzip
+import json
+from collections import OrderedDict
+
+import awkward as ak
+import numpy as np
+
+from WorkerState import worker_state
+
+VARIATIONS = {
+    "pileup": ("nominal", "up", "down"),
+    "muon": ("sf", "systup", "systdown"),
+}
+
+
+class NotDensifiable(Exception):
+    pass
+
+
+def _read_json(path):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt") as f:
+        return json.load(f)
+
+
+def _binning_edges(edges):
+    if isinstance(edges, dict):
+        return np.linspace(edges["low"], edges["high"], edges["n"] + 1)
+    return np.asarray(edges, dtype=np.float64)
+
+
+def collect_edges(node, edges=None, flows=None):
+    '''
+    Union of the bin edges used for each real input anywhere in the
+    correction tree; the flows of the binnings are added to `flows`.
+    '''
+    edges = {} if edges is None else edges
+    if not isinstance(node, dict):
+        return edges
+    if node.get("nodetype") in ("binning", "multibinning") and flows is not None:
+        flow = node.get("flow", "error")
+        flows.add(flow if flow in ("clamp", "error") else "default")
+    nodetype = node.get("nodetype")
+    if nodetype == "formula" or nodetype == "formularef":
+        raise NotDensifiable("formula node")
+    if nodetype == "binning":
+        edges.setdefault(node["input"], set()).update(_binning_edges(node["edges"]).tolist())
+        content = node["content"]
+    elif nodetype == "multibinning":
+        for name, input_edges in zip(node["inputs"], node["edges"]):
+            edges.setdefault(name, set()).update(_binning_edges(input_edges).tolist())
+        content = node["content"]
+    elif nodetype == "category":
+        content = [item["value"] for item in node["content"]]
+    elif nodetype == "transform":
+        raise NotDensifiable("transform node")
+    else:
+        content = []
+    for child in content:
+        collect_edges(child, edges, flows)
+    if isinstance(node.get("default"), dict):
+        collect_edges(node["default"], edges, flows)
+    if isinstance(node.get("flow"), dict):
+        collect_edges(node["flow"], edges, flows)
+    return edges
+
+
+class DenseCorrection:
+    '''
+    Table of a correction for fixed string/int inputs, over the bins of its
+    real inputs and the values of its systematic input. Unless every binning
+    clamps, the values outside the table are evaluated with correctionlib.
+    '''
+    def __init__(self, evaluator, correction_json, fixed, variations):
+        self.name = evaluator.name
+        self.variations = tuple(variations)
+        inputs = [i.name for i in evaluator.inputs]
+        self.variation_input = next(
+            i.name for i in evaluator.inputs if i.type == "string" and i.name not in fixed
+        )
+        self.real_inputs = [i.name for i in evaluator.inputs if i.name not in fixed and i.name != self.variation_input]
+        flows = set()
+        edges = collect_edges(correction_json["data"], flows=flows)
+        self.clamp = flows <= {"clamp"}
+        self.direct = None if self.clamp else DirectCorrection(evaluator, fixed, variations)
+        self.edges = [np.array(sorted(edges[name])) for name in self.real_inputs]
+        midpoints = [0.5 * (e[1:] + e[:-1]) for e in self.edges]
+        grid = np.meshgrid(*midpoints, indexing="ij")
+        table = []
+        for variation in self.variations:
+            values = {**fixed, self.variation_input: variation}
+            values.update({name: g.ravel() for name, g in zip(self.real_inputs, grid)})
+            table.append(evaluator.evaluate(*[values[name] for name in inputs]).reshape(grid[0].shape))
+        self.table = np.stack(table, axis=-1).astype(np.float64)
+
+    def __call__(self, *values):
+        values = [np.asarray(v, dtype=np.float64) for v in values]
+        index = tuple(
+            np.clip(np.searchsorted(e, v, side="right") - 1, 0, len(e) - 2)
+            for e, v in zip(self.edges, values)
+        )
+        result = self.table[index]
+        if self.direct is not None:
+            outside = np.zeros(result.shape[:-1], dtype=bool)
+            for e, v in zip(self.edges, values):
+                outside |= (v < e[0]) | (v >= e[-1])
+            if outside.any():
+                # Raises like correctionlib for the "error" flow
+                result[outside] = self.direct(*[v[outside] for v in values])
+        return result
+
+
+class DirectCorrection:
+    '''
+    Fallback with the same interface evaluating the correction itself.
+    '''
+    def __init__(self, evaluator, fixed, variations):
+        self.evaluator = evaluator
+        self.fixed = fixed
+        self.variations = tuple(variations)
+        self.variation_input = next(
+            i.name for i in evaluator.inputs if i.type == "string" and i.name not in fixed
+        )
+        self.real_inputs = [i.name for i in evaluator.inputs if i.name not in fixed and i.name != self.variation_input]
+
+    def __call__(self, *values):
+        inputs = dict(zip(self.real_inputs, values), **self.fixed)
+        return np.stack([
+            self.evaluator.evaluate(*[
+                variation if i.name == self.variation_input else inputs[i.name] for i in self.evaluator.inputs
+            ])
+            for variation in self.variations
+        ], axis=-1)
+
+
+class CorrectionService:
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+
+    def get(self, path, name, fixed=None, variations=VARIATIONS["muon"]):
+        fixed = dict(fixed or {})
+        key = (str(path), name, tuple(sorted(fixed.items())), tuple(variations))
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        import correctionlib
+
+        evaluator = correctionlib.CorrectionSet.from_file(str(path))[name]
+        correction_json = next(c for c in _read_json(path)["corrections"] if c["name"] == name)
+        try:
+            table = DenseCorrection(evaluator, correction_json, fixed, variations)
+        except NotDensifiable:
+            table = DirectCorrection(evaluator, fixed, variations)
+        self._tables[key] = table
+        while len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return table
+
+    def clear(self):
+        self._tables.clear()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __getstate__(self):
+        # Every worker builds its own tables
+        return {"maxsize": self.maxsize, "_tables": OrderedDict()}
+
+
+def correction_service():
+    '''
+    The service of this worker process, kept across chunks.
+    '''
+    return worker_state("CorrectionLUT.correction_service", CorrectionService)
+
+
+def pileup_weights(params, events, year):
+    conf = params.pileupJSONfiles[year]
+    table = correction_service().get(conf["file"], conf["name"], variations=VARIATIONS["pileup"])
+    return table(ak.to_numpy(events.Pileup.nTrueInt))
+
+
+def muon_sf_weights(params, events, year, key):
+    muon_sf = params.lepton_scale_factors.muon_sf
+    files = muon_sf.JSONfiles[year]
+    table = correction_service().get(
+        files["file"], muon_sf.sf_name[year][key], fixed={"year": files["year"]}, variations=VARIATIONS["muon"]
+    )
+    muons = events.MuonGood
+    counts = ak.to_numpy(ak.num(muons, axis=1))
+    sf = table(np.abs(ak.to_numpy(ak.flatten(muons.eta))), ak.to_numpy(ak.flatten(muons.pt)))
+    # Product over the muons of each event, for nominal/up/down at once
+    weights = np.ones((len(counts), sf.shape[-1]))
+    np.multiply.at(weights, np.repeat(np.arange(len(counts)), counts), sf)
+    return weights
+
+
+def correction_weights(params):
+    '''
+    Custom weights replacing the pileup, sf_mu_id and sf_mu_iso weights.
+    '''
+    from pocket_coffea.lib.weights_manager import WeightCustom
+
+    def pileup(events, size, metadata, shape_variation=None, **kwargs):
+        w = pileup_weights(params, events, metadata["year"])
+        return [("pileup", w[:, 0], w[:, 1], w[:, 2])]
+
+    def muon_sf(key):
+        def function(events, size, metadata, shape_variation=None, **kwargs):
+            w = muon_sf_weights(params, events, metadata["year"], key)
+            return [(f"sf_mu_{key}", w[:, 0], w[:, 1], w[:, 2])]
+        return function
+
+    return [
+        WeightCustom(name="pileup", function=pileup),
+        WeightCustom(name="sf_mu_id", function=muon_sf("id")),
+        WeightCustom(name="sf_mu_iso", function=muon_sf("iso")),
+    ]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Compare a dense correction table with correctionlib")
+    parser.add_argument("file", help="correctionlib JSON file")
+    parser.add_argument("name", help="Correction name")
+    parser.add_argument("--fixed", nargs="*", default=[], help="Fixed inputs, e.g. year=2017_UL")
+    parser.add_argument("--variations", nargs="+", default=list(VARIATIONS["muon"]))
+    parser.add_argument("--nvalues", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    import correctionlib
+
+    fixed = dict(f.split("=", 1) for f in args.fixed)
+    table = correction_service().get(args.file, args.name, fixed, args.variations)
+    evaluator = correctionlib.CorrectionSet.from_file(args.file)[args.name]
+    rng = np.random.default_rng(0)
+    edges = getattr(table, "edges", None) or [np.array([0., 100.])] * len(table.real_inputs)
+    values = [rng.uniform(e[0], e[-1], args.nvalues) for e in edges]
+    start = time.perf_counter()
+    dense = table(*values)
+    print(f"{type(table).__name__}: {args.nvalues / (time.perf_counter() - start):.0f} values/s")
+    reference = DirectCorrection(evaluator, fixed, args.variations)
+    start = time.perf_counter()
+    direct = reference(*values)
+    print(f"correctionlib: {args.nvalues / (time.perf_counter() - start):.0f} values/s")
+    print(f"max abs difference: {np.max(np.abs(dense - direct)):.3g}")
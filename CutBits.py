@@ -0,0 +1,111 @@
+'''
+Compact bitmask representation of a set of cuts.
+
+Every cut of a `CutBitmask` is evaluated once per chunk and stored as one
+bit of a packed unsigned integer per event (cached in the per-chunk cache).
+Any combination of the cuts, the N-1 selections and the sequential cutflow
+are then derived from those bits with bitwise operations in a single pass,
+without evaluating the cuts again.
+
+In the configuration, all the N-1 variants of a category are one entry:
+
+    categories = {**wc_bits.nminus1_categories("Wc")}
+'''
+import awkward as ak
+import numpy as np
+
+from ChunkCache import chunk_cache
+
+
+def _packed_dtype(nbits):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if nbits <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"At most 64 cuts can be packed, got {nbits}")
+
+
+class CutBitmask:
+    def __init__(self, name, cuts):
+        self.name = name
+        self.cuts = list(cuts)
+        self.dtype = _packed_dtype(len(self.cuts))
+        self.bit = {cut.name: self.dtype(1) << self.dtype(i) for i, cut in enumerate(self.cuts)}
+        self.all_bits = self.required()
+
+    def _evaluate(self, events, **kwargs):
+        bits = np.zeros(len(events), dtype=self.dtype)
+        for cut in self.cuts:
+            mask = cut.get_mask(events, **kwargs)
+            mask = np.asarray(ak.to_numpy(ak.fill_none(mask, False)), dtype=bool)
+            bits |= mask.astype(self.dtype) * self.bit[cut.name]
+        return bits
+
+    def bits(self, events, **kwargs):
+        return chunk_cache.get(events, ("cutbits", self.name), lambda: self._evaluate(events, **kwargs))
+
+    def required(self, names=None, exclude=()):
+        names = [cut.name for cut in self.cuts] if names is None else names
+        required = self.dtype(0)
+        for name in names:
+            if name not in exclude:
+                required |= self.bit[name]
+        return required
+
+    @staticmethod
+    def passing(bits, required):
+        return (bits & required) == required
+
+    def category_cut(self, name, exclude=()):
+        from pocket_coffea.lib.cut_definition import Cut
+
+        required = self.required(exclude=exclude)
+
+        def function(events, params=None, **kwargs):
+            return self.passing(self.bits(events, **kwargs), required)
+        function.__name__ = name
+        return Cut(name=name, function=function, params=None)
+
+    def nminus1_categories(self, prefix):
+        '''
+        The category with all the cuts plus one category per cut with all
+        the other cuts applied.
+        '''
+        categories = {prefix: [self.category_cut(f"{self.name}_all")]}
+        for cut in self.cuts:
+            categories[f"{prefix} N-1 {cut.name}"] = [
+                self.category_cut(f"{self.name}_nminus1_{cut.name}", exclude=(cut.name,))
+            ]
+        return categories
+
+    def cutflow(self, bits, weights=None):
+        '''
+        Sequential, N-1 and single-cut event counts (or sums of weights).
+        '''
+        weights = np.ones(len(bits)) if weights is None else np.asarray(weights, dtype=np.float64)
+        names = [cut.name for cut in self.cuts]
+        sequential = [float(weights.sum())]
+        required = self.dtype(0)
+        for name in names:
+            required |= self.bit[name]
+            sequential.append(float(weights[self.passing(bits, required)].sum()))
+        return {
+            "cuts": names,
+            "sequential": np.array(sequential),
+            "nminus1": np.array([
+                float(weights[self.passing(bits, self.required(exclude=(name,)))].sum()) for name in names
+            ]),
+            "single": np.array([
+                float(weights[self.passing(bits, self.bit[name])].sum()) for name in names
+            ]),
+        }
+
+
+def accumulate_cutflow(output, bitmask, sample, cutflow):
+    # Arrays add up across chunks in coffea's accumulate; the cut names do not
+    counts = {key: value for key, value in cutflow.items() if key != "cuts"}
+    target = output.setdefault("bit_cutflow", {}).setdefault(bitmask.name, {})
+    if sample in target:
+        for key, value in counts.items():
+            target[sample][key] = target[sample][key] + value
+    else:
+        target[sample] = counts
@@ -0,0 +1,114 @@
+'''
+Short-circuit evaluation of a chain of cuts.
+
+Instead of evaluating every cut on the full chunk and ANDing the masks,
+`CutChain` evaluates the cuts one after the other on the events still
+passing, and scatters the surviving indices back into a full-length mask.
+After `warmup_chunks` chunks the cuts are reordered using the statistics
+measured so far (time per evaluated event and fraction of events passing),
+so that cheap cuts rejecting many events run first. The result does not
+depend on the order. Only the final mask is kept in the per-chunk cache:
+what the cuts cached for the intermediate slices of the events is dropped
+with the slices.
+
+The chain is unpickled again for every chunk, so the statistics and the
+chunk count are kept per worker process (see WorkerState.py), under the name
+of the chain: the reordering starts after the worker has processed
+`warmup_chunks` chunks.
+
+    added_cuts_wc = CutChain("added_cuts_wc", [req_mtw, ptratiobtv, ...]).as_cut()
+'''
+import time
+
+import awkward as ak
+import numpy as np
+
+from ChunkCache import chunk_cache
+from WorkerState import worker_state
+
+
+class CutChain:
+    def __init__(self, name, cuts, warmup_chunks=3, reorder=True):
+        self.__name__ = name
+        self.name = name
+        self.cuts = list(cuts)
+        self.warmup_chunks = warmup_chunks
+        self.reorder = reorder
+
+    @property
+    def _state(self):
+        return worker_state(f"CutChain.{self.name}", lambda: {
+            "chunks": 0,
+            "stats": {cut.name: {"evaluated": 0, "passed": 0, "seconds": 0.} for cut in self.cuts},
+        })
+
+    @property
+    def chunks(self):
+        return self._state["chunks"]
+
+    @property
+    def stats(self):
+        return self._state["stats"]
+
+    def _rank(self, cut):
+        # Expected time spent per rejected event: lower runs first
+        s = self.stats[cut.name]
+        if s["evaluated"] == 0:
+            return 0.
+        cost = s["seconds"] / s["evaluated"]
+        rejection = 1. - s["passed"] / s["evaluated"]
+        return cost / max(rejection, 1e-6)
+
+    def order(self):
+        if not self.reorder or self.chunks < self.warmup_chunks:
+            return self.cuts
+        return sorted(self.cuts, key=self._rank)
+
+    def __call__(self, events, params=None, **kwargs):
+        return chunk_cache.get(events, ("cutchain", self.name), lambda: self._evaluate(events, **kwargs))
+
+    def _evaluate(self, events, **kwargs):
+        nevents = len(events)
+        index = np.arange(nevents)
+        current = events
+        state = self._state
+        stats = state["stats"]
+        for cut in self.order():
+            if index.size == 0:
+                break
+            start = time.perf_counter()
+            mask = cut.get_mask(current, **kwargs)
+            mask = np.asarray(ak.to_numpy(ak.fill_none(mask, False)), dtype=bool)
+            s = stats[cut.name]
+            s["seconds"] += time.perf_counter() - start
+            s["evaluated"] += index.size
+            s["passed"] += int(mask.sum())
+            if mask.all():
+                continue
+            index = index[mask]
+            if current is not events:
+                chunk_cache.discard(current)
+            current = current[mask]
+        if current is not events:
+            chunk_cache.discard(current)
+        state["chunks"] += 1
+        full = np.zeros(nevents, dtype=bool)
+        full[index] = True
+        return full
+
+    def summary(self):
+        rows = []
+        for cut in self.order():
+            s = self.stats[cut.name]
+            rows.append({
+                "cut": cut.name,
+                **s,
+                "pass_fraction": s["passed"] / s["evaluated"] if s["evaluated"] else None,
+                "us_per_event": 1e6 * s["seconds"] / s["evaluated"] if s["evaluated"] else None,
+            })
+        return rows
+
+    def as_cut(self):
+        from pocket_coffea.lib.cut_definition import Cut
+
+        return Cut(name=self.name, function=self, params=None)
@@ -0,0 +1,240 @@
+'''
+Single-pass scan of cut thresholds.
+
+A `CutScan` declares parameters, each one a continuous per-event variable
+compared to a list of threshold values. On every chunk the variables are
+computed once and each event is reduced to the index of its value among
+the thresholds of every parameter (and to its bin in the scanned
+histograms). Weighted counts are accumulated per distinct combination of
+indices only, so the storage is bounded by the number of events and not by
+the size of the grid. Yields and histograms for every point of the grid are
+derived from those cells at the end of the job.
+
+With `nominal` thresholds and the `category` they reproduce, the yield of
+the nominal cell is compared on every chunk with the yield of the category.
+Events at a threshold can legitimately fall on different sides of it (the
+scan compares double precision values, the cuts may use single precision or
+the fast kernels), so the comparison is kept in output["cut_scan_checks"]
+and a warning is issued when they differ by more than `rtol`.
+
+    mtw_scan = CutScan(
+        name="mtw_scan",
+        parameters=[ScanParameter("mtw_min", mtw_value, ">", [40, 45, 50, 55, 60])],
+        base_cuts=[reqmuon, jetselbtv],
+        histograms={"W_mass": Axis(field="W_mass", bins=30, start=0, stop=150)},
+    )
+'''
+import itertools
+import warnings
+from dataclasses import dataclass
+
+import awkward as ak
+import numpy as np
+
+
+@dataclass
+class ScanParameter:
+    name: str
+    variable: object
+    op: str
+    values: list
+
+    def __post_init__(self):
+        if self.op not in (">", "<"):
+            raise ValueError(f"Scan parameter {self.name}: op must be '>' or '<', got {self.op!r}")
+        self.values = sorted(self.values)
+
+    @property
+    def radix(self):
+        return len(self.values) + 1
+
+    def digitize(self, events):
+        '''
+        Index d of each event such that it passes threshold j for j < d
+        (op ">") or for j >= d (op "<"). Missing values fail every threshold.
+        '''
+        values = ak.to_numpy(ak.fill_none(self.variable(events), np.nan)).astype(np.float64)
+        thresholds = np.asarray(self.values, dtype=np.float64)
+        if self.op == ">":
+            digits = np.searchsorted(thresholds, values, side="left")
+            digits[np.isnan(values)] = 0
+        else:
+            digits = np.searchsorted(thresholds, values, side="right")
+            digits[np.isnan(values)] = len(self.values)
+        return digits.astype(np.int64)
+
+    def passing(self, digits, index):
+        return index < digits if self.op == ">" else index >= digits
+
+
+class SparseCells:
+    '''
+    Sums of weights and of squared weights per occupied cell code.
+    Adding two of them merges the cells, so they accumulate across chunks.
+    '''
+    def __init__(self, codes=None, sumw=None, sumw2=None):
+        self.codes = np.zeros(0, dtype=np.int64) if codes is None else codes
+        self.sumw = np.zeros(0) if sumw is None else sumw
+        self.sumw2 = np.zeros(0) if sumw2 is None else sumw2
+
+    @classmethod
+    def from_events(cls, codes, weights):
+        unique, inverse = np.unique(codes, return_inverse=True)
+        return cls(
+            unique,
+            np.bincount(inverse, weights=weights, minlength=len(unique)),
+            np.bincount(inverse, weights=weights**2, minlength=len(unique)),
+        )
+
+    def __add__(self, other):
+        codes = np.concatenate([self.codes, other.codes])
+        unique, inverse = np.unique(codes, return_inverse=True)
+        return SparseCells(
+            unique,
+            np.bincount(inverse, weights=np.concatenate([self.sumw, other.sumw]), minlength=len(unique)),
+            np.bincount(inverse, weights=np.concatenate([self.sumw2, other.sumw2]), minlength=len(unique)),
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class CutScan:
+    def __init__(self, name, parameters, base_cuts=(), combine=None, histograms=None, nominal=None,
+                 category=None):
+        self.name = name
+        self.parameters = list(parameters)
+        self.base_cuts = list(base_cuts)
+        # combine({parameter name: passing mask}) -> mask, all of them by default
+        self.combine = combine
+        self.histograms = dict(histograms or {})
+        self.nominal = None
+        if nominal is not None:
+            self.nominal = tuple(p.values.index(nominal[p.name]) for p in self.parameters)
+        self.category = category
+
+    @property
+    def shape(self):
+        return tuple(len(p.values) for p in self.parameters)
+
+    def _base_mask(self, events, **kwargs):
+        mask = np.ones(len(events), dtype=bool)
+        for cut in self.base_cuts:
+            cut_mask = cut.get_mask(events, **kwargs)
+            mask &= np.asarray(ak.to_numpy(ak.fill_none(cut_mask, False)), dtype=bool)
+        return mask
+
+    @staticmethod
+    def _hist_bins(axis, events):
+        values = events[axis.field]
+        if values.ndim > 1:
+            values = ak.firsts(values)
+        values = ak.to_numpy(ak.fill_none(values, np.nan)).astype(np.float64)
+        # Bin 0 is the underflow (and missing values), bins + 1 the overflow
+        edges = np.linspace(axis.start, axis.stop, axis.bins + 1)
+        bins = np.searchsorted(edges, values, side="right")
+        bins[np.isnan(values)] = 0
+        return bins, axis.bins + 2
+
+    def fill(self, events, weights=None, **kwargs):
+        '''
+        Returns {"yields": SparseCells, <histogram>: SparseCells} for a chunk.
+        '''
+        mask = self._base_mask(events, **kwargs)
+        selected = events[mask]
+        weights = np.ones(len(events)) if weights is None else np.asarray(weights, dtype=np.float64)
+        weights = weights[mask]
+        codes = np.zeros(len(selected), dtype=np.int64)
+        for parameter in self.parameters:
+            codes = codes * parameter.radix + parameter.digitize(selected)
+        cells = {"yields": SparseCells.from_events(codes, weights)}
+        for name, axis in self.histograms.items():
+            bins, nbins = self._hist_bins(axis, selected)
+            cells[name] = SparseCells.from_events(codes * nbins + bins, weights)
+        return cells
+
+    def _decode(self, codes):
+        digits = {}
+        for parameter in reversed(self.parameters):
+            codes, digits[parameter.name] = np.divmod(codes, parameter.radix)
+        return digits
+
+    def _grid_passing(self, digits):
+        for point in itertools.product(*(range(len(p.values)) for p in self.parameters)):
+            passes = {p.name: p.passing(digits[p.name], i) for p, i in zip(self.parameters, point)}
+            if self.combine is None:
+                mask = np.logical_and.reduce(list(passes.values()))
+            else:
+                mask = self.combine(passes)
+            yield point, mask
+
+    def yields(self, cells):
+        '''
+        Sum of weights and of squared weights for every point of the grid.
+        '''
+        sumw = np.zeros(self.shape)
+        sumw2 = np.zeros(self.shape)
+        digits = self._decode(cells.codes)
+        for point, mask in self._grid_passing(digits):
+            sumw[point] = cells.sumw[mask].sum()
+            sumw2[point] = cells.sumw2[mask].sum()
+        return sumw, sumw2
+
+    def nominal_yield(self, cells):
+        digits = self._decode(cells.codes)
+        passes = {p.name: p.passing(digits[p.name], i) for p, i in zip(self.parameters, self.nominal)}
+        mask = np.logical_and.reduce(list(passes.values())) if self.combine is None else self.combine(passes)
+        return float(cells.sumw[mask].sum())
+
+    def check_nominal(self, cells, category_yield, rtol=1e-6):
+        '''
+        Compares the nominal cell of `cells` with the yield of the category
+        the scan reproduces; warns if they differ and returns the comparison.
+        '''
+        scan_yield = self.nominal_yield(cells["yields"])
+        differs = not np.isclose(scan_yield, category_yield, rtol=rtol, atol=rtol)
+        if differs:
+            warnings.warn(f"Scan {self.name}: nominal cell yield {scan_yield} differs from the "
+                          f"yield {category_yield} of category {self.category!r}")
+        return {"scan_yield": scan_yield, "category_yield": category_yield,
+                "chunks": 1, "chunks_differing": int(differs)}
+
+    def histogram(self, name, cells):
+        '''
+        A hist.Hist with one category axis per scanned parameter followed by
+        the histogram axis.
+        '''
+        import hist
+
+        axis = self.histograms[name]
+        nbins = axis.bins + 2
+        h = hist.Hist(
+            *[hist.axis.StrCategory([str(v) for v in p.values], name=p.name) for p in self.parameters],
+            hist.axis.Regular(axis.bins, axis.start, axis.stop, name=axis.field, label=axis.label),
+            storage=hist.storage.Weight(),
+        )
+        codes, bins = np.divmod(cells.codes, nbins)
+        digits = self._decode(codes)
+        view = h.view(flow=True)
+        for point, mask in self._grid_passing(digits):
+            view.value[point] = np.bincount(bins[mask], weights=cells.sumw[mask], minlength=nbins)
+            view.variance[point] = np.bincount(bins[mask], weights=cells.sumw2[mask], minlength=nbins)
+        return h
+
+
+def accumulate_scan(output, scan, sample, cells):
+    target = output.setdefault("cut_scans", {}).setdefault(scan.name, {})
+    if sample in target:
+        for key, value in cells.items():
+            target[sample][key] = target[sample][key] + value
+    else:
+        target[sample] = cells
+
+
+def accumulate_check(output, scan, sample, check):
+    target = output.setdefault("cut_scan_checks", {}).setdefault(scan.name, {})
+    if sample in target:
+        for key, value in check.items():
+            target[sample][key] += value
+    else:
+        target[sample] = check
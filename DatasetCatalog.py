@@ -0,0 +1,175 @@
+'''
+Compiled, indexed dataset catalog.
+
+The dataset JSONs are parsed once and compiled into a binary catalog
+(`.catalog/<hash>.pkl`) holding the dataset metadata, the files with their
+storage site, entry count and estimated size, and indexes on sample, year,
+isMC and site. The catalog is rebuilt only when the hash of the source JSONs
+(or of the entry-count cache) changes.
+
+`filtered_jsons` returns a small JSON holding only the selected datasets, so
+that the Configurator and every worker parse a few kB instead of the full
+catalog:
+
+    datasets = {"jsons": filtered_jsons(jsons, filter), "filter": filter}
+'''
+import hashlib
+import json
+import os
+import pickle
+from urllib.parse import urlparse
+
+CATALOG_VERSION = 1
+INDEXED_FIELDS = ("sample", "year", "isMC", "site")
+
+
+def file_site(url):
+    # Storage endpoint of a file, "local" for plain paths
+    return urlparse(url).netloc or "local"
+
+
+def source_hash(json_paths, entry_counts_path=None):
+    h = hashlib.sha256(f"v{CATALOG_VERSION}".encode())
+    for path in list(json_paths) + ([entry_counts_path] if entry_counts_path else []):
+        if path is None or not os.path.exists(path):
+            continue
+        h.update(os.path.abspath(path).encode())
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+class DatasetCatalog:
+    def __init__(self, datasets, entry_counts=None, source=""):
+        entry_counts = entry_counts or {}
+        self.source = source
+        self.datasets = {}
+        self.files = {}
+        self.index = {field: {} for field in INDEXED_FIELDS}
+        for name, content in datasets.items():
+            metadata = content["metadata"]
+            files = content["files"]
+            nevents = int(metadata.get("nevents", 0) or 0)
+            size = int(metadata.get("size", 0) or 0)
+            records = []
+            for url in files:
+                entries = (entry_counts.get(url) or {}).get("entries")
+                if entries is not None and nevents:
+                    file_size = size * entries // nevents
+                else:
+                    file_size = size // max(len(files), 1)
+                records.append({"url": url, "site": file_site(url), "entries": entries, "size": file_size})
+            self.datasets[name] = metadata
+            self.files[name] = records
+            keys = {
+                "sample": {metadata.get("sample")},
+                "year": {metadata.get("year")},
+                "isMC": {str(metadata.get("isMC"))},
+                "site": {r["site"] for r in records},
+            }
+            for field, values in keys.items():
+                for value in values:
+                    self.index[field].setdefault(value, set()).add(name)
+
+    def select(self, samples=None, samples_exclude=None, year=None, isMC=None, site=None):
+        '''
+        Names of the datasets matching every given criterion. Each criterion
+        is a list of accepted values and is resolved through its index.
+        '''
+        selected = set(self.datasets)
+        for field, values in (("sample", samples), ("year", year), ("site", site),
+                              ("isMC", None if isMC is None else [str(v) for v in isMC])):
+            if values:
+                matching = set()
+                for value in values:
+                    matching |= self.index[field].get(value, set())
+                selected &= matching
+        for value in samples_exclude or ():
+            selected -= self.index["sample"].get(value, set())
+        # Keep the order of the source JSONs
+        return [name for name in self.datasets if name in selected]
+
+    def to_json(self, names):
+        return {
+            name: {"metadata": self.datasets[name], "files": [r["url"] for r in self.files[name]]}
+            for name in names
+        }
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((CATALOG_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            version, catalog = pickle.load(f)
+        if version != CATALOG_VERSION:
+            raise ValueError(f"Catalog {path} has version {version}, expected {CATALOG_VERSION}")
+        return catalog
+
+
+def load_catalog(json_paths, cache_dir=".catalog", entry_counts_path="entry_counts.json"):
+    '''
+    Returns the compiled catalog of `json_paths`, compiling it only if no
+    catalog exists for the current content of the sources.
+    '''
+    digest = source_hash(json_paths, entry_counts_path)
+    path = os.path.join(cache_dir, f"{digest}.pkl")
+    if os.path.exists(path):
+        try:
+            return DatasetCatalog.load(path)
+        except (ValueError, pickle.UnpicklingError, EOFError):
+            pass
+    datasets = {}
+    for json_path in json_paths:
+        with open(json_path) as f:
+            datasets.update(json.load(f))
+    entry_counts = {}
+    if entry_counts_path and os.path.exists(entry_counts_path):
+        with open(entry_counts_path) as f:
+            entry_counts = json.load(f)
+    catalog = DatasetCatalog(datasets, entry_counts, source=digest)
+    os.makedirs(cache_dir, exist_ok=True)
+    catalog.save(path)
+    return catalog
+
+
+def filtered_jsons(json_paths, filter=None, cache_dir=".catalog", entry_counts_path="entry_counts.json"):
+    '''
+    Writes (once per source hash and filter) a JSON holding only the
+    datasets selected by `filter` and returns it as a list of paths, ready
+    for the `datasets.jsons` entry of the Configurator.
+    '''
+    filter = filter or {}
+    key = hashlib.sha256(
+        (source_hash(json_paths, entry_counts_path) + json.dumps(filter, sort_keys=True)).encode()
+    ).hexdigest()
+    path = os.path.join(cache_dir, f"filtered_{key[:16]}.json")
+    if not os.path.exists(path):
+        catalog = load_catalog(json_paths, cache_dir, entry_counts_path)
+        names = catalog.select(**filter)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(catalog.to_json(names), f, indent=4)
+        os.replace(tmp_path, path)
+    return [path]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile and query the dataset catalog")
+    parser.add_argument("jsons", nargs="+")
+    parser.add_argument("--sample", nargs="*")
+    parser.add_argument("--year", nargs="*")
+    parser.add_argument("--isMC", nargs="*")
+    parser.add_argument("--site", nargs="*")
+    args = parser.parse_args()
+
+    catalog = load_catalog(args.jsons)
+    for name in catalog.select(samples=args.sample, year=args.year, isMC=args.isMC, site=args.site):
+        records = catalog.files[name]
+        sites = sorted({r["site"] for r in records})
+        print(f"{name:>45}: {len(records):5d} files  {', '.join(sites)}")
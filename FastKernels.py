@@ -0,0 +1,207 @@
+'''
+Numba-compiled fused kernels for the jet-muon and lepton-veto selections.
+
+Each kernel walks the offsets of the jagged collections once and returns
+the per-event decision directly, without building intermediate jagged masks
+or filtered collections. The arithmetic follows the awkward implementations
+in CommonSelectors step by step, in single precision like the NanoAOD
+inputs, so that both paths take the same decisions. The exception is the
+dilepton mass, a difference of large squares that loses most of its digits
+in single precision: it is computed in double precision, so events within
+a relative 1e-5 of the window edges (12, 80, 100 GeV) may be decided
+differently than by the four-vector sum of coffea.
+
+The fast path is selected with `workflow_options["fast_kernels"]`; without
+numba the cuts keep using the awkward implementations.
+
+This module is shipped by value with cloudpickle and executed again for
+every chunk, which would compile the kernels again every time. The compiled
+dispatchers are therefore kept per worker process (see WorkerState.py) and
+compiled on first use; with the source file available they also use the
+on-disk cache of numba (`cache=True`) across processes and runs, without it
+(e.g. on a remote worker) they are compiled once per worker.
+tests/test_fast_kernels.py checks both, and that every kernel takes the
+decisions of the awkward implementation.
+'''
+import functools
+import warnings
+
+import awkward as ak
+import numpy as np
+
+from WorkerState import worker_state
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_enabled = False
+
+
+def set_enabled(enabled):
+    global _enabled
+    if enabled and numba is None:
+        warnings.warn("numba is not available, the fast kernels are disabled")
+        enabled = False
+    _enabled = bool(enabled)
+
+
+def enabled():
+    return _enabled
+
+
+def _compile(function):
+    try:
+        return numba.njit(cache=True, nogil=True)(function)
+    except RuntimeError:
+        # No cache locator: the source file of the function is not here
+        return numba.njit(nogil=True)(function)
+
+
+def _jit(function):
+    if numba is None:
+        return function
+
+    @functools.wraps(function)
+    def kernel(*args):
+        return dispatcher(kernel)(*args)
+    return kernel
+
+
+def dispatcher(kernel):
+    '''
+    The compiled dispatcher of `kernel` in this worker process.
+    '''
+    function = kernel.__wrapped__
+    return worker_state(f"FastKernels.{function.__name__}", lambda: _compile(function))
+
+
+def _offsets(collection):
+    counts = np.asarray(ak.num(collection, axis=1), dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _flat(array, dtype=np.float32):
+    return np.asarray(ak.to_numpy(ak.flatten(array, axis=1)), dtype=dtype)
+
+
+def _f32(value):
+    return np.float32(value)
+
+
+@_jit
+def _count_muon_jets(offsets, muon_idx1, muon_idx2, mu_ef, ne_em_ef, ef_max, min_jets, out):
+    for i in range(offsets.size - 1):
+        n = 0
+        for j in range(offsets[i], offsets[i + 1]):
+            if (muon_idx1[j] != -1 or muon_idx2[j] != -1) and (mu_ef[j] + ne_em_ef[j]) < ef_max:
+                n += 1
+        out[i] = n >= min_jets
+
+
+@_jit
+def _dilepton_veto(e_offsets, e_pt, e_eta, e_mva, mu_offsets, mu_pt, mu_eta, mu_tight, mu_iso,
+                   pt_min, eb_max, ee_min, ee_max, mu_eta_max, iso_max, nlep, out):
+    for i in range(e_offsets.size - 1):
+        n = 0
+        for j in range(e_offsets[i], e_offsets[i + 1]):
+            # Same operator precedence as the awkward expression in dilepveto
+            if ((e_pt[j] > pt_min) and (abs(e_eta[j]) < eb_max)) or (
+                    (e_eta[j] < ee_max) and (e_eta[j] > ee_min) and e_mva[j]):
+                n += 1
+        for j in range(mu_offsets[i], mu_offsets[i + 1]):
+            if mu_pt[j] > pt_min and abs(mu_eta[j]) < mu_eta_max and mu_tight[j] and mu_iso[j] <= iso_max:
+                n += 1
+        out[i] = n != nlep
+
+
+@_jit
+def _transverse_mass_above(offsets, mu_pt, mu_phi, met_pt, met_phi, mt_min, out):
+    pi = np.float32(np.pi)
+    two_pi = np.float32(2 * np.pi)
+    for i in range(offsets.size - 1):
+        if offsets[i + 1] == offsets[i]:
+            out[i] = False
+            continue
+        j = offsets[i]
+        dphi = (mu_phi[j] - met_phi[i] + pi) % two_pi - pi
+        mt2 = np.float32(2) * mu_pt[j] * met_pt[i] * (np.float32(1) - np.cos(dphi))
+        out[i] = np.sqrt(mt2) > mt_min
+
+
+@_jit
+def _leading_pair_mass_window(offsets1, pt1, eta1, phi1, m1, offsets2, pt2, eta2, phi2, m2,
+                              low, window_low, window_high, out):
+    for i in range(offsets1.size - 1):
+        if offsets1[i + 1] == offsets1[i] or offsets2[i + 1] == offsets2[i]:
+            out[i] = False
+            continue
+        a = offsets1[i]
+        b = offsets2[i]
+        pta, etaa, phia, ma = np.float64(pt1[a]), np.float64(eta1[a]), np.float64(phi1[a]), np.float64(m1[a])
+        ptb, etab, phib, mb = np.float64(pt2[b]), np.float64(eta2[b]), np.float64(phi2[b]), np.float64(m2[b])
+        x = pta * np.cos(phia) + ptb * np.cos(phib)
+        y = pta * np.sin(phia) + ptb * np.sin(phib)
+        za = pta * np.sinh(etaa)
+        zb = ptb * np.sinh(etab)
+        ta = np.sqrt(pta * pta + za * za + ma * ma)
+        tb = np.sqrt(ptb * ptb + zb * zb + mb * mb)
+        z = za + zb
+        t = ta + tb
+        mass = np.sqrt(t * t - x * x - y * y - z * z)
+        out[i] = (mass > low) and ((mass < window_low) or (mass > window_high))
+
+
+def muon_jet_selection(events, ef_max=0.7, min_jets=1):
+    jets = events.JetGood
+    out = np.empty(len(jets), dtype=np.bool_)
+    _count_muon_jets(
+        _offsets(jets),
+        _flat(jets.muonIdx1, np.int32), _flat(jets.muonIdx2, np.int32),
+        _flat(jets.muEF), _flat(jets.neEmEF),
+        _f32(ef_max), min_jets, out,
+    )
+    return ak.Array(out)
+
+
+def dilepton_veto(events, pt_min=12, eb_max=1.4442, ee_min=1.566, ee_max=2.5,
+                  mu_eta_max=2.4, iso_max=0.15, nlep=2):
+    electrons = events.ElectronGood
+    muons = events.MuonGood
+    out = np.empty(len(electrons), dtype=np.bool_)
+    _dilepton_veto(
+        _offsets(electrons), _flat(electrons.pt), _flat(electrons.eta),
+        _flat(electrons.mvaFall17V2Iso_WP80 > 0.5, np.bool_),
+        _offsets(muons), _flat(muons.pt), _flat(muons.eta),
+        _flat(muons.tightId > 0.5, np.bool_), _flat(muons.pfRelIso04_all),
+        _f32(pt_min), _f32(eb_max), _f32(ee_min), _f32(ee_max),
+        _f32(mu_eta_max), _f32(iso_max), nlep, out,
+    )
+    return ak.Array(out)
+
+
+def transverse_mass_cut(events, mt_min=55):
+    muons = events.MuonGood
+    out = np.empty(len(muons), dtype=np.bool_)
+    _transverse_mass_above(
+        _offsets(muons), _flat(muons.pt), _flat(muons.phi),
+        np.asarray(events.MET.pt, dtype=np.float32), np.asarray(events.MET.phi, dtype=np.float32),
+        _f32(mt_min), out,
+    )
+    return ak.Array(out)
+
+
+def dilepton_mass_cut(events, low=12, window_low=80, window_high=100,
+                      coll1="MuonGood", coll2="SoftMuonGood"):
+    first = events[coll1]
+    second = events[coll2]
+    out = np.empty(len(first), dtype=np.bool_)
+    _leading_pair_mass_window(
+        _offsets(first), _flat(first.pt), _flat(first.eta), _flat(first.phi), _flat(first.mass),
+        _offsets(second), _flat(second.pt), _flat(second.eta), _flat(second.phi), _flat(second.mass),
+        np.float64(low), np.float64(window_low), np.float64(window_high), out,
+    )
+    return ak.Array(out)
@@ -0,0 +1,212 @@
+'''
+Per-stage timing and memory instrumentation.
+
+When recording is active, every wrapped processor method and every
+instrumented cut records wall time, CPU time, events in and out and the
+change of resident memory. The per-chunk records are summed by name into
+`output["instrumentation"]` and the individual calls are kept, per worker,
+in `output["instrumentation_trace"]` for a Chrome-trace timeline
+(chrome://tracing or https://ui.perfetto.dev).
+
+When recording is off the processor methods are not wrapped at all and an
+instrumented cut costs a single global lookup per call.
+
+    python Instrumentation.py output.coffea --trace timeline.json
+'''
+import functools
+import os
+import socket
+import threading
+import time
+
+import awkward as ak
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+_active = None
+
+
+def _rss():
+    # Resident memory in bytes; /proc is much cheaper than psutil
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _length(array):
+    try:
+        return len(array)
+    except TypeError:
+        return 0
+
+
+class Recorder:
+    def __init__(self, keep_trace=True):
+        self.keep_trace = keep_trace
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.summary = {}
+        self.trace = []
+
+    def call(self, kind, name, function, args, kwargs, events_in, events_out):
+        rss_start = _rss()
+        cpu_start = time.process_time()
+        start = time.time()
+        wall_start = time.perf_counter()
+        nin = events_in()
+        result = function(*args, **kwargs)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss_delta = _rss() - rss_start
+        nout = events_out(result)
+        key = f"{kind}:{name}"
+        s = self.summary.setdefault(key, {
+            "calls": 0, "wall": 0., "cpu": 0., "events_in": 0, "events_out": 0, "rss_delta_mb": 0.,
+        })
+        s["calls"] += 1
+        s["wall"] += wall
+        s["cpu"] += cpu
+        s["events_in"] += nin
+        s["events_out"] += nout
+        s["rss_delta_mb"] += rss_delta / 2**20
+        if self.keep_trace:
+            self.trace.append({
+                "name": name, "cat": kind, "ph": "X",
+                "ts": start * 1e6, "dur": wall * 1e6,
+                "pid": self.worker, "tid": threading.get_ident(),
+                "args": {"events_in": nin, "events_out": nout, "cpu": cpu, "rss_delta_mb": rss_delta / 2**20},
+            })
+        return result
+
+    def instrument_methods(self, obj, names):
+        '''
+        Shadows the given methods of `obj` with recording wrappers and
+        returns a function removing them again.
+        '''
+        wrapped = []
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is None:
+                continue
+            def wrapper(*args, _method=method, _name=name, **kwargs):
+                return self.call(
+                    "stage", _name, _method, args, kwargs,
+                    lambda: _length(getattr(obj, "events", None)),
+                    lambda _: _length(getattr(obj, "events", None)),
+                )
+            setattr(obj, name, wrapper)
+            wrapped.append(name)
+
+        def restore():
+            for name in wrapped:
+                obj.__dict__.pop(name, None)
+        return restore
+
+    def output(self):
+        output = {"instrumentation": self.summary}
+        if self.keep_trace:
+            output["instrumentation_trace"] = {self.worker: self.trace}
+        return output
+
+
+def start_recording(keep_trace=True):
+    global _active
+    _active = Recorder(keep_trace)
+    return _active
+
+
+def stop_recording():
+    global _active
+    recorder, _active = _active, None
+    return recorder
+
+
+def _count_passing(mask):
+    try:
+        return int(ak.sum(mask))
+    except Exception:
+        return 0
+
+
+def instrumented_cut(function):
+    '''
+    Records the evaluation of a cut function while recording is active.
+    '''
+    @functools.wraps(function)
+    def wrapper(events, *args, **kwargs):
+        recorder = _active
+        if recorder is None:
+            return function(events, *args, **kwargs)
+        return recorder.call(
+            "cut", function.__name__, function, (events,) + args, kwargs,
+            lambda: _length(events), _count_passing,
+        )
+    return wrapper
+
+
+def summary_table(summary):
+    header = (f"{'stage':<50} {'calls':>7} {'wall [s]':>10} {'cpu [s]':>10} "
+              f"{'events in':>12} {'events out':>12} {'ev/s':>12} {'dRSS [MB]':>10}")
+    lines = [header, "-" * len(header)]
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]["wall"]):
+        rate = s["events_in"] / s["wall"] if s["wall"] > 0 else 0.
+        lines.append(
+            f"{name:<50} {s['calls']:7d} {s['wall']:10.3f} {s['cpu']:10.3f} "
+            f"{s['events_in']:12d} {s['events_out']:12d} {rate:12.0f} {s['rss_delta_mb']:10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def chrome_trace(trace_by_worker, worker=None):
+    '''
+    Chrome trace events for all workers (one process per worker) or for a
+    single one.
+    '''
+    events = []
+    for pid, (name, trace) in enumerate(sorted(trace_by_worker.items())):
+        if worker is not None and name != worker:
+            continue
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+        events.extend({**e, "pid": pid} for e in trace)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def export_chrome_trace(output, path, per_worker=False):
+    import json
+
+    traces = output.get("instrumentation_trace", {})
+    if not per_worker:
+        with open(path, "w") as f:
+            json.dump(chrome_trace(traces), f)
+        return [path]
+    root, ext = os.path.splitext(path)
+    paths = []
+    for worker in traces:
+        worker_path = f"{root}_{worker.replace(':', '_')}{ext or '.json'}"
+        with open(worker_path, "w") as f:
+            json.dump(chrome_trace(traces, worker), f)
+        paths.append(worker_path)
+    return paths
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from coffea.util import load
+
+    parser = argparse.ArgumentParser(description="Summarize the instrumentation of a processor output")
+    parser.add_argument("output", help="Coffea output file")
+    parser.add_argument("--trace", help="Write a Chrome-trace timeline to this file")
+    parser.add_argument("--per-worker", action="store_true", help="One timeline file per worker")
+    args = parser.parse_args()
+
+    output = load(args.output)
+    print(summary_table(output.get("instrumentation", {})))
+    if args.trace:
+        for path in export_chrome_trace(output, args.trace, args.per_worker):
+            print(f"Timeline written to {path}")
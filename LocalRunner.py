@@ -0,0 +1,544 @@
+'''
+Local multi-process runner for a configuration.
+
+The processor is shipped once to every worker of a process pool. Chunks are
+cut on demand by `AdaptiveChunker`, processed on the workers, which report
+the wall time and the peak resident memory of each chunk, and merged with
+coffea's `accumulate` in the parent. The measurements drive the chunk size
+of each dataset (see AdaptiveChunks); the chosen sizes and the reasons for
+every change are written next to the output.
+
+With `prefetch=N` every worker instead pulls chunks from a shared queue and
+reads the next N of them on a background thread while processing the
+current one (see Prefetch). The parent checks that these workers are alive
+while it waits for results, so a worker killed e.g. for its memory fails
+the run instead of hanging it.
+
+`cfg` may also be a frozen `ConfigSnapshot`, whose pickled processor is
+shipped to the workers as is (see ConfigSnapshot). Every chunk reports the
+time its worker took to load the processor and the size of the payload.
+
+With `site_affinity=True` every worker has its own queue, filled by a
+`SiteScheduler` that keeps each worker on one storage endpoint and caps the
+chunks queued or running per endpoint at `max_streams` (see SiteScheduler).
+
+With `shared_merge=True` the workers add the histograms of their chunks into
+shared memory slabs and only the chunk measurements are sent per chunk; the
+parent merges one output per worker at the end (see SharedAccumulator). The
+CPU time the parent spent merging is logged and saved with the chunk log.
+
+With `preview=fraction` only a seeded, stratified sample of the chunks of
+every dataset is processed (see Preview).
+
+With `resplit_stragglers=True` the datasets are cut up front into chunks
+of roughly `target_cost` bytes, interleaved across datasets (`plan_chunks`),
+and the process pool is driven by a `WorkQueue`, which splits the chunks
+running far longer than expected and resubmits their halves (see
+ChunkPlanner).
+
+With `replica_cache={"cache_dir": ..., "max_bytes": ...}` the chunks are
+read from partial local replicas of the input files, shared by the workers
+of the node and fetched on a miss (see ReplicaCache).
+
+    python LocalRunner.py config_Wc.py --workers 8 --memory-budget-mb 3000 -o output.coffea
+'''
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cloudpickle
+
+from AdaptiveChunks import AdaptiveChunker, ChunkSizeController, current_rss, peak_rss, reset_peak_rss
+from ChunkPlanner import EntryCounts, WorkQueue, plan_chunks
+from ConfigSnapshot import ConfigSnapshot
+
+logger = logging.getLogger(__name__)
+
+_processor = None
+_columns = None
+_replica_cache = None
+_startup_seconds = None
+
+
+def make_replica_cache(options):
+    if not options:
+        return None
+    from ReplicaCache import ReplicaCache
+
+    return ReplicaCache(**options)
+
+
+def _init_worker(payload, columns, replica_cache=None):
+    global _processor, _columns, _replica_cache, _startup_seconds
+    start = time.perf_counter()
+    _processor = cloudpickle.loads(payload)
+    _startup_seconds = time.perf_counter() - start
+    _columns = columns
+    _replica_cache = make_replica_cache(replica_cache)
+
+
+def chunk_metadata(chunk):
+    return {
+        **chunk.metadata,
+        "dataset": chunk.dataset,
+        "filename": chunk.filename,
+        "treename": chunk.treename,
+        "entrystart": chunk.entrystart,
+        "entrystop": chunk.entrystop,
+        "fileuuid": chunk.fileuuid,
+    }
+
+
+def load_chunk(chunk, columns=None, replica_cache=None):
+    from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+
+    from ColumnPruning import load_events
+
+    metadata = chunk_metadata(chunk)
+    if replica_cache is not None:
+        return replica_cache.open_events(chunk.filename, columns or None, chunk.entrystart, chunk.entrystop,
+                                         chunk.treename, metadata)
+    if columns:
+        return load_events(chunk.filename, columns, chunk.entrystart, chunk.entrystop,
+                           chunk.treename, metadata)
+    return NanoEventsFactory.from_root(
+        chunk.filename, treepath=chunk.treename, entry_start=chunk.entrystart,
+        entry_stop=chunk.entrystop, schemaclass=NanoAODSchema, metadata=metadata,
+    ).events()
+
+
+def run_chunk(chunk, processor_instance=None, columns=None, events=None):
+    '''
+    Processes one chunk; returns its output and the measurements of the run.
+    '''
+    processor_instance = processor_instance or _processor
+    columns = columns if columns is not None else _columns
+    base = current_rss()
+    reset_peak_rss()
+    start = time.perf_counter()
+    if events is None:
+        events = load_chunk(chunk, columns, _replica_cache)
+    output = processor_instance.process(events)
+    stats = {
+        "dataset": chunk.dataset,
+        "nevents": chunk.nevents,
+        "seconds": time.perf_counter() - start,
+        "peak_rss": peak_rss(),
+        "base_rss": base,
+        "pid": os.getpid(),
+        "startup_seconds": _startup_seconds,
+    }
+    return output, stats
+
+
+def prefetching_worker(payload, columns, tasks, results, depth, max_bytes, worker=None, shared_merge=False,
+                       slab_prefix=None, replica_cache=None):
+    '''
+    Worker loop of the prefetching mode: chunks come from the `tasks` queue
+    (None stops the worker) and ("ok", (output, stats)) or ("error",
+    (worker, traceback)) go to the `results` queue, one per chunk, in order.
+    With `shared_merge` the outputs are added to slabs named `slab_prefix`
+    instead, sent as None, and ("slabs", description) is sent after the last
+    chunk; a worker leaving on an error frees its slabs. `replica_cache` are
+    the options of the ReplicaCache the chunks are read through, if any.
+    '''
+    from Prefetch import Prefetcher, events_from_arrays
+    from SharedAccumulator import SlabAccumulator
+
+    start = time.perf_counter()
+    processor_instance = cloudpickle.loads(payload)
+    startup_seconds = time.perf_counter() - start
+    prefetcher = Prefetcher(tasks.get, columns, depth, max_bytes,
+                            replica_cache=make_replica_cache(replica_cache))
+    accumulator = SlabAccumulator(slab_prefix) if shared_merge else None
+    try:
+        _prefetching_loop(prefetcher, processor_instance, columns, results, worker, startup_seconds,
+                          accumulator)
+        prefetcher.close()
+        if accumulator is not None:
+            results.put(("slabs", accumulator.describe()))
+            accumulator.close()
+    except BaseException:
+        if accumulator is not None:
+            accumulator.close(unlink=True)
+        raise
+
+
+def _prefetching_loop(prefetcher, processor_instance, columns, results, worker, startup_seconds, accumulator):
+    waited = 0.
+    for chunk, arrays, fetch_seconds in prefetcher:
+        try:
+            if isinstance(arrays, Exception):
+                raise arrays
+            events = events_from_arrays(chunk, arrays, chunk_metadata(chunk))
+            output, stats = run_chunk(chunk, processor_instance, columns, events)
+            stats["fetch_seconds"] = fetch_seconds
+            stats["startup_seconds"] = startup_seconds
+            stats["worker"] = worker
+            # Time this chunk's processing waited for its data
+            stats["waited_seconds"] = prefetcher.wait_seconds - waited
+            waited = prefetcher.wait_seconds
+            if accumulator is not None:
+                start = time.perf_counter()
+                accumulator.add(output)
+                stats["merge_seconds"] = time.perf_counter() - start
+                output = None
+            results.put(("ok", (output, stats)))
+        except Exception:
+            results.put(("error", (worker, traceback.format_exc())))
+
+
+class LocalRunner:
+    def __init__(self, cfg, workers=4, columns=None, controller=None, entry_counts=None,
+                 max_inflight=None, prefetch=0, prefetch_bytes=2 * 2**30, site_affinity=False,
+                 max_streams=None, default_streams=4, shared_merge=False, preview=None, seed=0,
+                 resplit_stragglers=False, target_cost=100 * 2**20, replica_cache=None):
+        if resplit_stragglers and (prefetch or site_affinity or shared_merge):
+            raise ValueError("Stragglers are only re-split with the process pool: "
+                             "not with prefetch, site_affinity or shared_merge")
+        self.cfg = cfg
+        self.workers = workers
+        self.columns = columns
+        self.controller = controller or ChunkSizeController()
+        self.entry_counts = entry_counts or EntryCounts()
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.site_affinity = site_affinity
+        self.max_streams = max_streams
+        self.default_streams = default_streams
+        self.scheduler = None
+        self.shared_merge = shared_merge
+        self.preview = preview
+        self.seed = seed
+        self.preview_summary = None
+        self.resplit_stragglers = resplit_stragglers
+        self.target_cost = target_cost
+        self.work_queue = None
+        self.replica_cache = replica_cache
+        self._slabs = []
+        self._slab_prefixes = []
+        # Enough queued chunks for every worker to read ahead
+        self.max_inflight = max_inflight or workers * (prefetch + 2)
+        self.chunk_stats = []
+        self.payload_bytes = None
+        self.merge_cpu_seconds = 0.
+
+    def make_processor(self):
+        if isinstance(self.cfg, ConfigSnapshot):
+            return self.cfg.processor()
+        return self.cfg.workflow(self.cfg)
+
+    def make_payload(self, processor_instance):
+        if isinstance(self.cfg, ConfigSnapshot):
+            return self.cfg.payload
+        return cloudpickle.dumps(processor_instance)
+
+    def merge(self, output, result):
+        from coffea.processor import accumulate
+
+        return result if output is None else accumulate([output, result])
+
+    def _run_pool(self, chunker, payload):
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                 initargs=(payload, self.columns, self.replica_cache)) as executor:
+            if self.resplit_stragglers:
+                self.work_queue = WorkQueue(chunker, self.workers)
+                for _, result in self.work_queue.results(executor, run_chunk):
+                    yield result
+                return
+            running = set()
+            while True:
+                for chunk in chunker:
+                    running.add(executor.submit(run_chunk, chunk))
+                    if len(running) >= self.max_inflight:
+                        break
+                if not running:
+                    return
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _start_workers(self, payload, queues, results):
+        if self.shared_merge:
+            from multiprocessing import resource_tracker
+
+            # Shared by the workers, so that their slabs outlive them
+            resource_tracker.ensure_running()
+        run = secrets.token_hex(4)
+        self._slab_prefixes = [f"slab{os.getpid()}_{run}_{i}" for i in range(len(queues))]
+        workers = [
+            multiprocessing.Process(
+                target=prefetching_worker,
+                args=(payload, self.columns, tasks, results, self.prefetch, self.prefetch_bytes, i,
+                      self.shared_merge, prefix, self.replica_cache),
+                daemon=True,
+            )
+            for i, (tasks, prefix) in enumerate(zip(queues, self._slab_prefixes))
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    @staticmethod
+    def _get_result(results, workers, finishing=False, timeout=5):
+        '''
+        Next message of the workers. Raises if a worker died, or if all of
+        them exited when `finishing`, instead of waiting forever.
+        '''
+        while True:
+            try:
+                return results.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            exited = {i: worker.exitcode for i, worker in enumerate(workers) if not worker.is_alive()}
+            # The workers only exit once told there is no more work
+            failed = {i: code for i, code in exited.items() if code != 0 or not finishing}
+            if failed:
+                raise RuntimeError(f"Workers exited while chunks were pending (worker: exit code): {failed}")
+            if finishing and len(exited) == len(workers):
+                raise RuntimeError("All workers exited before sending their results")
+
+    def _collect_slabs(self, workers, queues, results):
+        # Every worker describes its slabs once it gets the end of the work
+        for tasks in queues:
+            tasks.put(None)
+        while len(self._slabs) < len(queues):
+            status, value = self._get_result(results, workers, finishing=True)
+            if status == "error":
+                raise RuntimeError(f"Chunk processing failed on worker {value[0]}:\n{value[1]}")
+            self._slabs.append(value)
+
+    def _stop_workers(self, workers, queues):
+        if len(self._slabs) < len(queues):
+            for tasks in queues:
+                tasks.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+    def _free_slabs(self):
+        '''
+        Frees the slabs of every worker, described or not, when the run
+        cannot reduce them; the workers must have stopped.
+        '''
+        from SharedAccumulator import free_slabs, unlink_prefix
+
+        free_slabs(self._slabs)
+        described = {description["prefix"] for description in self._slabs}
+        for prefix in self._slab_prefixes:
+            if prefix not in described:
+                unlink_prefix(prefix)
+        self._slabs = []
+
+    def _run_prefetching(self, chunker, payload):
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        workers = self._start_workers(payload, [tasks] * self.workers, results)
+        inflight = 0
+        try:
+            while True:
+                for chunk in chunker:
+                    tasks.put(chunk)
+                    inflight += 1
+                    if inflight >= self.max_inflight:
+                        break
+                if inflight == 0:
+                    break
+                status, value = self._get_result(results, workers)
+                inflight -= 1
+                if status == "error":
+                    raise RuntimeError(f"Chunk processing failed on a worker:\n{value[1]}")
+                yield value
+            if self.shared_merge:
+                self._collect_slabs(workers, [tasks] * self.workers, results)
+        except BaseException:
+            self._stop_workers(workers, [tasks] * self.workers)
+            self._free_slabs()
+            raise
+        else:
+            self._stop_workers(workers, [tasks] * self.workers)
+
+    def _run_sites(self, chunker, payload):
+        from collections import deque
+
+        from SiteScheduler import SiteScheduler
+
+        self.scheduler = scheduler = SiteScheduler(chunker, self.max_streams, self.default_streams)
+        scheduler.assign(range(self.workers))
+        queues = [multiprocessing.Queue() for _ in range(self.workers)]
+        results = multiprocessing.Queue()
+        workers = self._start_workers(payload, queues, results)
+        # Chunks queued on each worker, in the order they are processed
+        pending = [deque() for _ in range(self.workers)]
+        try:
+            while True:
+                # One chunk per worker and pass, so that the streams of an
+                # endpoint are spread over its workers
+                added = True
+                while added:
+                    added = False
+                    for i, tasks in enumerate(queues):
+                        if len(pending[i]) > self.prefetch:
+                            continue
+                        chunk = scheduler.next_chunk(i)
+                        if chunk is not None:
+                            tasks.put(chunk)
+                            pending[i].append(chunk)
+                            added = True
+                if not any(pending):
+                    break
+                status, value = self._get_result(results, workers)
+                if status == "error":
+                    raise RuntimeError(f"Chunk processing failed on worker {value[0]}:\n{value[1]}")
+                scheduler.release(pending[value[1]["worker"]].popleft())
+                yield value
+            if self.shared_merge:
+                self._collect_slabs(workers, queues, results)
+        except BaseException:
+            self._stop_workers(workers, queues)
+            self._free_slabs()
+            raise
+        else:
+            self._stop_workers(workers, queues)
+
+    def run(self, datasets=None):
+        filesets = self.cfg.filesets
+        if datasets:
+            filesets = {d: filesets[d] for d in datasets}
+        if self.preview:
+            from Preview import PreviewChunker
+
+            chunker = PreviewChunker(filesets, self.entry_counts, self.preview, self.seed)
+            self.preview_summary = chunker.summary()
+        elif self.resplit_stragglers:
+            # Equal-cost chunks; the work queue evens out the rest
+            chunker = plan_chunks(filesets, self.entry_counts, self.target_cost,
+                                  max_entries=self.controller.max_entries)
+        else:
+            chunker = AdaptiveChunker(filesets, self.entry_counts, self.controller)
+        processor_instance = self.make_processor()
+        payload = self.make_payload(processor_instance)
+        self.payload_bytes = len(payload)
+        logger.info("Processor payload of %.0f kB shipped to %d workers", len(payload) / 2**10, self.workers)
+        if self.site_affinity:
+            run = self._run_sites
+        else:
+            # The pool workers cannot keep slabs across chunks
+            run = self._run_prefetching if self.prefetch or self.shared_merge else self._run_pool
+        output = None
+        self._slabs = []
+        # The controller sees every result before the next chunks are cut
+        for result, stats in run(chunker, payload):
+            self.chunk_stats.append(stats)
+            self.controller.update(stats["dataset"], stats["nevents"], stats["seconds"],
+                                   stats["peak_rss"], stats["base_rss"])
+            if result is not None:
+                start = time.process_time()
+                output = self.merge(output, result)
+                self.merge_cpu_seconds += time.process_time() - start
+        if self._slabs:
+            from SharedAccumulator import reduce_slabs
+
+            start = time.process_time()
+            try:
+                reduced = reduce_slabs(self._slabs)
+            finally:
+                # Those not read when the reduction failed
+                self._free_slabs()
+            if reduced is not None:
+                output = self.merge(output, reduced)
+            self.merge_cpu_seconds += time.process_time() - start
+        logger.info("Merged %d chunk outputs with %.2f s of CPU in the parent",
+                    len(self.chunk_stats), self.merge_cpu_seconds)
+        return processor_instance.postprocess(output if output is not None else {})
+
+    def save_log(self, path):
+        with open(path, "w") as f:
+            log = {
+                "payload_bytes": self.payload_bytes,
+                "merge_cpu_seconds": self.merge_cpu_seconds,
+                "chunk_sizes": self.controller.history,
+                "chunks": self.chunk_stats,
+            }
+            if self.scheduler is not None:
+                log["sites"] = self.scheduler.summary()
+            if self.preview_summary is not None:
+                log["preview"] = self.preview_summary
+            if self.work_queue is not None:
+                log["stragglers"] = self.work_queue.summary()
+            if self.replica_cache:
+                log["replica_cache"] = make_replica_cache(self.replica_cache).report()
+            json.dump(log, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from ColumnPruning import load_columns, load_config
+
+    parser = argparse.ArgumentParser(description="Run a configuration on a local process pool")
+    parser.add_argument("config", help="Configuration file defining `cfg`, or a frozen .snapshot")
+    parser.add_argument("-j", "--workers", type=int, default=4)
+    parser.add_argument("--datasets", nargs="*", help="Only these datasets")
+    parser.add_argument("--columns", help="Pruned branch set (pruned_columns.json)")
+    parser.add_argument("--memory-budget-mb", type=float, default=2048, help="Peak RSS budget per worker")
+    parser.add_argument("--initial-entries", type=int, default=100_000)
+    parser.add_argument("--min-entries", type=int, default=5_000)
+    parser.add_argument("--max-entries", type=int, default=2_000_000)
+    parser.add_argument("--counts", default="entry_counts.json")
+    parser.add_argument("--prefetch", type=int, default=0, help="Chunks read ahead by every worker")
+    parser.add_argument("--prefetch-mb", type=float, default=2048, help="Memory cap of the read-ahead")
+    parser.add_argument("--site-affinity", action="store_true", help="Keep every worker on one endpoint")
+    parser.add_argument("--max-streams", type=int, default=4, help="Chunks queued or running per endpoint")
+    parser.add_argument("--shared-merge", action="store_true", help="Merge the histograms in shared memory slabs")
+    parser.add_argument("--preview", type=float, help="Process only this fraction of every dataset")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the preview selection")
+    parser.add_argument("--resplit-stragglers", action="store_true",
+                        help="Split and resubmit the chunks running much longer than expected")
+    parser.add_argument("--target-mb", type=float, default=100.,
+                        help="Compressed size of the planned chunks with --resplit-stragglers")
+    parser.add_argument("--replica-cache", help="Read the chunks through a local replica cache in this directory")
+    parser.add_argument("--replica-cache-gb", type=float, default=50, help="Size budget of the replica cache")
+    parser.add_argument("-o", "--output", default="output.coffea")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    from coffea.util import save
+
+    if args.config.endswith(".snapshot"):
+        cfg = ConfigSnapshot.load(args.config)
+    else:
+        cfg = load_config(os.path.abspath(args.config))
+    runner = LocalRunner(
+        cfg,
+        workers=args.workers,
+        columns=load_columns(args.columns) if args.columns else None,
+        controller=ChunkSizeController(
+            memory_budget=args.memory_budget_mb * 2**20,
+            initial_entries=args.initial_entries,
+            min_entries=args.min_entries,
+            max_entries=args.max_entries,
+        ),
+        entry_counts=EntryCounts(args.counts),
+        prefetch=args.prefetch,
+        prefetch_bytes=args.prefetch_mb * 2**20,
+        site_affinity=args.site_affinity,
+        default_streams=args.max_streams,
+        shared_merge=args.shared_merge,
+        preview=args.preview,
+        seed=args.seed,
+        resplit_stragglers=args.resplit_stragglers,
+        target_cost=args.target_mb * 2**20,
+        replica_cache={"cache_dir": args.replica_cache, "max_bytes": args.replica_cache_gb * 2**30}
+        if args.replica_cache else None,
+    )
+    output = runner.run(args.datasets)
+    save(output, args.output)
+    runner.save_log(os.path.splitext(args.output)[0] + "_chunks.json")
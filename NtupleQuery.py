@@ -0,0 +1,272 @@
+'''
+Multi-core histogramming of the saved W+c ntuples.
+
+The Parquet parts under `Saved_root_files/<dataset>/` (those indexed in its
+`_metadata` once consolidated) are scanned without going back to NanoAOD:
+only the columns used by the cuts and the histograms are read, row groups
+whose min/max statistics cannot pass the cuts are skipped without being
+read, and the remaining row groups are split into tasks filled in parallel
+by a pool of processes. Histograms use the `Axis`
+definitions of the configuration variables with the same field, or with
+the field the column was saved from (`NTUPLE_COLUMNS`).
+
+Rows are filled with their "weight" column, the nominal event weight of the
+processor, with the sum of squared weights as variance. The weight holds
+lumi x XS and the corrections but not the division by the sum of generator
+weights of the dataset, which is taken from the output of the run that
+wrote the ntuples (`--output-of`), as coffea histograms are normalized.
+Ntuples written without the column are filled with unit weights.
+
+    python NtupleQuery.py --hist W_mass Z_mass --cut "W_mass>55" "hl_ptratio<0.4" --output-of output.coffea
+'''
+import functools
+import glob
+import operator
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from BatchFill import bin_index, hist_axis, nbins_with_flow
+from NtupleWriter import dataset_parts
+
+OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+CUT_PATTERN = re.compile(r"^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*([-+.\w]+)\s*$")
+
+# Event fields saved by the processor under another column name (see
+# `variables_to_save` in CoffeaBTVProcessor)
+NTUPLE_COLUMNS = {
+    "nMuonGood": "nMuon",
+    "nSoftMuonGood": "nSoftMuon",
+}
+
+
+def ntuple_column(field):
+    return NTUPLE_COLUMNS.get(field, field)
+
+
+def parse_cut(text):
+    match = CUT_PATTERN.match(text)
+    if match is None:
+        raise ValueError(f"Cannot parse cut {text!r}, expected e.g. 'W_mass>55'")
+    column, op, value = match.groups()
+    return ntuple_column(column), op, float(value)
+
+
+def config_axes(cfg, names=None):
+    '''
+    Axes of the 1D per-event variables of a configuration, by histogram name.
+    '''
+    axes = {}
+    for name, hist_conf in cfg.variables.items():
+        if len(hist_conf.axes) != 1 or hist_conf.axes[0].coll != "events":
+            continue
+        if names is None or name in names:
+            axes[name] = hist_conf.axes[0]
+    return axes
+
+
+def may_pass(row_group, columns, cuts):
+    '''
+    False when the statistics of the row group prove that no row passes.
+    '''
+    for column, op, value in cuts:
+        stats = row_group.column(columns[column]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        low, high = stats.min, stats.max
+        if op == ">" and not high > value:
+            return False
+        if op == ">=" and not high >= value:
+            return False
+        if op == "<" and not low < value:
+            return False
+        if op == "<=" and not low <= value:
+            return False
+        if op == "==" and not low <= value <= high:
+            return False
+        if op == "!=" and low == high == value:
+            return False
+    return True
+
+
+def plan_tasks(outdir, datasets=None, cuts=(), row_groups_per_task=4):
+    '''
+    (dataset, path, row groups) tasks of the row groups that may pass the
+    cuts, and the total and skipped numbers of row groups.
+    '''
+    tasks = []
+    total = skipped = 0
+    for directory in sorted(glob.glob(os.path.join(outdir, "*"))):
+        dataset = os.path.basename(directory)
+        if not os.path.isdir(directory) or (datasets and dataset not in datasets):
+            continue
+        for path in dataset_parts(directory):
+            metadata = pq.read_metadata(path)
+            columns = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+            selected = []
+            for i in range(metadata.num_row_groups):
+                total += 1
+                if may_pass(metadata.row_group(i), columns, cuts):
+                    selected.append(i)
+                else:
+                    skipped += 1
+            for start in range(0, len(selected), row_groups_per_task):
+                tasks.append((dataset, path, selected[start:start + row_groups_per_task]))
+    return tasks, total, skipped
+
+
+def fill_task(task, axes, cuts):
+    '''
+    Sums of weights and of squared weights of every histogram for one task,
+    and the rows read and passing.
+    '''
+    dataset, path, row_groups = task
+    parquet = pq.ParquetFile(path)
+    weighted = "weight" in parquet.schema_arrow.names
+    columns = sorted({ntuple_column(axis.field) for axis in axes.values()} | {column for column, _, _ in cuts}
+                     | ({"weight"} if weighted else set()))
+    table = parquet.read_row_groups(row_groups, columns=columns)
+    values = {
+        column: table.column(column).to_numpy(zero_copy_only=False).astype(np.float64)
+        for column in columns
+    }
+    # Missing values are NaN and fail every cut
+    mask = np.ones(table.num_rows, dtype=bool)
+    for column, op, value in cuts:
+        mask &= OPS[op](values[column], value) & ~np.isnan(values[column])
+    weights = values["weight"] if weighted else np.ones(table.num_rows)
+    sums = {}
+    for name, axis in axes.items():
+        v = values[ntuple_column(axis.field)][mask]
+        w = weights[mask]
+        present = ~np.isnan(v)
+        index = bin_index(axis, v[present])
+        w = w[present]
+        nbins = nbins_with_flow(axis)
+        sums[name] = (np.bincount(index, weights=w, minlength=nbins),
+                      np.bincount(index, weights=w**2, minlength=nbins))
+    return dataset, sums, table.num_rows, int(mask.sum()), weighted
+
+
+def run_query(outdir, axes, cuts=(), datasets=None, workers=None, row_groups_per_task=4,
+              sum_genweights=None):
+    '''
+    Returns {histogram name: hist.Hist with a dataset axis} and scan
+    statistics. The MC datasets in `sum_genweights` are divided by their sum
+    of generator weights.
+    '''
+    import hist
+
+    start = time.perf_counter()
+    tasks, total, skipped = plan_tasks(outdir, datasets, cuts, row_groups_per_task)
+    sums = {}
+    rows_read = rows_passed = 0
+    unweighted = set()
+    function = functools.partial(fill_task, axes=axes, cuts=list(cuts))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for dataset, task_sums, nread, npassed, weighted in executor.map(function, tasks):
+            rows_read += nread
+            rows_passed += npassed
+            if not weighted:
+                unweighted.add(dataset)
+            target = sums.setdefault(dataset, {})
+            for name, (sumw, sumw2) in task_sums.items():
+                if name in target:
+                    target[name] = (target[name][0] + sumw, target[name][1] + sumw2)
+                else:
+                    target[name] = (sumw, sumw2)
+    names = sorted(sums)
+    scales = {dataset: 1. / sum_genweights[dataset] for dataset in names
+              if sum_genweights and sum_genweights.get(dataset)}
+    histograms = {}
+    for name, axis in axes.items():
+        h = hist.Hist(hist.axis.StrCategory(names, name="dataset"), hist_axis(axis),
+                      storage=hist.storage.Weight())
+        view = h.view(flow=True)
+        for i, dataset in enumerate(names):
+            if name in sums[dataset]:
+                scale = scales.get(dataset, 1.)
+                view.value[i] = sums[dataset][name][0] * scale
+                view.variance[i] = sums[dataset][name][1] * scale**2
+        histograms[name] = h
+    stats = {
+        "row_groups": total,
+        "row_groups_skipped": skipped,
+        "tasks": len(tasks),
+        "rows_read": rows_read,
+        "rows_passed": rows_passed,
+        "unweighted": sorted(unweighted),
+        "normalized": sorted(scales),
+        "seconds": time.perf_counter() - start,
+    }
+    return histograms, stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import pickle
+
+    from ColumnPruning import load_config
+
+    parser = argparse.ArgumentParser(description="Fill histograms from the saved Parquet ntuples")
+    parser.add_argument("--outdir", default="Saved_root_files", help="Ntuple directory")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_Wc.py"))
+    parser.add_argument("--hist", nargs="*", help="Histograms of the config to fill (default: all available)")
+    parser.add_argument("--cut", nargs="*", default=[], help="Cuts on ntuple columns, e.g. 'W_mass>55'")
+    parser.add_argument("--datasets", nargs="*", help="Only these datasets")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--row-groups-per-task", type=int, default=4)
+    parser.add_argument("--output-of", help="Output of the run that wrote the ntuples, for the sums of "
+                                            "generator weights of the MC datasets")
+    parser.add_argument("-o", "--output", default="ntuple_hists.pkl")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    axes = config_axes(cfg, args.hist)
+    if args.hist:
+        unknown = sorted(set(args.hist) - set(axes))
+        if unknown:
+            parser.error(f"Not 1D per-event histograms of the config: {', '.join(unknown)}")
+    # Only the histograms of columns that are in the ntuples
+    tasks, _, _ = plan_tasks(args.outdir, args.datasets)
+    if tasks:
+        available = set(pq.read_schema(tasks[0][1]).names)
+        missing = {name: ntuple_column(axis.field) for name, axis in axes.items()
+                   if ntuple_column(axis.field) not in available}
+        if missing and args.hist:
+            parser.error("No ntuple column for " + ", ".join(f"{n} ({f})" for n, f in sorted(missing.items())))
+        for name, field in sorted(missing.items()):
+            print(f"Skipped {name}: no ntuple column {field}")
+        axes = {name: axis for name, axis in axes.items() if name not in missing}
+    sum_genweights = None
+    if args.output_of:
+        from coffea.util import load
+
+        sum_genweights = {
+            dataset: value for dataset, value in load(args.output_of).get("sum_genweights", {}).items()
+            if cfg.filesets.get(dataset, {}).get("metadata", {}).get("isMC") == "True"
+        }
+    cuts = [parse_cut(c) for c in args.cut]
+    histograms, stats = run_query(args.outdir, axes, cuts, args.datasets, args.workers, args.row_groups_per_task,
+                                  sum_genweights)
+    with open(args.output, "wb") as f:
+        pickle.dump(histograms, f)
+    print(f"{len(histograms)} histograms in {stats['seconds']:.2f} s: "
+          f"{stats['rows_passed']}/{stats['rows_read']} rows passing, "
+          f"{stats['row_groups_skipped']}/{stats['row_groups']} row groups skipped")
+    if stats["unweighted"]:
+        print(f"No weight column, filled with unit weights: {', '.join(stats['unweighted'])}")
+    if args.output_of is None:
+        print("Not divided by the sums of generator weights, see --output-of")
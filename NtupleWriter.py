@@ -0,0 +1,357 @@
+'''
+Arrow-native writer for the per-event ntuples saved by the processor.
+
+Every chunk gets its own writer, named after the chunk (see `chunk_writer`),
+which writes one Parquet part per dataset. The writer is closed at the end
+of the chunk and the paths of its complete parts are returned in the chunk
+output, so nothing depends on the worker process surviving the chunk and a
+rerun overwrites the same parts. At the end of the job `compact` rewrites
+those per-chunk parts into a bounded number of files, with row groups of
+`row_group_size` rows and at most `max_rows_per_file` rows per file, and
+`write_metadata_file` collects the footers of the result into a
+consolidated `_metadata` file, so a whole dataset can be opened in one
+call, e.g.
+
+    pyarrow.dataset.parquet_dataset("Saved_root_files/<dataset>/_metadata")
+
+With `background=True` the conversion, compression and disk I/O run on a
+writer thread fed through a bounded queue, so that writing the ntuple of a
+chunk overlaps the filling of its histograms; the thread is joined when the
+writer of the chunk is closed.
+'''
+import glob
+import os
+import queue
+import threading
+import warnings
+
+import awkward as ak
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# On-disk types: kinematics do not need double precision and the object
+# counts always fit in 16 bits
+FLOAT_TYPE = pa.float32()
+COUNT_TYPE = pa.int16()
+
+NTUPLE_DEFAULTS = {
+    "outdir": "Saved_root_files",
+    "row_group_size": 100_000,
+    "compression": "zstd",
+    "compression_level": None,
+    "max_rows_per_file": 5_000_000,
+    "background": True,
+    "max_pending": 4,
+}
+
+# awkward 2 wraps the columns in Arrow extension types unless told not to
+ARROW_OPTIONS = {"extensionarray": False} if int(ak.__version__.split(".")[0]) >= 2 else {}
+
+
+def narrow_schema(schema):
+    fields = []
+    for field in schema:
+        if pa.types.is_floating(field.type):
+            type_ = FLOAT_TYPE
+        elif pa.types.is_integer(field.type):
+            type_ = COUNT_TYPE
+        else:
+            type_ = field.type
+        # Every column is nullable so that all the parts share one schema
+        fields.append(pa.field(field.name, type_, nullable=True))
+    return pa.schema(fields)
+
+
+def to_narrow_table(array):
+    table = ak.to_arrow_table(array, **ARROW_OPTIONS)
+    return table.cast(narrow_schema(table.schema))
+
+
+class _DatasetOutput:
+    def __init__(self, dataset, directory, schema):
+        self.dataset = dataset
+        self.directory = directory
+        self.schema = schema
+        self.buffer = []
+        self.buffered_rows = 0
+        self.file_rows = 0
+        self.nparts = 0
+        self.writer = None
+        self.path = None
+
+
+class ParquetNtupleWriter:
+    '''
+    Appends the saved variables of each chunk to a bounded number of Parquet
+    files per dataset. Rows are buffered until a full row group is available.
+    '''
+    def __init__(self, outdir="Saved_root_files", row_group_size=100_000,
+                 compression="zstd", compression_level=None,
+                 max_rows_per_file=5_000_000, tag=None):
+        self.outdir = outdir
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_rows_per_file = max_rows_per_file
+        # Part files are named part-<tag>-NNNN.parquet
+        self._tag = tag or str(os.getpid())
+        self._outputs = {}
+        # {dataset: [paths]} of the complete parts
+        self.parts = {}
+
+    def write(self, dataset, array):
+        self.write_table(dataset, to_narrow_table(array))
+
+    def write_table(self, dataset, table):
+        if len(table) == 0:
+            return
+        output = self._outputs.get(dataset)
+        if output is None:
+            directory = os.path.join(self.outdir, dataset)
+            os.makedirs(directory, exist_ok=True)
+            output = self._outputs[dataset] = _DatasetOutput(dataset, directory, table.schema)
+        output.buffer.append(table.cast(output.schema))
+        output.buffered_rows += len(table)
+        while output.buffered_rows >= self.row_group_size:
+            self._flush(output, self.row_group_size)
+
+    def _flush(self, output, nrows):
+        table = pa.concat_tables(output.buffer)
+        if output.writer is None:
+            output.path = os.path.join(
+                output.directory, f"part-{self._tag}-{output.nparts:04d}.parquet"
+            )
+            # Parts are written under a temporary name and only renamed once
+            # their footer is complete
+            output.writer = pq.ParquetWriter(
+                output.path + ".tmp", output.schema,
+                compression=self.compression,
+                compression_level=self.compression_level,
+            )
+        output.writer.write_table(table.slice(0, nrows), row_group_size=nrows)
+        rest = table.slice(nrows)
+        output.buffer = [rest] if len(rest) else []
+        output.buffered_rows = len(rest)
+        output.file_rows += nrows
+        if output.file_rows >= self.max_rows_per_file:
+            self._close_file(output)
+
+    def _close_file(self, output):
+        if output.writer is None:
+            return
+        output.writer.close()
+        os.replace(output.path + ".tmp", output.path)
+        self.parts.setdefault(output.dataset, []).append(output.path)
+        output.writer = None
+        output.file_rows = 0
+        output.nparts += 1
+
+    def flush(self):
+        for output in self._outputs.values():
+            if output.buffered_rows:
+                self._flush(output, output.buffered_rows)
+
+    def close(self):
+        '''
+        Writes the buffered rows and returns the complete parts.
+        '''
+        self.flush()
+        for output in self._outputs.values():
+            self._close_file(output)
+        self._outputs.clear()
+        return self.parts
+
+    def abort(self):
+        '''
+        Drops the buffered rows and the incomplete parts.
+        '''
+        for output in self._outputs.values():
+            if output.writer is not None:
+                output.writer.close()
+                os.remove(output.path + ".tmp")
+        self._outputs.clear()
+
+    @property
+    def datasets(self):
+        return list(self._outputs)
+
+
+_STOP = object()
+
+
+class AsyncNtupleWriter:
+    '''
+    Runs a ParquetNtupleWriter on a background thread. Chunks are handed
+    over through a queue holding at most `max_pending` of them, which
+    bounds the memory taken by output waiting to be written.
+
+    A failure on the writer thread is raised in the caller at the next
+    write, flush or close; everything queued after the failure is dropped.
+    The thread is always joined by `close` or `abort`, so a writer closed at
+    the end of every chunk reports its failures in that chunk.
+    '''
+    def __init__(self, writer, max_pending=4):
+        self._writer = writer
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self._run, name="ntuple-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self._error is None and not self._aborted:
+                    method, args = item
+                    getattr(self._writer, method)(*args)
+            except BaseException as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise RuntimeError(f"Ntuple writing failed: {err!r}") from err
+
+    def write(self, dataset, array):
+        self._raise_error()
+        # Blocks while the queue is full
+        self._queue.put(("write", (dataset, array)))
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.put(("flush", ()))
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(("close", ()))
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_error()
+        return self._writer.parts
+
+    def abort(self):
+        '''
+        Stops the thread, dropping what is still queued, and removes the
+        incomplete parts; a failure of the thread is not raised.
+        '''
+        self._aborted = True
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._error = None
+        self._writer.abort()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+
+def chunk_writer(tag, **options):
+    '''
+    Writer of the ntuples of one chunk, whose parts are named after `tag`
+    (e.g. the chunk key); `close()` returns {dataset: [part paths]}.
+    '''
+    options = {**NTUPLE_DEFAULTS, **options}
+    background = options.pop("background")
+    max_pending = options.pop("max_pending")
+    writer = ParquetNtupleWriter(tag=tag, **options)
+    if background:
+        writer = AsyncNtupleWriter(writer, max_pending=max_pending)
+    return writer
+
+
+def compact(outdir, parts, tag="job", **writer_options):
+    '''
+    Rewrites the per-chunk parts ({dataset: [paths]}) into the parts of one
+    writer named after `tag`, replacing a previous compaction, and removes
+    them; returns {dataset: [part paths]}.
+    '''
+    writer = ParquetNtupleWriter(outdir, tag=tag, **writer_options)
+    compacted = set()
+    for dataset, paths in sorted(parts.items()):
+        for path in glob.glob(os.path.join(outdir, dataset, f"part-{tag}-*.parquet")):
+            os.remove(path)
+        for path in sorted(paths):
+            # One row group at a time, the parts can be as large as a chunk
+            part = pq.ParquetFile(path)
+            for i in range(part.num_row_groups):
+                writer.write_table(dataset, part.read_row_group(i))
+            compacted.add(path)
+    parts = writer.close()
+    for path in compacted:
+        os.remove(path)
+    return parts
+
+
+def write_metadata_file(directory, parts=None):
+    '''
+    Collects the footers of the given parts of a dataset, all its complete
+    part-*.parquet files by default, into `_metadata` and
+    `_common_metadata`. Returns the number of parts included.
+    '''
+    metadata = None
+    schema = None
+    nparts = 0
+    if parts is None:
+        parts = glob.glob(os.path.join(directory, "part-*.parquet"))
+    for path in sorted(parts):
+        try:
+            part_metadata = pq.read_metadata(path)
+        except (OSError, pa.ArrowInvalid) as err:
+            warnings.warn(f"Skipping unreadable ntuple part {path}: {err}")
+            continue
+        part_metadata.set_file_path(os.path.relpath(path, directory))
+        if metadata is None:
+            metadata = part_metadata
+            schema = pq.read_schema(path)
+        else:
+            metadata.append_row_groups(part_metadata)
+        nparts += 1
+    if metadata is None:
+        return 0
+    pq.write_metadata(schema, os.path.join(directory, "_common_metadata"))
+    metadata.write_metadata_file(os.path.join(directory, "_metadata"))
+    return nparts
+
+
+def dataset_parts(directory):
+    '''
+    The parts of a dataset indexed in its `_metadata`, or all its complete
+    part-*.parquet files when it has not been consolidated.
+    '''
+    path = os.path.join(directory, "_metadata")
+    if not os.path.exists(path):
+        return sorted(glob.glob(os.path.join(directory, "part-*.parquet")))
+    metadata = pq.read_metadata(path)
+    paths = {metadata.row_group(i).column(0).file_path for i in range(metadata.num_row_groups)}
+    return sorted(os.path.join(directory, p) for p in paths)
+
+
+def consolidate(outdir="Saved_root_files", parts=None):
+    '''
+    Writes the `_metadata` of every dataset of `outdir`, or only of the
+    datasets of `parts` ({dataset: [paths]}) from those parts.
+    '''
+    if parts is not None:
+        for dataset, paths in sorted(parts.items()):
+            write_metadata_file(os.path.join(outdir, dataset), paths)
+        return
+    for directory in sorted(glob.glob(os.path.join(outdir, "*"))):
+        if os.path.isdir(directory):
+            write_metadata_file(directory)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write the consolidated _metadata of saved ntuples")
+    parser.add_argument("outdir", nargs="?", default="Saved_root_files")
+    args = parser.parse_args()
+    consolidate(args.outdir)
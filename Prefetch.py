@@ -0,0 +1,207 @@
+'''
+Read-ahead of the next chunks while the current one is processed.
+
+A `Prefetcher` pulls chunks from a source on a background thread and reads
+them in full: the baskets of all the (pruned) branches of a chunk are
+requested in one `tree.arrays` call, which uproot turns into vector reads
+(XRootD) or multi-range requests (HTTP) instead of one request per basket,
+and are decompressed on the same thread. Up to `depth` chunks are kept
+ready ahead of the consumer and no new fetch starts while the ready chunks
+hold more than `max_bytes`. The consumer builds NanoEvents from the
+preloaded arrays, so processing only waits for I/O when the fetch of the
+next chunk takes longer than the processing of the current one.
+
+The effect can be measured against a stand-in server with injected latency:
+
+    python Prefetch.py --latency-ms 100 --nchunks 8 --depth 0 1 2
+'''
+import threading
+import time
+from collections import deque
+
+import awkward as ak
+import uproot
+
+_END = object()
+
+
+def fetch_chunk(chunk, columns=None, open_options=None, replica_cache=None):
+    '''
+    Reads and decompresses the branches of a chunk; returns them with their
+    size in memory. With a `replica_cache` (see ReplicaCache) they are read
+    from the local replica of the chunk, fetched on a miss.
+    '''
+    if replica_cache is not None:
+        source = replica_cache.open(chunk.filename, columns, chunk.entrystart, chunk.entrystop,
+                                    chunk.treename)
+        # The replica only holds the entries of the chunk
+        entry_start, entry_stop = None, None
+    else:
+        source = uproot.open(chunk.filename, **(open_options or {}))
+        entry_start, entry_stop = chunk.entrystart, chunk.entrystop
+    with source as f:
+        tree = f[chunk.treename]
+        names = [c for c in columns if c in tree] if columns else tree.keys()
+        arrays = tree.arrays(names, entry_start=entry_start, entry_stop=entry_stop, how=dict)
+    return arrays, sum(ak.Array(array).nbytes for array in arrays.values())
+
+
+def events_from_arrays(chunk, arrays, metadata=None):
+    from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+    from coffea.nanoevents.mapping import SimplePreloadedColumnSource
+
+    source = SimplePreloadedColumnSource(
+        arrays, chunk.fileuuid or chunk.filename, chunk.nevents, object_path=f"/{chunk.treename}"
+    )
+    return NanoEventsFactory.from_preloaded(
+        source, entry_start=0, entry_stop=chunk.nevents, schemaclass=NanoAODSchema, metadata=metadata,
+    ).events()
+
+
+class Prefetcher:
+    '''
+    Iterates over (chunk, arrays or exception, fetch seconds) in the order
+    the chunks are returned by `next_chunk()`, which returns None at the end.
+    '''
+    def __init__(self, next_chunk, columns=None, depth=1, max_bytes=2 * 2**30, open_options=None,
+                 replica_cache=None):
+        self.next_chunk = next_chunk
+        self.columns = columns
+        self.depth = max(depth, 1)
+        self.max_bytes = max_bytes
+        self.open_options = open_options
+        self.replica_cache = replica_cache
+        self._ready = deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.wait_seconds = 0.
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def _full(self):
+        return len(self._ready) >= self.depth or (self._ready and self._bytes >= self.max_bytes)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._full() and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            chunk = self.next_chunk()
+            if chunk is None:
+                item, nbytes = _END, 0
+            else:
+                start = time.perf_counter()
+                try:
+                    arrays, nbytes = fetch_chunk(chunk, self.columns, self.open_options, self.replica_cache)
+                except Exception as err:
+                    arrays, nbytes = err, 0
+                item = (chunk, arrays, time.perf_counter() - start)
+            with self._cond:
+                self._ready.append((item, nbytes))
+                self._bytes += nbytes
+                self._cond.notify_all()
+            if item is _END:
+                return
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                item, nbytes = self._ready.popleft()
+                self._bytes -= nbytes
+                self._cond.notify_all()
+            self.wait_seconds += time.perf_counter() - start
+            if item is _END:
+                return
+            yield item
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    @property
+    def buffered_bytes(self):
+        return self._bytes
+
+
+def _demo_process(events, work_seconds):
+    # Touches the jets like the object preselection, then simulates the rest
+    ak.sum(events.Jet.pt, axis=1)
+    time.sleep(work_seconds)
+
+
+def run_demo(directory, nchunks, nevents, depth, latency, bandwidth, work_seconds):
+    '''
+    Wall time of processing the chunks served by a stand-in server, with the
+    time spent fetching and the time the processing waited for data.
+    '''
+    from ChunkPlanner import Chunk
+    from StandInServer import start_server
+
+    server = start_server(directory, latency=latency, bandwidth=bandwidth)
+    try:
+        url = f"{server.url}/synthetic.root"
+        chunks = deque(
+            Chunk("synthetic", url, i * nevents, (i + 1) * nevents, 0.) for i in range(nchunks)
+        )
+        start = time.perf_counter()
+        fetch = process = wait = 0.
+        if depth == 0:
+            for chunk in chunks:
+                t0 = time.perf_counter()
+                arrays, _ = fetch_chunk(chunk)
+                t1 = time.perf_counter()
+                _demo_process(events_from_arrays(chunk, arrays), work_seconds)
+                fetch += t1 - t0
+                process += time.perf_counter() - t1
+            wait = fetch
+        else:
+            prefetcher = Prefetcher(lambda: chunks.popleft() if chunks else None, depth=depth)
+            for chunk, arrays, seconds in prefetcher:
+                t0 = time.perf_counter()
+                _demo_process(events_from_arrays(chunk, arrays), work_seconds)
+                fetch += seconds
+                process += time.perf_counter() - t0
+            wait = prefetcher.wait_seconds
+        return {
+            "wall": time.perf_counter() - start,
+            "fetch": fetch,
+            "process": process,
+            "waited": wait,
+            "requests": server.stats["requests"],
+        }
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tempfile
+
+    from SyntheticEvents import write_nanoaod
+
+    parser = argparse.ArgumentParser(description="Measure how much fetch time the read-ahead hides")
+    parser.add_argument("--nchunks", type=int, default=8)
+    parser.add_argument("--nevents", type=int, default=50_000, help="Events per chunk")
+    parser.add_argument("--depth", type=int, nargs="+", default=[0, 1, 2], help="0 reads sequentially")
+    parser.add_argument("--latency-ms", type=float, default=100.)
+    parser.add_argument("--bandwidth-mbps", type=float, default=50.)
+    parser.add_argument("--work-ms", type=float, default=500., help="Simulated processing time per chunk")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_nanoaod(os.path.join(directory, "synthetic.root"), args.nchunks * args.nevents,
+                      compression=uproot.ZSTD(4))
+        print(f"{'depth':>5} {'wall s':>8} {'fetch s':>8} {'process s':>10} {'waited s':>9} {'requests':>9}")
+        for depth in args.depth:
+            r = run_demo(directory, args.nchunks, args.nevents, depth, args.latency_ms / 1000,
+                         args.bandwidth_mbps * 2**20, args.work_ms / 1000)
+            print(f"{depth:5d} {r['wall']:8.2f} {r['fetch']:8.2f} {r['process']:10.2f} "
+                  f"{r['waited']:9.2f} {r['requests']:9d}")
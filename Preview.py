@@ -0,0 +1,241 @@
+'''
+Stratified preview of a fraction of every dataset.
+
+`PreviewChunker` cuts the files of each dataset into small chunks and keeps
+a seeded systematic sample of them: the chunks of a dataset are ordered file
+by file and one is taken every 1/fraction chunks from a random offset, so
+the selection is spread evenly over the files of every sample, in
+proportion to their entries, and is the same for the same seed. The chunks
+carry the fraction in their metadata ("preview").
+
+The processor records the entries and the generator weights processed per
+dataset. The MC histograms are normalized with the sum of the generator
+weights processed, so that lumi x XS is spread over the fraction of the
+sample actually read; for skimmed inputs, normalized with the sum of the
+original sample, that sum is scaled by the fraction of the generator weight
+of the skim processed. Data histograms hold the processed fraction of the
+data. The fractions and the statistical uncertainty of every histogram are
+stored in output["preview"]:
+
+    python LocalRunner.py config_Wc.py --preview 0.01 --seed 1 -o preview.coffea
+    python Preview.py preview.coffea
+'''
+import math
+import random
+
+import awkward as ak
+import numpy as np
+
+from ChunkPlanner import EntryCounts, interleave, plan_chunks
+from DatasetCatalog import file_site
+
+
+def select_chunks(chunks, fraction, seed=0, key=""):
+    '''
+    Systematic sample of about `fraction` of `chunks`, at least one.
+    '''
+    if not chunks:
+        return []
+    nselected = max(1, round(len(chunks) * fraction))
+    step = len(chunks) / nselected
+    offset = random.Random(f"{seed}:{key}").uniform(0, step)
+    return [chunks[int(offset + i * step)] for i in range(nselected)]
+
+
+class PreviewChunker:
+    '''
+    The preview chunks of `datasets`, in the interface of AdaptiveChunker.
+    '''
+    def __init__(self, datasets, entry_counts=None, fraction=0.01, seed=0, chunk_entries=20_000,
+                 treename="Events"):
+        if not 0 < fraction <= 1:
+            raise ValueError(f"The preview fraction must be in (0, 1], got {fraction}")
+        entry_counts = entry_counts or EntryCounts(treename=treename)
+        per_dataset = {}
+        self.planned = {}
+        for dataset, content in datasets.items():
+            metadata = {**content["metadata"], "preview": str(fraction)}
+            # A single dataset keeps the file order
+            chunks = plan_chunks({dataset: {**content, "metadata": metadata}}, entry_counts,
+                                 max_entries=chunk_entries, treename=treename)
+            per_dataset[dataset] = select_chunks(chunks, fraction, seed, dataset)
+            self.planned[dataset] = sum(chunk.nevents for chunk in chunks)
+        self._todo = interleave(per_dataset)
+        self._summary = {
+            dataset: {
+                "chunks": len(chunks),
+                "entries": sum(chunk.nevents for chunk in chunks),
+                "files": len({chunk.filename for chunk in chunks}),
+                "total_files": len(datasets[dataset]["files"]),
+                "total_entries": self.planned[dataset],
+            }
+            for dataset, chunks in per_dataset.items()
+        }
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.take()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def take(self, site=None):
+        for i, chunk in enumerate(self._todo):
+            if site is None or file_site(chunk.filename) == site:
+                return self._todo.pop(i)
+        return None
+
+    def remaining_by_site(self):
+        remaining = {}
+        for chunk in self._todo:
+            site = file_site(chunk.filename)
+            remaining[site] = remaining.get(site, 0) + chunk.nevents
+        return remaining
+
+    @property
+    def remaining(self):
+        return sum(chunk.nevents for chunk in self._todo)
+
+    def summary(self):
+        return self._summary
+
+
+def preview_summary(events):
+    '''
+    Accumulator entry of a preview chunk: counts add up across chunks.
+    '''
+    return {
+        "nevents": len(events),
+        "sum_genweights": float(ak.sum(events.genWeight)) if "genWeight" in events.fields else 0.,
+    }
+
+
+def preview_fractions(filesets, previewed):
+    '''
+    Fractions of the entries and of the generator weight processed for every
+    dataset; the latter only where the dataset JSON gives the total.
+    '''
+    fractions = {}
+    for dataset, processed in previewed.items():
+        metadata = filesets[dataset]["metadata"]
+        total = float(metadata.get("nevents", 0))
+        entries = processed["nevents"] / total if total else None
+        # Skims hold the sum of their own events next to the original one
+        key = "sum_genweights_skimmed" if metadata.get("skim") == "True" else "sum_genweights"
+        genweights = float(metadata[key]) if metadata.get(key) else 0.
+        fractions[dataset] = {
+            "entries": entries,
+            "genweights": processed["sum_genweights"] / genweights if genweights else None,
+        }
+    return fractions
+
+
+def preview_sum_genweights(filesets, previewed):
+    '''
+    Normalization of the previewed skimmed MC datasets: the sum of generator
+    weights of the original sample times the fraction processed.
+    '''
+    normalization = {}
+    for dataset, fraction in preview_fractions(filesets, previewed).items():
+        metadata = filesets[dataset]["metadata"]
+        if metadata.get("skim") != "True" or metadata.get("isMC") != "True" or "sum_genweights" not in metadata:
+            continue
+        # Older skims without their own sum fall back to the fraction of entries
+        scale = fraction["genweights"] if fraction["genweights"] is not None else fraction["entries"]
+        if scale:
+            normalization[dataset] = float(metadata["sum_genweights"]) * scale
+    return normalization
+
+
+def statistical_uncertainty(histogram):
+    '''
+    Yield, its statistical uncertainty, the effective number of entries and
+    the largest relative uncertainty of a filled bin.
+    '''
+    values = histogram.values(flow=True)
+    variances = histogram.variances(flow=True)
+    if variances is None:
+        variances = values
+    total, variance = float(values.sum()), float(variances.sum())
+    filled = values > 0
+    return {
+        "yield": total,
+        "stat": math.sqrt(variance),
+        "rel_stat": math.sqrt(variance) / abs(total) if total else None,
+        "n_eff": total**2 / variance if variance > 0 else 0.,
+        "max_bin_rel_stat": (
+            float(np.max(np.sqrt(variances[filled]) / values[filled])) if filled.any() else None
+        ),
+    }
+
+
+def histogram_uncertainties(variables):
+    '''
+    Statistical uncertainty of the nominal variation of every histogram,
+    per sample and category.
+    '''
+    report = {}
+    for name, samples in variables.items():
+        for sample, histogram in samples.items():
+            names = [axis.name for axis in histogram.axes]
+            if "cat" not in names:
+                continue
+            for category in histogram.axes["cat"]:
+                selection = {"cat": category}
+                if "variation" in names:
+                    selection["variation"] = "nominal"
+                report.setdefault(name, {}).setdefault(sample, {})[category] = (
+                    statistical_uncertainty(histogram[selection])
+                )
+    return report
+
+
+def preview_report(accumulator, filesets):
+    fractions = preview_fractions(filesets, accumulator["preview"])
+    return {
+        "datasets": {
+            dataset: {**processed, "fraction": fractions[dataset]}
+            for dataset, processed in accumulator["preview"].items()
+        },
+        "uncertainty": histogram_uncertainties(accumulator.get("variables", {})),
+    }
+
+
+def _format(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from coffea.util import load
+
+    parser = argparse.ArgumentParser(description="Print the fractions and uncertainties of a preview output")
+    parser.add_argument("output", help="Output of a preview run")
+    parser.add_argument("--category", help="Only this category")
+    parser.add_argument("--max-rel-stat", type=float, default=None,
+                        help="Only the histograms with a larger relative uncertainty")
+    args = parser.parse_args()
+
+    report = load(args.output)["preview"]
+    print(f"{'dataset':<40} {'events':>12} {'entries %':>10} {'genweight %':>12}")
+    for dataset, r in report["datasets"].items():
+        entries, genweights = r["fraction"]["entries"], r["fraction"]["genweights"]
+        print(f"{dataset:<40} {r['nevents']:12d} {_format(entries and 100 * entries, '10.3f'):>10} "
+              f"{_format(genweights and 100 * genweights, '12.3f'):>12}")
+    print()
+    print(f"{'histogram':<24} {'sample':<20} {'category':<20} {'yield':>12} {'stat':>10} "
+          f"{'rel %':>7} {'n_eff':>10} {'max bin %':>10}")
+    for name, samples in report["uncertainty"].items():
+        for sample, categories in samples.items():
+            for category, u in categories.items():
+                if args.category and category != args.category:
+                    continue
+                if args.max_rel_stat is not None and (u["rel_stat"] or 0) <= args.max_rel_stat:
+                    continue
+                rel = u["rel_stat"] and 100 * u["rel_stat"]
+                max_bin = u["max_bin_rel_stat"] and 100 * u["max_bin_rel_stat"]
+                print(f"{name:<24} {sample:<20} {category:<20} {u['yield']:12.4g} {u['stat']:10.3g} "
+                      f"{_format(rel, '7.2f'):>7} {u['n_eff']:10.1f} {_format(max_bin, '10.2f'):>10}")
@@ -0,0 +1,263 @@
+'''
+Local on-disk replica cache for the remote NanoAOD files of the datasets.
+
+Replicas are partial: for a given file, entry range and (pruned) branch set
+only the requested branches are fetched and written to a small local ROOT
+file, so only the baskets that are actually needed land on disk. Entries
+are content-addressed by the UUID of the source ROOT file rather than by its
+URL, so the same file served by two storage sites is cached once. The UUID
+and the number of entries of every URL are kept in the index (NanoAOD files
+are never rewritten in place), so a hit does not open the remote file.
+
+The index lives in an SQLite database inside the cache directory, which
+makes the cache safe to share between the worker processes of a node. When
+the total size exceeds the budget, the least recently used replicas are
+evicted. `open` maps the replica as soon as it is found, so a replica
+evicted by another worker afterwards stays readable.
+
+LocalRunner reads its chunks through the cache with `replica_cache=...`
+(the options of `ReplicaCache`), in both the process pool (`open_events`)
+and the prefetching workers (Prefetch.fetch_chunk).
+'''
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+import awkward as ak
+import uproot
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+
+COMPRESSIONS = {
+    "lz4": lambda: uproot.LZ4(1),
+    "zstd": lambda: uproot.ZSTD(4),
+    "zlib": lambda: uproot.ZLIB(4),
+    "lzma": lambda: uproot.LZMA(4),
+}
+
+# Name of the option of uproot.open choosing the source class in uproot 4 and 5
+HANDLER_OPTION = "handler" if int(uproot.__version__.split(".")[0]) >= 5 else "file_handler"
+
+STATS = ("hits", "misses", "bytes_hit", "bytes_fetched", "evictions", "bytes_evicted")
+
+
+def write_events_tree(path, arrays, treepath="Events", compression=None):
+    '''
+    Writes NanoAOD-like branches to a ROOT file. Jagged branches sharing a
+    collection prefix are zipped so that uproot writes them with a single
+    `n<Collection>` counter, as in NanoAOD; jagged branches without a prefix
+    (LHEPdfWeight, PSWeight, ...) get their own counter. Raises if any of
+    `arrays` is not in the written tree.
+    '''
+    jagged = defaultdict(dict)
+    single = {}
+    for name, array in arrays.items():
+        if array.ndim == 1:
+            continue
+        if "_" in name:
+            collection, field = name.split("_", 1)
+            jagged[collection][field] = array
+        else:
+            single[name] = array
+    # The counters are regenerated by uproot from the jagged branches
+    flat = {
+        name: array for name, array in arrays.items()
+        if array.ndim == 1 and not (name.startswith("n") and (name[1:] in jagged or name[1:] in single))
+    }
+    branches = {**flat, **single}
+    for collection, fields in jagged.items():
+        branches[collection] = ak.zip(fields)
+    with uproot.recreate(path, compression=compression) as f:
+        f[treepath] = branches
+    with uproot.open(path) as f:
+        written = set(f[treepath].keys())
+    missing = sorted(set(arrays) - written)
+    if missing:
+        raise ValueError(f"Branches not written to {path}: {', '.join(missing)}")
+
+
+class ReplicaCache:
+    def __init__(self, cache_dir="replica_cache", max_bytes=50 * 2**30, compression="lz4"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.compression = compression
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self._db_path = os.path.join(cache_dir, "index.sqlite")
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS replicas ("
+                "key TEXT PRIMARY KEY, url TEXT, size INTEGER, last_access REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "url TEXT, treepath TEXT, uuid TEXT, num_entries INTEGER, PRIMARY KEY (url, treepath))"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            db.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)", [(s,) for s in STATS])
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # The connection itself only commits on exit: it is closed here
+        db = sqlite3.connect(self._db_path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _object_path(self, key):
+        return os.path.join(self.cache_dir, "objects", key[:2], key + ".root")
+
+    @staticmethod
+    def key(uuid, treepath, columns, entry_start, entry_stop):
+        # None stands for all the branches
+        columns = sorted(columns) if columns is not None else None
+        identity = json.dumps([str(uuid), treepath, columns, entry_start, entry_stop])
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def _count(self, db, **increments):
+        db.executemany(
+            "UPDATE stats SET value = value + ? WHERE name = ?",
+            [(value, name) for name, value in increments.items()],
+        )
+
+    def _source(self, url, treepath):
+        '''
+        UUID and number of entries of `url`, read from the remote file once.
+        '''
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT uuid, num_entries FROM sources WHERE url = ? AND treepath = ?", (url, treepath)
+            ).fetchone()
+        if row is not None:
+            return row
+        with uproot.open(url) as f:
+            row = (str(f.file.uuid), f[treepath].num_entries)
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (url, treepath, *row))
+        return row
+
+    def fetch(self, url, columns, entry_start=None, entry_stop=None, treepath="Events"):
+        '''
+        Returns the path of a local ROOT file holding `columns` (all the
+        branches if None) for the requested entry range of `url`, fetching
+        it on a miss.
+        '''
+        uuid, num_entries = self._source(url, treepath)
+        entry_start = 0 if entry_start is None else entry_start
+        entry_stop = num_entries if entry_stop is None else min(entry_stop, num_entries)
+        key = self.key(uuid, treepath, columns, entry_start, entry_stop)
+        path = self._object_path(key)
+        with self._connect() as db:
+            row = db.execute("SELECT size FROM replicas WHERE key = ?", (key,)).fetchone()
+            if row is not None and os.path.exists(path):
+                db.execute("UPDATE replicas SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._count(db, hits=1, bytes_hit=row[0])
+                return path
+        with uproot.open(url) as f:
+            arrays = f[treepath].arrays(
+                filter_name=list(columns) if columns is not None else None,
+                entry_start=entry_start,
+                entry_stop=entry_stop,
+                how=dict,
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        write_events_tree(tmp_path, arrays, treepath, self._compression())
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO replicas VALUES (?, ?, ?, ?)",
+                (key, url, size, time.time()),
+            )
+            self._count(db, misses=1, bytes_fetched=size)
+            self._evict(db, keep=key)
+        return path
+
+    def _compression(self):
+        if self.compression is None:
+            return None
+        return COMPRESSIONS[self.compression]()
+
+    def _evict(self, db, keep=None):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM replicas").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT key, size FROM replicas ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._object_path(key))
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM replicas WHERE key = ?", (key,))
+            self._count(db, evictions=1, bytes_evicted=size)
+            total -= size
+
+    def open(self, url, columns, entry_start=None, entry_stop=None, treepath="Events"):
+        '''
+        The replica of the entry range of `url` opened with uproot; its
+        entries start at 0.
+        '''
+        for _ in range(3):
+            path = self.fetch(url, columns, entry_start, entry_stop, treepath)
+            try:
+                # Mapped now, the replica can be evicted while the events are read
+                return uproot.open(path, **{HANDLER_OPTION: uproot.MemmapSource})
+            except FileNotFoundError:
+                # Evicted by another worker in between: fetched again
+                continue
+        raise RuntimeError(f"The replica of {url} was evicted before it could be opened: "
+                           f"the cache budget is too small for the workers")
+
+    def open_events(self, url, columns, entry_start=None, entry_stop=None,
+                    treepath="Events", metadata=None):
+        source = self.open(url, columns, entry_start, entry_stop, treepath)
+        return NanoEventsFactory.from_root(
+            source, treepath=treepath, schemaclass=NanoAODSchema, metadata=metadata,
+        ).events()
+
+    def report(self):
+        with self._connect() as db:
+            stats = dict(db.execute("SELECT name, value FROM stats").fetchall())
+            nfiles, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM replicas").fetchone()
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "replicas": nfiles,
+            "size": size,
+            "max_bytes": self.max_bytes,
+            "hit_rate": stats["hits"] / lookups if lookups else 0.,
+        })
+        return stats
+
+    def clear(self):
+        with self._connect() as db:
+            for (key,) in db.execute("SELECT key FROM replicas").fetchall():
+                try:
+                    os.remove(self._object_path(key))
+                except FileNotFoundError:
+                    pass
+            db.execute("DELETE FROM replicas")
+            db.execute("DELETE FROM sources")
+            db.execute("UPDATE stats SET value = 0")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report on the local replica cache")
+    parser.add_argument("cache_dir", nargs="?", default="replica_cache")
+    parser.add_argument("--clear", action="store_true")
+    args = parser.parse_args()
+    cache = ReplicaCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    for name, value in cache.report().items():
+        print(f"{name:>14}: {value}")
@@ -0,0 +1,155 @@
+'''
+Persistent per-chunk results for checkpointing and resuming a job.
+
+Every processed chunk is saved under a key built from its file, tree and
+entry range, in a directory named after the hash of the configuration (the
+config file, the local modules it imports, i.e. the processor and the cuts,
+and the parameters). On a restart the processor returns the saved
+accumulator of completed chunks without reading them. The ntuple table of
+each chunk is saved with its accumulator and all the ntuples are exported
+in a fixed order at the end of the job, so a killed and restarted run gives
+the same output as an uninterrupted one.
+
+Results saved with another configuration hash are never used; they are
+reported when the store is opened and can be removed with
+
+    python ResultStore.py .checkpoints --prune <config hash>
+'''
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import warnings
+
+from NtupleWriter import ParquetNtupleWriter
+
+
+def config_hash(config_path, parameters=None):
+    directory = os.path.dirname(os.path.abspath(config_path))
+    sources = {os.path.abspath(config_path)}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.endswith(".py") and os.path.dirname(os.path.abspath(path)) == directory:
+            sources.add(os.path.abspath(path))
+    digest = hashlib.sha256()
+    for path in sorted(sources):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    if parameters is not None:
+        try:
+            from omegaconf import OmegaConf
+            text = OmegaConf.to_yaml(parameters)
+        except (ImportError, ValueError):
+            text = repr(parameters)
+        digest.update(text.encode())
+    return digest.hexdigest()[:16]
+
+
+def chunk_key(metadata):
+    text = ":".join(str(metadata.get(field)) for field in ("filename", "treename", "entrystart", "entrystop"))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+class ResultStore:
+    def __init__(self, directory, config_hash):
+        self.directory = directory
+        self.config_hash = config_hash
+        self.path = os.path.join(directory, config_hash)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.pkl")
+
+    def load(self, key):
+        try:
+            with open(self._entry_path(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError) as err:
+            warnings.warn(f"Ignoring unreadable checkpoint {key}: {err}")
+            return None
+
+    def save(self, key, metadata, accumulator, ntuple=None):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            "metadata": {field: metadata.get(field) for field in ("dataset", "filename", "treename",
+                                                                   "entrystart", "entrystop")},
+            "accumulator": accumulator,
+            "ntuple": ntuple,
+        }
+        # A chunk killed while saving leaves only a temporary file behind
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def __len__(self):
+        return len(glob.glob(os.path.join(self.path, "*", "*.pkl")))
+
+    def stale(self):
+        '''
+        Number of saved chunks per configuration hash other than the current one.
+        '''
+        counts = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, "*"))):
+            name = os.path.basename(path)
+            if os.path.isdir(path) and name != self.config_hash:
+                counts[name] = len(glob.glob(os.path.join(path, "*", "*.pkl")))
+        return counts
+
+    def warn_stale(self):
+        stale = self.stale()
+        if stale:
+            warnings.warn(
+                f"{sum(stale.values())} checkpointed chunks in {self.directory} belong to other "
+                f"configurations ({', '.join(stale)}) and will be recomputed"
+            )
+
+    def prune(self, config_hashes=None):
+        for name in self.stale() if config_hashes is None else config_hashes:
+            shutil.rmtree(os.path.join(self.directory, name))
+
+    def export_ntuples(self, chunks, outdir="Saved_root_files", **writer_options):
+        '''
+        Writes the ntuples of the given {dataset: {key: nevents}} chunks,
+        ordered by file and entry range, replacing a previous export; returns
+        {dataset: [part paths]}.
+        '''
+        writer = ParquetNtupleWriter(outdir, tag="checkpoint", **writer_options)
+        for dataset, keys in sorted(chunks.items()):
+            for path in glob.glob(os.path.join(outdir, dataset, "part-checkpoint-*.parquet")):
+                os.remove(path)
+            entries = []
+            for key in keys:
+                entry = self.load(key)
+                if entry is None:
+                    raise RuntimeError(f"Checkpoint {key} of {dataset} is missing from {self.path}")
+                entries.append(entry)
+            entries.sort(key=lambda e: (e["metadata"]["filename"], e["metadata"]["entrystart"]))
+            for entry in entries:
+                if entry["ntuple"] is not None:
+                    writer.write_table(dataset, entry["ntuple"])
+        return writer.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or prune the checkpointed chunk results")
+    parser.add_argument("directory", nargs="?", default=".checkpoints")
+    parser.add_argument("--prune", nargs="*", metavar="HASH",
+                        help="Remove the results of these configuration hashes")
+    args = parser.parse_args()
+
+    store = ResultStore(args.directory, config_hash="")
+    for name, count in store.stale().items():
+        print(f"{name}: {count} chunks")
+    if args.prune:
+        store.prune(args.prune)
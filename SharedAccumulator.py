@@ -0,0 +1,220 @@
+'''
+Merging of the chunk outputs in shared memory, on the workers.
+
+Sending every chunk output to the parent costs a pickle round trip of all
+its histograms and one Python merge per chunk, which makes the parent the
+bottleneck with many workers. With a `SlabAccumulator` every worker adds the
+bin contents of the histograms of each chunk into its own slabs, one shared
+memory block per histogram written by that worker only, so no locking is
+needed. The small accumulators (cutflows, sums of weights) are merged on the
+worker. At the end each worker sends the names and shapes of its slabs, the
+axes of the histograms and its small accumulators; the parent maps the
+slabs, builds the histograms from them and merges one output per worker.
+
+Histograms with a storage other than Double, Int64 or Weight (e.g. Mean),
+or whose axes grow from chunk to chunk, are merged as small accumulators.
+
+Slabs are named `<prefix>_<n>` in the order they are made, so the parent can
+free those of a worker that died before describing them (`unlink_prefix`).
+'''
+import os
+import secrets
+from multiprocessing import shared_memory
+
+import numpy as np
+
+WEIGHT_FIELDS = ("value", "variance")
+
+
+def slab_fields(value):
+    '''
+    Storage fields of a histogram that can be summed in a slab: () for a
+    single-valued storage, None if `value` cannot be kept in a slab.
+    '''
+    import boost_histogram as bh
+
+    if not isinstance(value, bh.Histogram):
+        return None
+    names = value.view(flow=True).dtype.names
+    if names is None:
+        return ()
+    return WEIGHT_FIELDS if set(names) == set(WEIGHT_FIELDS) else None
+
+
+def split_histograms(output, path=()):
+    '''
+    Returns the histograms of a nested output, keyed by their path, and the
+    output without them.
+    '''
+    histograms, rest = {}, {}
+    for key, value in output.items():
+        if isinstance(value, dict):
+            inner, inner_rest = split_histograms(value, path + (key,))
+            histograms.update(inner)
+            if inner_rest:
+                rest[key] = inner_rest
+        elif slab_fields(value) is not None:
+            histograms[path + (key,)] = value
+        else:
+            rest[key] = value
+    return histograms, rest
+
+
+def _set_path(output, path, value):
+    for key in path[:-1]:
+        output = output.setdefault(key, {})
+    output[path[-1]] = value
+
+
+def _get_path(output, path):
+    for key in path:
+        if not isinstance(output, dict) or key not in output:
+            return None
+        output = output[key]
+    return output
+
+
+class _Slab:
+    def __init__(self, name, histogram):
+        view = histogram.view(flow=True)
+        self.fields = slab_fields(histogram)
+        self.axes = histogram.axes
+        dtype = view.dtype[self.fields[0]] if self.fields else view.dtype
+        shape = ((len(self.fields),) if self.fields else ()) + view.shape
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1)
+        )
+        self.array = np.ndarray(shape, dtype, buffer=self.memory.buf)
+        self.array[...] = 0
+        self.template = (type(histogram), tuple(histogram.axes), histogram.storage_type,
+                         dict(histogram.__dict__))
+
+    def add(self, histogram):
+        view = histogram.view(flow=True)
+        if self.fields:
+            for i, field in enumerate(self.fields):
+                self.array[i] += getattr(view, field)
+        else:
+            self.array += view
+
+    def describe(self):
+        return self.memory.name, self.array.shape, self.array.dtype.str, self.fields, self.template
+
+
+class SlabAccumulator:
+    def __init__(self, prefix=None):
+        self.prefix = prefix or f"slab{os.getpid()}_{secrets.token_hex(4)}"
+        self.slabs = {}
+        self.rest = None
+        self.nchunks = 0
+
+    def add(self, output):
+        from coffea.processor import accumulate
+
+        histograms, rest = split_histograms(output)
+        for path, histogram in histograms.items():
+            slab = self.slabs.get(path)
+            if slab is None:
+                slab = self.slabs[path] = _Slab(f"{self.prefix}_{len(self.slabs)}", histogram)
+            elif histogram.axes != slab.axes:
+                # Grown categories: merged the usual way
+                _set_path(rest, path, histogram)
+                continue
+            slab.add(histogram)
+        self.rest = rest if self.rest is None else accumulate([self.rest, rest])
+        self.nchunks += 1
+
+    def describe(self):
+        '''
+        What the parent needs to read the slabs: a few hundred bytes per
+        histogram and the small accumulators.
+        '''
+        return {
+            "slabs": {path: slab.describe() for path, slab in self.slabs.items()},
+            "rest": self.rest,
+            "nchunks": self.nchunks,
+            "prefix": self.prefix,
+        }
+
+    def close(self, unlink=False):
+        for slab in self.slabs.values():
+            # The buffer cannot be closed while an array maps it
+            slab.array = None
+            slab.memory.close()
+            if unlink:
+                slab.memory.unlink()
+        self.slabs = {}
+
+
+def read_slabs(description, unlink=True):
+    '''
+    The output of one worker, with its histograms built from the slabs,
+    which are freed unless `unlink` is False.
+    '''
+    from coffea.processor import accumulate
+
+    output = dict(description["rest"] or {})
+    for path, (name, shape, dtype, fields, template) in description["slabs"].items():
+        cls, axes, storage_type, metadata = template
+        histogram = cls(*axes, storage=storage_type())
+        histogram.__dict__.update(metadata)
+        memory = shared_memory.SharedMemory(name=name)
+        try:
+            array = np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+            view = histogram.view(flow=True)
+            if fields:
+                for i, field in enumerate(fields):
+                    setattr(view, field, array[i])
+            else:
+                view[...] = array
+            del array
+        finally:
+            memory.close()
+            if unlink:
+                memory.unlink()
+        # The chunks whose axes had grown were merged with the small accumulators
+        grown = _get_path(output, path)
+        if grown is not None:
+            histogram = accumulate([histogram, grown])
+        _set_path(output, path, histogram)
+    return output
+
+
+def _unlink(name):
+    try:
+        memory = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    memory.close()
+    memory.unlink()
+    return True
+
+
+def free_slabs(descriptions):
+    '''
+    Frees the described slabs that have not been read and freed yet.
+    '''
+    for description in descriptions:
+        for name, *_ in description["slabs"].values():
+            _unlink(name)
+
+
+def unlink_prefix(prefix):
+    '''
+    Frees the slabs of the accumulator with `prefix`, as long as none of
+    them has been freed; returns how many were.
+    '''
+    count = 0
+    while _unlink(f"{prefix}_{count}"):
+        count += 1
+    return count
+
+
+def reduce_slabs(descriptions, unlink=True):
+    '''
+    Merges the outputs of all the workers; None if there is none.
+    '''
+    from coffea.processor import accumulate
+
+    outputs = [read_slabs(description, unlink) for description in descriptions if description["nchunks"]]
+    return accumulate(outputs) if outputs else None
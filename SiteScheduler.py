@@ -0,0 +1,226 @@
+'''
+Site-affinity scheduling of chunks over storage endpoints.
+
+The work is grouped by the endpoint serving each file (the netloc of its
+URL, see DatasetCatalog.file_site). Every worker is given a preferred site,
+in proportion to the entries left at each site, and takes its chunks from
+there. Each endpoint serves at most `max_streams` chunks at a time, so a
+single xrootd door is never flooded by all the workers. A worker whose site
+is at its stream limit steals a chunk from another site only if it would
+otherwise sit idle; a worker whose site has no work left moves to the site
+with the most work per worker.
+
+    python SiteScheduler.py --sites 20:400 150:50 --workers 6
+'''
+import threading
+from collections import Counter
+
+from DatasetCatalog import file_site
+
+
+class SiteScheduler:
+    def __init__(self, chunker, max_streams=None, default_streams=4):
+        self.chunker = chunker
+        self.max_streams = dict(max_streams or {})
+        self.default_streams = default_streams
+        self.active = Counter()
+        self.preference = {}
+        self.dispatched = Counter()
+        self.steals = 0
+        self.moves = 0
+        self._lock = threading.Lock()
+
+    def limit(self, site):
+        return self.max_streams.get(site, self.default_streams)
+
+    def _best_site(self, exclude=()):
+        # Most remaining entries per preferring worker, among sites with work
+        remaining = self.chunker.remaining_by_site()
+        workers = Counter(self.preference.values())
+        sites = [s for s, n in remaining.items() if n > 0 and s not in exclude]
+        if not sites:
+            return None
+        return max(sites, key=lambda s: remaining[s] / (workers[s] + 1))
+
+    def assign(self, workers):
+        with self._lock:
+            for worker in workers:
+                self.preference[worker] = None
+            for worker in workers:
+                # Sites already having as many workers as streams come last
+                site = self._best_site(exclude=[
+                    s for s, n in Counter(self.preference.values()).items()
+                    if s is not None and n >= self.limit(s)
+                ]) or self._best_site()
+                self.preference[worker] = site
+        return dict(self.preference)
+
+    def _take(self, site):
+        if site is None or self.active[site] >= self.limit(site):
+            return None
+        chunk = self.chunker.take(site)
+        if chunk is not None:
+            self.active[site] += 1
+            self.dispatched[site] += 1
+        return chunk
+
+    def next_chunk(self, worker):
+        '''
+        Next chunk for `worker`, or None if every site with work left is at
+        its stream limit (or there is no work left).
+        '''
+        with self._lock:
+            site = self.preference.get(worker)
+            remaining = self.chunker.remaining_by_site()
+            if not remaining.get(site):
+                site = self._best_site()
+                if site is None:
+                    return None
+                if self.preference.get(worker) is not None:
+                    self.moves += 1
+                self.preference[worker] = site
+            chunk = self._take(site)
+            if chunk is not None:
+                return chunk
+            # Idle otherwise: steal from the site with the most free streams
+            others = sorted(
+                (s for s, n in remaining.items() if n > 0 and s != site),
+                key=lambda s: self.active[s] - self.limit(s),
+            )
+            for other in others:
+                chunk = self._take(other)
+                if chunk is not None:
+                    self.steals += 1
+                    return chunk
+            return None
+
+    def finished(self):
+        with self._lock:
+            return not any(self.chunker.remaining_by_site().values())
+
+    def release(self, chunk):
+        with self._lock:
+            self.active[file_site(chunk.filename)] -= 1
+
+    def summary(self):
+        return {
+            "dispatched": dict(self.dispatched),
+            "steals": self.steals,
+            "moves": self.moves,
+            "preference": dict(self.preference),
+        }
+
+
+def run_demo(sites, workers, nchunks_per_site, nevents, max_streams, work_seconds, affinity=True):
+    '''
+    Threads standing in for workers read chunks from stand-in endpoints with
+    the given (latency, bandwidth) or (latency, bandwidth, door streams)
+    profiles (see StandInServer); returns the wall time, the largest number
+    of concurrent streams seen per endpoint and the scheduler summary.
+    '''
+    import os
+    import tempfile
+    import time
+
+    import uproot
+
+    from AdaptiveChunks import AdaptiveChunker, ChunkSizeController
+    from Prefetch import fetch_chunk
+    from StandInServer import start_server
+    from SyntheticEvents import write_nanoaod
+
+    class _Counts:
+        def __init__(self, entries):
+            self.entries = entries
+
+        def scan(self, files):
+            return {f: {"entries": self.entries, "uuid": ""} for f in files}
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Not ZSTD: uproot 4 shares one zstd decompressor between the threads
+        write_nanoaod(os.path.join(directory, "synthetic.root"), nchunks_per_site * nevents,
+                      compression=uproot.ZLIB(4))
+        servers = [start_server(directory, latency=latency, bandwidth=bandwidth,
+                                streams=streams[0] if streams else None)
+                   for latency, bandwidth, *streams in sites]
+        try:
+            datasets = {
+                f"site{i}": {"metadata": {}, "files": [f"{server.url}/synthetic.root"]}
+                for i, server in enumerate(servers)
+            }
+            controller = ChunkSizeController(initial_entries=nevents, min_entries=1)
+            chunker = AdaptiveChunker(datasets, _Counts(nchunks_per_site * nevents), controller)
+            scheduler = SiteScheduler(chunker, {file_site(server.url): max_streams for server in servers})
+            scheduler.assign(range(workers))
+            concurrency = Counter()
+            peak = Counter()
+            dispatched = Counter()
+            lock = threading.Lock()
+
+            def next_chunk(index):
+                if affinity:
+                    return scheduler.next_chunk(index)
+                # Baseline: chunks in plan order, whatever their endpoint
+                with lock:
+                    return chunker.take()
+
+            def worker(index):
+                while True:
+                    chunk = next_chunk(index)
+                    if chunk is None:
+                        if not affinity or scheduler.finished():
+                            return
+                        time.sleep(0.01)
+                        continue
+                    site = file_site(chunk.filename)
+                    with lock:
+                        dispatched[site] += 1
+                        concurrency[site] += 1
+                        peak[site] = max(peak[site], concurrency[site])
+                    fetch_chunk(chunk)
+                    with lock:
+                        concurrency[site] -= 1
+                    if affinity:
+                        scheduler.release(chunk)
+                    time.sleep(work_seconds)
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return {
+                **scheduler.summary(),
+                "wall": time.perf_counter() - start,
+                "peak_streams": dict(peak),
+                "dispatched": dict(dispatched),
+            }
+        finally:
+            for server in servers:
+                server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulate site-affinity scheduling against stand-in endpoints")
+    parser.add_argument("--sites", nargs="+", default=["20:400", "150:50"],
+                        help="Endpoint profiles as latency_ms:bandwidth_MBps[:door_streams]")
+    parser.add_argument("--workers", type=int, default=6)
+    parser.add_argument("--nchunks", type=int, default=8, help="Chunks per site")
+    parser.add_argument("--nevents", type=int, default=20_000, help="Events per chunk")
+    parser.add_argument("--max-streams", type=int, default=2, help="Concurrent streams per endpoint")
+    parser.add_argument("--work-ms", type=float, default=200.)
+    args = parser.parse_args()
+
+    profiles = []
+    for site in args.sites:
+        latency, bandwidth, *streams = site.split(":")
+        profiles.append((float(latency) / 1000, float(bandwidth) * 2**20, *map(int, streams)))
+    for affinity in (False, True):
+        r = run_demo(profiles, args.workers, args.nchunks, args.nevents, args.max_streams,
+                     args.work_ms / 1000, affinity)
+        label = "site affinity" if affinity else "no affinity"
+        print(f"{label:>14}: {r['wall']:.2f} s, peak streams {r['peak_streams']}, "
+              f"dispatched {r['dispatched']}, steals {r['steals']}, moves {r['moves']}")
@@ -0,0 +1,126 @@
+'''
+Skim-to-local mode: persists the events passing the trigger skim and the
+preselection as reduced NanoAOD.
+
+For every chunk the surviving events are written, restricted to the pruned
+branch set of ColumnPruning, to a compressed local ROOT file. At the end of
+the job a dataset JSON in the same format as the input ones is generated,
+with the local files and the sum of the generator weights of the original
+(unskimmed) events, which is used to normalize the skimmed datasets:
+
+    "jsons": [f"{localdir}/skims/skim_datasets.json"]
+'''
+import json
+import os
+import warnings
+
+import awkward as ak
+import uproot
+
+from ReplicaCache import COMPRESSIONS, write_events_tree
+
+SKIM_DEFAULTS = {
+    "outdir": "skims",
+    "columns": None,
+    "compression": "zstd",
+}
+
+
+def skim_path(outdir, metadata):
+    stem = os.path.splitext(os.path.basename(metadata["filename"]))[0]
+    return os.path.join(
+        outdir, metadata["dataset"], f"{stem}_{metadata['entrystart']}_{metadata['entrystop']}.root"
+    )
+
+
+def write_skim_chunk(outdir, metadata, columns, index, compression="zstd"):
+    '''
+    Writes the events at `index` of the chunk described by `metadata`.
+    The branches are read from the input file again, as stored on disk;
+    every requested column is written, or a warning names those the input
+    file does not have (e.g. the generator branches in data).
+    '''
+    treename = metadata.get("treename") or "Events"
+    tree = uproot.open(metadata["filename"])[treename]
+    absent = [c for c in columns if c not in tree]
+    if absent:
+        warnings.warn(f"Skim of {metadata['dataset']}: {metadata['filename']} has no {', '.join(absent)}")
+    arrays = tree.arrays(
+        [c for c in columns if c in tree], entry_start=metadata["entrystart"],
+        entry_stop=metadata["entrystop"], how=dict,
+    )
+    path = skim_path(outdir, metadata)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Complete files only: the ROOT file is written under a temporary name.
+    # Raises if a branch read from the input is not in the skim
+    tmp = f"{path}.{os.getpid()}.tmp"
+    write_events_tree(tmp, {name: array[index] for name, array in arrays.items()}, treename,
+                      compression=COMPRESSIONS[compression]())
+    os.replace(tmp, path)
+    return path
+
+
+def skim_summary(events, index, path):
+    '''
+    Accumulator entry of a skimmed chunk: counts add up across chunks.
+    '''
+    has_genweight = "genWeight" in events.fields
+    return {
+        "nevents": len(events),
+        "nskimmed": len(index),
+        "sum_genweights": float(ak.sum(events.genWeight)) if has_genweight else 0.,
+        "sum_genweights_skimmed": float(ak.sum(events.genWeight[index])) if has_genweight else 0.,
+        "files": {path: len(index)} if path is not None else {},
+    }
+
+
+def write_skim_datasets(outdir, filesets, skimmed, filename="skim_datasets.json"):
+    '''
+    Dataset JSON of the skimmed files, in the format of the input JSONs.
+    '''
+    datasets = {}
+    for dataset, summary in sorted(skimmed.items()):
+        files = sorted(path for path, n in summary["files"].items() if n > 0)
+        metadata = dict(filesets[dataset]["metadata"])
+        metadata.update({
+            "nevents": str(summary["nskimmed"]),
+            "size": str(sum(os.path.getsize(path) for path in files)),
+            "skim": "True",
+            "nevents_unskimmed": str(summary["nevents"]),
+        })
+        if metadata.get("isMC") == "True":
+            metadata["sum_genweights"] = str(summary["sum_genweights"])
+            metadata["sum_genweights_skimmed"] = str(summary["sum_genweights_skimmed"])
+        datasets[dataset] = {"metadata": metadata, "files": [os.path.abspath(path) for path in files]}
+    path = os.path.join(outdir, filename)
+    os.makedirs(outdir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(datasets, f, indent=4)
+    return path
+
+
+def skim_sum_genweights(filesets):
+    '''
+    Original sums of generator weights of the skimmed datasets.
+    '''
+    return {
+        dataset: float(fileset["metadata"]["sum_genweights"])
+        for dataset, fileset in filesets.items()
+        if fileset["metadata"].get("skim") == "True" and "sum_genweights" in fileset["metadata"]
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize a generated skim dataset JSON")
+    parser.add_argument("json", nargs="?", default="skims/skim_datasets.json")
+    args = parser.parse_args()
+
+    with open(args.json) as f:
+        datasets = json.load(f)
+    for dataset, content in datasets.items():
+        metadata = content["metadata"]
+        kept = int(metadata["nevents"]) / max(int(metadata["nevents_unskimmed"]), 1)
+        print(f"{dataset}: {len(content['files'])} files, {metadata['nevents']} events "
+              f"({100 * kept:.1f}%), {int(metadata['size']) / 2**20:.1f} MB")
@@ -0,0 +1,188 @@
+'''
+Local stand-in for a remote storage endpoint.
+
+Serves the files of a directory over HTTP with byte-range support (single
+and multipart ranges, as issued by uproot's HTTP source for vector reads)
+and injects a fixed latency per request and a bandwidth limit, shared by all
+the concurrent streams of the server as on a real storage door, so that the
+effect of remote I/O on a job can be reproduced on a single machine:
+
+    python StandInServer.py /tmp/nanoaod --port 8001 --latency-ms 80 --bandwidth-mbps 200
+
+With `streams=N` the server behaves like an overloaded door: every stream
+beyond N sending at the same time costs the others a fraction `overload`
+of the bandwidth (seeks between the streams, server threads competing).
+
+The files are then read as http://127.0.0.1:8001/<name>.root.
+'''
+import os
+import re
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE_PATTERN = re.compile(r"(\d*)-(\d*)")
+BOUNDARY = "STANDINBOUNDARY"
+BLOCK = 1 << 16
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    # Set per server class by `make_server`
+    latency = 0.
+    bandwidth = None
+    streams = None
+    overload = 0.
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _ranges(self, size):
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes="):
+            return None
+        ranges = []
+        for part in header[len("bytes="):].split(","):
+            start, stop = RANGE_PATTERN.match(part.strip()).groups()
+            if start == "":
+                start, stop = size - int(stop), size - 1
+            else:
+                start, stop = int(start), int(stop) if stop else size - 1
+            ranges.append((start, min(stop, size - 1)))
+        return ranges
+
+    def _throttle(self, nbytes):
+        # Token bucket of the server holding at most one block: the tokens
+        # can go negative, so the streams wait for the bandwidth in turn
+        stats = self.stats
+        with stats["lock"]:
+            now = time.monotonic()
+            tokens = min(BLOCK, stats["tokens"] + (now - stats["refilled"]) * self.bandwidth)
+            if self.streams:
+                nbytes *= 1 + self.overload * max(stats["active"] - self.streams, 0)
+            tokens -= nbytes
+            stats["tokens"] = tokens
+            stats["refilled"] = now
+        if tokens < 0:
+            time.sleep(-tokens / self.bandwidth)
+
+    def _send(self, body):
+        with self.stats["lock"]:
+            self.stats["active"] += 1
+        try:
+            # Throttled in blocks so that concurrent requests share the bandwidth
+            for start in range(0, len(body), BLOCK):
+                data = body[start:start + BLOCK]
+                if self.bandwidth:
+                    self._throttle(len(data))
+                self.wfile.write(data)
+        finally:
+            with self.stats["lock"]:
+                self.stats["active"] -= 1
+                self.stats["bytes"] += len(body)
+
+    def _serve(self, head):
+        time.sleep(self.latency)
+        with self.stats["lock"]:
+            self.stats["requests"] += 1
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        ranges = self._ranges(size)
+        if ranges is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if not head:
+                with open(path, "rb") as f:
+                    self._send(f.read())
+            return
+        with open(path, "rb") as f:
+            parts = []
+            for start, stop in ranges:
+                f.seek(start)
+                parts.append((start, stop, f.read(stop - start + 1)))
+        self.send_response(206)
+        if len(parts) == 1:
+            start, stop, body = parts[0]
+            self.send_header("Content-Range", f"bytes {start}-{stop}/{size}")
+        else:
+            chunks = []
+            for start, stop, data in parts:
+                chunks.append(
+                    f"--{BOUNDARY}\r\nContent-Type: application/octet-stream\r\n"
+                    f"Content-Range: bytes {start}-{stop}/{size}\r\n\r\n".encode() + data + b"\r\n"
+                )
+            body = b"".join(chunks) + f"--{BOUNDARY}--\r\n".encode()
+            self.send_header("Content-Type", f"multipart/byteranges; boundary={BOUNDARY}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self._send(body)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+
+def make_server(directory, port=0, latency=0., bandwidth=None, host="127.0.0.1", streams=None, overload=0.5):
+    '''
+    HTTP server for `directory` with `latency` seconds per request and at
+    most `bandwidth` bytes/s over all its streams, less when more than
+    `streams` of them send at once. Port 0 picks a free port.
+    '''
+    handler = type("StandInHandler", (_Handler,), {
+        "latency": latency,
+        "bandwidth": bandwidth,
+        "streams": streams,
+        "overload": overload,
+        "stats": {"requests": 0, "bytes": 0, "active": 0, "lock": threading.Lock(),
+                  "tokens": BLOCK, "refilled": time.monotonic()},
+    })
+
+    def factory(*args, **kwargs):
+        return handler(*args, directory=directory, **kwargs)
+
+    server = ThreadingHTTPServer((host, port), factory)
+    server.daemon_threads = True
+    server.stats = handler.stats
+    server.url = f"http://{host}:{server.server_address[1]}"
+    return server
+
+
+def start_server(directory, port=0, latency=0., bandwidth=None, streams=None, overload=0.5):
+    '''
+    Starts a stand-in server on a background thread and returns it;
+    `server.shutdown()` stops it.
+    '''
+    server = make_server(directory, port, latency, bandwidth, streams=streams, overload=overload)
+    threading.Thread(target=server.serve_forever, name="stand-in-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a directory as a slow remote endpoint")
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=50.)
+    parser.add_argument("--bandwidth-mbps", type=float, default=None, help="Bandwidth of the endpoint in MB/s")
+    parser.add_argument("--streams", type=int, default=None, help="Streams served at full bandwidth")
+    parser.add_argument("--overload", type=float, default=0.5,
+                        help="Fraction of the bandwidth lost per stream beyond --streams")
+    args = parser.parse_args()
+
+    server = make_server(args.directory, args.port, args.latency_ms / 1000,
+                         args.bandwidth_mbps * 2**20 if args.bandwidth_mbps else None,
+                         streams=args.streams, overload=args.overload)
+    print(f"Serving {args.directory} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
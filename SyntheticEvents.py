@@ -0,0 +1,196 @@
+'''
+Seeded generator of NanoAOD-like events for benchmarks and validation.
+
+The Muon, Electron, Jet and PuppiMET collections carry the fields read by
+the processor, by the object preselection and by the cuts in
+CommonSelectors, with Poisson multiplicities, falling pT spectra sorted in
+each event and jet-muon cross references. The branches can be written to a
+ROOT file and read back as regular NanoEvents:
+
+    events = synthetic_events(100_000, seed=1)
+'''
+import os
+import tempfile
+
+import awkward as ak
+import numpy as np
+
+DEFAULT_MULTIPLICITIES = {"Muon": 1.5, "Electron": 1.0, "Jet": 4.5}
+
+
+def _jagged(rng, counts, fields):
+    total = int(counts.sum())
+    return {name: ak.unflatten(make(rng, total), counts) for name, make in fields.items()}
+
+
+def _pt(scale, minimum):
+    def make(rng, n):
+        return (minimum + rng.exponential(scale, n)).astype(np.float32)
+    return make
+
+
+def _uniform(low, high):
+    def make(rng, n):
+        return rng.uniform(low, high, n).astype(np.float32)
+    return make
+
+
+def _bool(p):
+    def make(rng, n):
+        return rng.random(n) < p
+    return make
+
+
+def _int(values, p=None):
+    def make(rng, n):
+        return rng.choice(np.asarray(values, dtype=np.int32), n, p=p)
+    return make
+
+
+def _abs_normal(sigma):
+    def make(rng, n):
+        return np.abs(rng.normal(0, sigma, n)).astype(np.float32)
+    return make
+
+
+def _signed_normal(sigma):
+    def make(rng, n):
+        return rng.normal(0, sigma, n).astype(np.float32)
+    return make
+
+
+def _charge(rng, n):
+    return rng.choice(np.array([-1, 1], dtype=np.int32), n)
+
+
+MUON_FIELDS = {
+    "pt": _pt(20., 3.),
+    "eta": _uniform(-2.4, 2.4),
+    "phi": _uniform(-np.pi, np.pi),
+    "mass": lambda rng, n: np.full(n, 0.10566, dtype=np.float32),
+    "charge": _charge,
+    "dxy": _signed_normal(0.01),
+    "dz": _signed_normal(0.02),
+    "sip3d": _abs_normal(2.),
+    "pfRelIso03_all": _abs_normal(0.2),
+    "pfRelIso04_all": _abs_normal(0.2),
+    "miniPFRelIso_all": _abs_normal(0.2),
+    "looseId": _bool(0.95),
+    "mediumId": _bool(0.85),
+    "tightId": _bool(0.75),
+    "softId": _bool(0.8),
+}
+
+ELECTRON_FIELDS = {
+    "pt": _pt(20., 5.),
+    "eta": _uniform(-2.5, 2.5),
+    "phi": _uniform(-np.pi, np.pi),
+    "mass": lambda rng, n: np.full(n, 0.000511, dtype=np.float32),
+    "charge": _charge,
+    "deltaEtaSC": _signed_normal(0.01),
+    "dxy": _signed_normal(0.01),
+    "dz": _signed_normal(0.02),
+    "sip3d": _abs_normal(2.),
+    "pfRelIso03_all": _abs_normal(0.2),
+    "mvaFall17V2Iso_WP80": _bool(0.7),
+    "mvaFall17V2Iso_WP90": _bool(0.8),
+    "mvaFall17V2noIso_WP80": _bool(0.75),
+    "cutBased": _int([0, 1, 2, 3, 4]),
+}
+
+JET_FIELDS = {
+    "pt": _pt(35., 15.),
+    "eta": _uniform(-4.7, 4.7),
+    "phi": _uniform(-np.pi, np.pi),
+    "mass": _pt(5., 1.),
+    "jetId": _int([0, 2, 6], p=[0.05, 0.15, 0.8]),
+    "puId": _int([0, 4, 6, 7], p=[0.1, 0.1, 0.1, 0.7]),
+    "btagDeepFlavB": _uniform(0., 1.),
+    "btagDeepFlavCvL": _uniform(0., 1.),
+    "btagDeepFlavCvB": _uniform(0., 1.),
+    "muEF": _uniform(0., 1.),
+    "neEmEF": _uniform(0., 0.5),
+    "chEmEF": _uniform(0., 0.5),
+    "hadronFlavour": _int([0, 4, 5], p=[0.8, 0.1, 0.1]),
+    "partonFlavour": _int([0, 1, 2, 3, 4, 5, 21]),
+}
+
+
+def _object_indices(rng, parent_counts, child_counts, probability):
+    # Index of a random object of the event, or -1, for every child object
+    nparent = np.repeat(parent_counts, child_counts)
+    index = np.floor(rng.random(nparent.size) * nparent).astype(np.int32)
+    linked = (nparent > 0) & (rng.random(nparent.size) < probability)
+    return ak.unflatten(np.where(linked, index, -1).astype(np.int32), child_counts)
+
+
+def generate_branches(nevents, seed=0, multiplicities=None):
+    '''
+    Returns {branch name: array} with NanoAOD naming for `nevents` events.
+    '''
+    rng = np.random.default_rng(seed)
+    mult = {**DEFAULT_MULTIPLICITIES, **(multiplicities or {})}
+    counts = {name: rng.poisson(mean, nevents) for name, mean in mult.items()}
+
+    branches = {
+        "run": np.ones(nevents, dtype=np.uint32),
+        "luminosityBlock": (np.arange(nevents) // 1000 + 1).astype(np.uint32),
+        "event": np.arange(1, nevents + 1, dtype=np.uint64),
+        "genWeight": np.where(rng.random(nevents) < 0.9, 1., -1.).astype(np.float32),
+        "Pileup_nTrueInt": rng.uniform(0, 80, nevents).astype(np.float32),
+        "Pileup_nPU": rng.poisson(30, nevents).astype(np.int32),
+        "PV_npvsGood": rng.poisson(30, nevents).astype(np.int32),
+        "fixedGridRhoFastjetAll": rng.uniform(0, 50, nevents).astype(np.float32),
+        "PuppiMET_pt": (rng.exponential(40., nevents)).astype(np.float32),
+        "PuppiMET_phi": rng.uniform(-np.pi, np.pi, nevents).astype(np.float32),
+        "PuppiMET_sumEt": rng.uniform(100, 2000, nevents).astype(np.float32),
+        "MET_pt": (rng.exponential(40., nevents)).astype(np.float32),
+        "MET_phi": rng.uniform(-np.pi, np.pi, nevents).astype(np.float32),
+        "HLT_IsoMu27": rng.random(nevents) < 0.6,
+        "HLT_IsoMu24": rng.random(nevents) < 0.6,
+        "HLT_Ele32_WPTight_Gsf": rng.random(nevents) < 0.4,
+    }
+    for name, fields in (("Muon", MUON_FIELDS), ("Electron", ELECTRON_FIELDS), ("Jet", JET_FIELDS)):
+        collection = _jagged(rng, counts[name], fields)
+        # NanoAOD collections are pT ordered
+        collection["pt"] = ak.sort(collection["pt"], axis=1, ascending=False)
+        branches.update({f"{name}_{field}": array for field, array in collection.items()})
+
+    for lepton, prefix in (("Muon", "muon"), ("Electron", "electron")):
+        branches[f"Jet_{prefix}Idx1"] = _object_indices(rng, counts[lepton], counts["Jet"], 0.3)
+        branches[f"Jet_{prefix}Idx2"] = _object_indices(rng, counts[lepton], counts["Jet"], 0.05)
+    branches["Muon_jetIdx"] = _object_indices(rng, counts["Jet"], counts["Muon"], 0.5)
+    branches["Electron_jetIdx"] = _object_indices(rng, counts["Jet"], counts["Electron"], 0.5)
+    return branches
+
+
+def write_nanoaod(path, nevents, seed=0, multiplicities=None, compression=None):
+    from ReplicaCache import write_events_tree
+    write_events_tree(path, generate_branches(nevents, seed, multiplicities), compression=compression)
+    return path
+
+
+def synthetic_events(nevents, seed=0, multiplicities=None, metadata=None, directory=None):
+    '''
+    Generated events read back through NanoEvents, with the metadata of a
+    regular chunk.
+    '''
+    from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+
+    directory = directory or tempfile.mkdtemp(prefix="synthetic_nanoaod_")
+    path = os.path.join(directory, f"synthetic_{nevents}_{seed}.root")
+    if not os.path.exists(path):
+        write_nanoaod(path, nevents, seed, multiplicities)
+    metadata = {
+        "dataset": "synthetic",
+        "sample": "synthetic",
+        "year": "2017",
+        "isMC": True,
+        "filename": path,
+        "entrystart": 0,
+        "entrystop": nevents,
+        **(metadata or {}),
+    }
+    return NanoEventsFactory.from_root(
+        path, schemaclass=NanoAODSchema, metadata=metadata
+    ).events()
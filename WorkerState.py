@@ -0,0 +1,43 @@
+'''
+State kept for the life of a worker process.
+
+The modules of this repository are shipped to the workers by value with
+cloudpickle (see config_Wc.py), so they are executed again for every
+unpickled processor, i.e. for every chunk: their globals and the attributes
+of the pickled objects start afresh each time. What has to persist between
+the chunks of a worker (dense correction tables, cut statistics) is kept in
+a registry on the `sys` module, which is always imported by reference, keyed
+by the process id so that a forked worker starts from its own state.
+
+    service = worker_state("CorrectionLUT.correction_service", CorrectionService)
+'''
+import os
+import sys
+
+_REGISTRY = "_btv_worker_state"
+
+
+def worker_state(key, factory):
+    '''
+    The object stored under `key` in this process, made by `factory` on
+    first use.
+    '''
+    registry = sys.__dict__.setdefault(_REGISTRY, {})
+    pid = os.getpid()
+    if pid not in registry:
+        # What a forked worker inherited belongs to its parent
+        registry.clear()
+        registry[pid] = {}
+    state = registry[pid]
+    if key not in state:
+        state[key] = factory()
+    return state[key]
+
+
+def clear_worker_state(prefix=""):
+    '''
+    Drops the state of this process whose key starts with `prefix`.
+    '''
+    state = sys.__dict__.get(_REGISTRY, {}).get(os.getpid(), {})
+    for key in [key for key in state if key.startswith(prefix)]:
+        del state[key]
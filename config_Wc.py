@@ -11,7 +11,38 @@ from CoffeaBTVProcessor import CommBTVBaseProcessor
 import CommonSelectors
 from CommonSelectors import *
 
+import BatchFill
+import ChunkCache
+import ResultStore
+import SkimWriter
+from ResultStore import config_hash
+import CorrectionLUT
+from CorrectionLUT import correction_weights
+from ColumnPruning import load_columns
+from DatasetCatalog import filtered_jsons
+import NtupleWriter
+import Preview
+import Instrumentation
+import FastKernels
+import CutChain
+import CutBits
+import CutScan
+import WorkerState
+
 import cloudpickle
+cloudpickle.register_pickle_by_value(BatchFill)
+cloudpickle.register_pickle_by_value(ChunkCache)
+cloudpickle.register_pickle_by_value(CorrectionLUT)
+cloudpickle.register_pickle_by_value(ResultStore)
+cloudpickle.register_pickle_by_value(SkimWriter)
+cloudpickle.register_pickle_by_value(NtupleWriter)
+cloudpickle.register_pickle_by_value(Preview)
+cloudpickle.register_pickle_by_value(Instrumentation)
+cloudpickle.register_pickle_by_value(FastKernels)
+cloudpickle.register_pickle_by_value(CutChain)
+cloudpickle.register_pickle_by_value(CutBits)
+cloudpickle.register_pickle_by_value(CutScan)
+cloudpickle.register_pickle_by_value(WorkerState)
 cloudpickle.register_pickle_by_value(CoffeaBTVProcessor)
 cloudpickle.register_pickle_by_value(CommonSelectors)
 
@@ -30,24 +61,67 @@ parameters = defaults.merge_parameters_from_files(default_parameters,
 
 
 
+# Add the W+c category with all its N-1 variants and the cutflows, derived
+# from the cut bits (evaluates every W+c cut on the full chunk)
+study_nminus1 = False
+# Fill the W+c threshold grid of wc_threshold_scan in output["cut_scans"]
+scan_thresholds = False
+# Pileup and muon ID/ISO weights from per-worker dense lookup tables
+correction_luts = False
+# Save every chunk result and skip the completed chunks when the job is rerun
+checkpoint = False
+# Write the events passing the skim and preselection, restricted to the branches
+# of pruned_columns.json, with a dataset JSON to run on them afterwards
+skim_to_local = False
+
+dataset_jsons = [f"{localdir}/Run2UL2017_MC_VJets.json",
+                 f"{localdir}/datasets/Run2UL2017_DATA.json"]
+dataset_filter = {
+    "samples": ["WJetsToLNu_MLM","DATA_DoubleMuon",
+        
+    ],
+    "samples_exclude" : [],
+    "year": ["2017"]
+}
+
 cfg = Configurator(
     parameters = parameters,
     datasets = {
-        "jsons": [f"{localdir}/Run2UL2017_MC_VJets.json",
-                  f"{localdir}/datasets/Run2UL2017_DATA.json"],
-        
-        
-        "filter" : {
-            "samples": ["WJetsToLNu_MLM","DATA_DoubleMuon",
-                
-            ],
-            "samples_exclude" : [],
-            "year": ["2017"]
-            
-        }
+        # Only the selected datasets of the compiled catalog are parsed
+        "jsons": filtered_jsons(dataset_jsons, dataset_filter, cache_dir=f"{localdir}/.catalog"),
+        "filter" : dataset_filter,
     },
 
     workflow = CommBTVBaseProcessor,
+    workflow_options = {
+        "ntuples": {
+            "outdir": "Saved_root_files",
+            "row_group_size": 100_000,
+            "compression": "zstd",
+            "max_rows_per_file": 5_000_000,
+            "background": True,
+            "max_pending": 4,
+        },
+        # True: per-stage summary and timeline, "summary": summary only
+        "instrumentation": False,
+        # Numba kernels for MuonSelBTV, dilepveto, mtw and dilepmass
+        "fast_kernels": False,
+        # Sequential/N-1 cutflows of these cut bitmasks in output["bit_cutflow"],
+        # nominal variation with the nominal inclusive weights
+        "bit_cutflows": [wc_bits] if study_nminus1 else [],
+        "scans": [wc_threshold_scan] if scan_thresholds else [],
+        # Fill the histograms grouped by collection with one bincount per group
+        "batched_fill": False,
+        "checkpoint": {
+            "directory": f"{localdir}/.checkpoints",
+            "config_hash": config_hash(__file__, parameters),
+        } if checkpoint else None,
+        "skim": {
+            "outdir": f"{localdir}/skims",
+            "columns": load_columns(f"{localdir}/pruned_columns.json"),
+            "compression": "zstd",
+        } if skim_to_local else None,
+    },
 
     #skim = [get_HLTsel(primaryDatasets=["SingleMuon","SingleEle"])],
     skim = [get_HLTsel(primaryDatasets=["SingleMuon"])],
@@ -55,14 +129,17 @@ cfg = Configurator(
     preselections = [ll_2j],
     categories = {
         "baseline_Wc": [passthrough],
-        "Added cuts Wc": [req_mtw, ptratiobtv, req_dilepveto, mujetselbtv, reqmuon, jetselbtv, reqsoftmuon, req_dilepmass ],
+        # req_mtw, ptratiobtv, req_dilepveto, mujetselbtv, reqmuon, jetselbtv, reqsoftmuon, req_dilepmass
+        "Added cuts Wc": [added_cuts_wc],
+        **(wc_bits.nminus1_categories("Wc") if study_nminus1 else {}),
     },
 
     weights = {
         "common": {
             "inclusive": ["signOf_genWeight","lumi","XS",
-                          "pileup",
-                          "sf_mu_id","sf_mu_iso",
+                          *(correction_weights(parameters) if correction_luts else
+                            ["pileup",
+                             "sf_mu_id","sf_mu_iso"]),
                           ],
             "bycategory" : {
                 
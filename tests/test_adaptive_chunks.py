@@ -0,0 +1,46 @@
+from AdaptiveChunks import ChunkSizeController, current_rss, peak_rss
+
+MB = 2**20
+
+
+def controller():
+    return ChunkSizeController(memory_budget=1000 * MB, initial_entries=10_000, min_entries=1_000,
+                               max_entries=1_000_000, headroom=0.8, max_growth=2., smoothing=1.)
+
+
+def test_rss_helpers():
+    assert 0 < current_rss() <= peak_rss()
+
+
+def test_memory_cap():
+    c = controller()
+    # 10 kB/event over a 200 MB baseline: grows by at most max_growth at a time
+    assert c.update("DY", 10_000, 1., 200 * MB + 10_000 * 10 * 1024, 200 * MB) == 20_000
+    assert c.update("DY", 20_000, 2., 200 * MB + 20_000 * 10 * 1024, 200 * MB) == 40_000
+    # The size settles where the peak fits in the headroom of the budget
+    for _ in range(10):
+        entries = c.entries("DY")
+        c.update("DY", entries, entries / 10_000, 200 * MB + entries * 10 * 1024, 200 * MB)
+    assert c.entries("DY") == int((0.8 * 1000 - 200) * MB / (10 * 1024))
+    # A chunk over the budget shrinks the next ones at once, below the growth limit
+    entries = c.entries("DY")
+    assert c.update("DY", entries, entries / 10_000, 1200 * MB, 200 * MB) < entries
+    assert 200 * MB + c.entries("DY") * 1000 * MB / entries <= 0.8 * 1000 * MB + 1
+    assert "over the budget" in c.history[-1]["reason"]
+    # Other datasets keep their own size
+    assert c.entries("TTbar") == 10_000
+
+
+def test_no_room():
+    c = controller()
+    assert c.update("DY", 10_000, 1., 900 * MB, 850 * MB) == 1_000
+    assert "leaves no room" in c.history[-1]["reason"]
+
+
+def test_rollback_after_throughput_drop():
+    c = controller()
+    assert c.update("DY", 10_000, 1., 100 * MB, 50 * MB) == 20_000
+    # The larger chunks run at half the rate: back to the previous size
+    assert c.update("DY", 20_000, 4., 150 * MB, 50 * MB) == 10_000
+    assert "throughput fell" in c.history[-1]["reason"]
+    assert [(h["from"], h["to"]) for h in c.history] == [(10_000, 20_000), (20_000, 10_000)]
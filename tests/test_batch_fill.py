@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+hist = pytest.importorskip("hist")
+
+from BatchFill import BatchedHistFiller
+
+CATEGORIES = ["baseline", "Wc"]
+
+
+def hist_conf(coll, field, bins=10, start=0., stop=100., pos=None, type="regular"):
+    axis = SimpleNamespace(coll=coll, field=field, pos=pos, bins=bins, start=start, stop=stop, type=type,
+                           name=None, label=field, transform=None, underflow=True, overflow=True)
+    return SimpleNamespace(axes=[axis], autofill=True, variations=True, no_weights=False)
+
+
+HIST_CONFS = {
+    "MET_pt": hist_conf("events", "MET_pt"),
+    "nJet": hist_conf("events", "nJet", start=0, stop=6, type="int"),
+    "MuonGood_pt": hist_conf("MuonGood", "pt", bins=[0., 10., 30., 60., 100.], type="variable"),
+    "MuonGood_eta": hist_conf("MuonGood", "eta", bins=24, start=-2.4, stop=2.4),
+    "MuonGood_pt_1": hist_conf("MuonGood", "pt", pos=0),
+    "MuonGood_pt_2": hist_conf("MuonGood", "pt", pos=1),
+}
+
+
+@pytest.fixture
+def chunk():
+    rng = np.random.default_rng(2)
+    n = 3000
+    counts = rng.integers(0, 4, n)
+    nmuons = counts.sum()
+    met = rng.uniform(-10, 130, n)
+    met[::97] = np.nan
+    events = ak.zip({
+        "MET_pt": met,
+        "nJet": rng.integers(0, 8, n),
+        "MuonGood": ak.unflatten(ak.zip({"pt": rng.exponential(30, nmuons), "eta": rng.uniform(-3, 3, nmuons)}),
+                                 counts),
+    }, depth_limit=1)
+    masks = {"baseline": np.ones(n, dtype=bool), "Wc": rng.random(n) < 0.3}
+    return events, masks, rng
+
+
+def reference_fill(histograms, events, masks, weights, variations):
+    '''
+    One histogram, category and variation at a time.
+    '''
+    for name, conf in HIST_CONFS.items():
+        axis = conf.axes[0]
+        for category, mask in masks.items():
+            for ivar, variation in enumerate(variations):
+                w = weights[category][:, ivar][mask]
+                selected = events[mask]
+                if axis.coll == "events":
+                    values = selected[axis.field]
+                elif axis.pos is None:
+                    objects = selected[axis.coll][axis.field]
+                    w = np.repeat(w, ak.to_numpy(ak.num(objects)))
+                    values = ak.flatten(objects)
+                else:
+                    values = ak.pad_none(selected[axis.coll][axis.field], axis.pos + 1)[:, axis.pos]
+                    present = ak.to_numpy(~ak.is_none(values))
+                    values, w = values[present], w[present]
+                histograms[name].fill(category, variation, ak.to_numpy(values), weight=w)
+
+
+def assert_same(histograms, reference):
+    for name in HIST_CONFS:
+        np.testing.assert_allclose(histograms[name].values(flow=True), reference[name].values(flow=True),
+                                   rtol=1e-10, atol=1e-12, err_msg=name)
+        np.testing.assert_allclose(histograms[name].variances(flow=True), reference[name].variances(flow=True),
+                                   rtol=1e-10, atol=1e-12, err_msg=name)
+
+
+def test_batched_fill_matches_per_histogram_fill(chunk):
+    events, masks, rng = chunk
+    filler = BatchedHistFiller(HIST_CONFS, CATEGORIES, ["nominal"])
+    assert not filler.unsupported
+    weights = {category: rng.normal(1, 0.2, (len(events), 1)) for category in CATEGORIES}
+    histograms = filler.fill(filler.empty_histograms(), events, masks, weights)
+    reference = filler.empty_histograms()
+    reference_fill(reference, events, masks, weights, ["nominal"])
+    assert_same(histograms, reference)
+    # Flow bins and NaN values are filled like boost-histogram
+    assert histograms["MET_pt"][{"cat": "baseline", "variation": "nominal"}].values(flow=True)[-1] > 0
+
+
+def test_variation_axis_matches_per_variation_fills(chunk):
+    events, masks, rng = chunk
+    variations = ["nominal", "pileupUp", "pileupDown", "sf_mu_idUp", "sf_mu_idDown"]
+    filler = BatchedHistFiller(HIST_CONFS, CATEGORIES, variations)
+    weights = {category: rng.normal(1, 0.2, (len(events), len(variations))) for category in CATEGORIES}
+    stacked = filler.fill(filler.empty_histograms(), events, masks, weights)
+
+    # One fill per variation, as without the variation matrix
+    separate = filler.empty_histograms()
+    for ivar, variation in enumerate(variations):
+        filler.fill(separate, events, masks, {c: w[:, ivar:ivar + 1] for c, w in weights.items()}, [variation])
+    assert_same(stacked, separate)
+
+    reference = filler.empty_histograms()
+    reference_fill(reference, events, masks, weights, variations)
+    assert_same(stacked, reference)
+    muon_pt = stacked["MuonGood_pt"]
+    assert muon_pt[{"variation": "pileupUp"}].sum() != muon_pt[{"variation": "nominal"}].sum()
@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("uproot")
+
+from ChunkPlanner import Chunk, WorkQueue, interleave
+
+
+def chunks(n, entries=100_000):
+    return [Chunk("DY", f"file{i}.root", 0, entries, cost=1.) for i in range(n)]
+
+
+def sleeping(slow=()):
+    def process_chunk(chunk):
+        seconds = 0.02 * chunk.nevents / 100_000
+        time.sleep(seconds * (20 if chunk.filename in slow and chunk.nevents == 100_000 else 1))
+        return chunk.nevents
+    return process_chunk
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self, workers):
+        super().__init__(workers)
+        self.futures = []
+        self.max_inflight = 0
+
+    def submit(self, fn, *args):
+        self.futures = [future for future in self.futures if not future.done()]
+        self.futures.append(super().submit(fn, *args))
+        self.max_inflight = max(self.max_inflight, len(self.futures))
+        return self.futures[-1]
+
+
+def test_queued_chunks_are_not_timed():
+    queue = WorkQueue(chunks(20), workers=2, min_completed=2, min_split_entries=1, poll_interval=0.005)
+    with CountingExecutor(2) as executor:
+        # More in flight than workers is not honoured: the waiting chunks would look slow
+        total = queue.run(executor, sleeping(), lambda a, b: a + b, max_inflight=20)
+    assert total == 20 * 100_000
+    assert executor.max_inflight == 2
+    assert queue.summary()["resplit"] == 0
+
+
+def test_straggler_resplit_counts_entries_once():
+    queue = WorkQueue(chunks(12), workers=2, min_completed=3, min_split_entries=1, poll_interval=0.005)
+    with ThreadPoolExecutor(2) as executor:
+        total = queue.run(executor, sleeping(slow={"file6.root"}), lambda a, b: a + b)
+    assert total == 12 * 100_000
+    assert queue.summary()["resplit"] >= 1
+
+
+def test_interleave_by_fraction_of_cost():
+    large = [Chunk("large", "l.root", i, i + 1, cost=1.) for i in range(4)]
+    small = [Chunk("small", "s.root", 0, 1, cost=4.)]
+    order = [chunk.dataset for chunk in interleave({"large": large, "small": small})]
+    assert order == ["large", "large", "small", "large", "large"]
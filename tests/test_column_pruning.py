@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+pytest.importorskip("uproot")
+pytest.importorskip("coffea")
+
+from ColumnPruning import trace_columns
+from SyntheticEvents import write_nanoaod
+
+
+class TraceProcessor:
+    '''
+    Stands in for the workflow: a muon preselection, then a category on the
+    jets and one that no event reaches.
+    '''
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.ntuple_options = {}
+
+    def process(self, events):
+        dataset = events.metadata["dataset"]
+        presel = events[ak.num(events.Muon) >= self.cfg.min_muons]
+        jets = presel[ak.sum(presel.Jet.pt > 30, axis=1) >= 1]
+        none = presel[presel.MET.pt < 0]
+        ak.sum(none.Electron.pt)
+        return {"cutflow": {
+            "initial": {dataset: len(events)},
+            "presel": {dataset: len(presel)},
+            "jets": {dataset: len(jets)},
+            "no_events": {dataset: len(none)},
+        }}
+
+
+class TraceConfig:
+    workflow = TraceProcessor
+
+    def __init__(self, filename, min_muons):
+        self.filesets = {"DY_2017": {"metadata": {"sample": "DY", "isMC": True}, "files": [filename]}}
+        self.min_muons = min_muons
+
+
+@pytest.fixture(scope="module")
+def filename(tmp_path_factory):
+    return write_nanoaod(str(tmp_path_factory.mktemp("trace") / "nano.root"), 500, seed=1)
+
+
+def test_trace_synthetic_events(filename):
+    with pytest.warns(UserWarning, match="no events in no_events"):
+        columns = trace_columns(TraceConfig(filename, min_muons=1), entry_stop=200)
+    assert {"nMuon", "nJet", "Jet_pt", "MET_pt"} <= set(columns)
+    assert not any(column.startswith("Tau_") for column in columns)
+
+
+def test_trace_without_preselected_events(filename):
+    with pytest.raises(RuntimeError, match="no events after the preselection"):
+        trace_columns(TraceConfig(filename, min_muons=100), entry_stop=200)
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("awkward")
+correctionlib = pytest.importorskip("correctionlib")
+
+from CorrectionLUT import CorrectionService, DenseCorrection, VARIATIONS
+
+ETA_EDGES = [0., 0.9, 1.2, 2.1, 2.4]
+
+
+def binned(rng, pt_edges, flow):
+    return {
+        "nodetype": "multibinning",
+        "inputs": ["abseta", "pt"],
+        "edges": [ETA_EDGES, [float(edge) for edge in pt_edges]],
+        "content": rng.uniform(0.9, 1.1, (len(ETA_EDGES) - 1) * (len(pt_edges) - 1)).tolist(),
+        "flow": flow,
+    }
+
+
+def write_correction(path, flow):
+    rng = np.random.default_rng(4)
+    # The systematics do not share all their pt edges
+    pt_edges = {"sf": [15, 20, 25, 30, 40, 50, 60, 120], "systup": [15, 25, 40, 120], "systdown": [15, 30, 120]}
+    correction = {
+        "name": "NUM_TightID_DEN_TrackerMuons",
+        "version": 1,
+        "inputs": [
+            {"name": "year", "type": "string"},
+            {"name": "abseta", "type": "real"},
+            {"name": "pt", "type": "real"},
+            {"name": "ValType", "type": "string"},
+        ],
+        "output": {"name": "weight", "type": "real"},
+        "data": {
+            "nodetype": "category",
+            "input": "year",
+            "content": [{"key": "2017_UL", "value": {
+                "nodetype": "category",
+                "input": "ValType",
+                "content": [{"key": key, "value": binned(rng, edges, flow)} for key, edges in pt_edges.items()],
+            }}],
+        },
+    }
+    with open(path, "w") as f:
+        json.dump({"schema_version": 2, "corrections": [correction]}, f)
+    return path
+
+
+def reference(path, abseta, pt):
+    evaluator = correctionlib.CorrectionSet.from_file(str(path))["NUM_TightID_DEN_TrackerMuons"]
+    return np.stack([evaluator.evaluate("2017_UL", abseta, pt, v) for v in VARIATIONS["muon"]], axis=-1)
+
+
+def lookup(path):
+    table = CorrectionService().get(path, "NUM_TightID_DEN_TrackerMuons", fixed={"year": "2017_UL"})
+    assert isinstance(table, DenseCorrection)
+    return table
+
+
+def inside_values(n=10_000):
+    rng = np.random.default_rng(8)
+    abseta = rng.uniform(0, 2.4, n)
+    pt = rng.uniform(15, 120, n)
+    # Exactly on the edges
+    abseta[:4] = ETA_EDGES[:-1]
+    pt[5:12] = [15, 20, 25, 30, 40, 50, 60]
+    return abseta, pt
+
+
+@pytest.mark.parametrize("flow", ["clamp", "error", 1.0])
+def test_lut_matches_correctionlib_inside_edges(tmp_path, flow):
+    path = write_correction(str(tmp_path / "muon.json"), flow)
+    abseta, pt = inside_values()
+    np.testing.assert_array_equal(lookup(path)(abseta, pt), reference(path, abseta, pt))
+
+
+@pytest.mark.parametrize("flow", ["clamp", 1.0])
+def test_lut_matches_correctionlib_outside_edges(tmp_path, flow):
+    path = write_correction(str(tmp_path / "muon.json"), flow)
+    abseta = np.array([0.5, 0.5, 2.4, 3.0, 1.0])
+    pt = np.array([5., 120., 50., 50., 1e4])
+    np.testing.assert_array_equal(lookup(path)(abseta, pt), reference(path, abseta, pt))
+
+
+def test_lut_raises_outside_edges_like_correctionlib(tmp_path):
+    path = write_correction(str(tmp_path / "muon.json"), "error")
+    abseta, pt = np.array([0.5, 0.5]), np.array([30., 500.])
+    with pytest.raises(Exception) as expected:
+        reference(path, abseta, pt)
+    with pytest.raises(type(expected.value)):
+        lookup(path)(abseta, pt)
@@ -0,0 +1,70 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+
+from ChunkCache import chunk_cache
+from CutBits import CutBitmask, accumulate_cutflow
+
+
+class FakeCut:
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+    def get_mask(self, events, **kwargs):
+        return self.function(events)
+
+
+CUTS = [
+    FakeCut("mtw", lambda events: events.mtw > 55),
+    FakeCut("ptratio", lambda events: events.ptratio < 0.6),
+    # Missing values fail the cut
+    FakeCut("njet", lambda events: ak.mask(events.nJet >= 1, events.nJet != 3)),
+]
+
+
+@pytest.fixture
+def chunk():
+    rng = np.random.default_rng(11)
+    n = 10_000
+    events = ak.zip({"mtw": rng.uniform(0, 120, n), "ptratio": rng.uniform(0, 1, n), "nJet": rng.integers(0, 5, n)})
+    chunk_cache.clear()
+    yield events, rng.normal(1, 0.3, n)
+    chunk_cache.clear()
+
+
+def masks(events):
+    return {cut.name: ak.to_numpy(ak.fill_none(cut.get_mask(events), False)) for cut in CUTS}
+
+
+def test_cutflow_matches_sequential_and_nminus1_cuts(chunk):
+    events, weights = chunk
+    bitmask = CutBitmask("wc", CUTS)
+    cutflow = bitmask.cutflow(bitmask.bits(events), weights)
+    cut_masks = masks(events)
+
+    passing = np.ones(len(events), dtype=bool)
+    expected = [weights.sum()]
+    for name in cutflow["cuts"]:
+        passing &= cut_masks[name]
+        expected.append(weights[passing].sum())
+    np.testing.assert_allclose(cutflow["sequential"], expected)
+
+    for i, name in enumerate(cutflow["cuts"]):
+        others = np.logical_and.reduce([mask for other, mask in cut_masks.items() if other != name])
+        assert cutflow["nminus1"][i] == pytest.approx(weights[others].sum())
+        assert cutflow["single"][i] == pytest.approx(weights[cut_masks[name]].sum())
+
+
+def test_cutflow_accumulates_over_chunks(chunk):
+    events, weights = chunk
+    bitmask = CutBitmask("wc", CUTS)
+    output = {}
+    half = len(events) // 2
+    for part in (slice(0, half), slice(half, None)):
+        accumulate_cutflow(output, bitmask, "DY", bitmask.cutflow(bitmask.bits(events[part]), weights[part]))
+    chunk_cache.clear()
+    whole = bitmask.cutflow(bitmask.bits(events), weights)
+    for key in ("sequential", "nminus1", "single"):
+        np.testing.assert_allclose(output["bit_cutflow"]["wc"]["DY"][key], whole[key])
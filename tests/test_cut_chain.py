@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("awkward")
+cloudpickle = pytest.importorskip("cloudpickle")
+
+import CutChain
+import WorkerState
+from WorkerState import clear_worker_state
+
+
+class FakeCut:
+    def __init__(self, name, function, seconds=0.):
+        self.name = name
+        self.function = function
+        self.seconds = seconds
+
+    def get_mask(self, events, **kwargs):
+        time.sleep(self.seconds)
+        return self.function(events)
+
+
+def chain_payload(name, warmup_chunks=2):
+    # Shipped by value, as in config_Wc.py
+    cloudpickle.register_pickle_by_value(CutChain)
+    cloudpickle.register_pickle_by_value(WorkerState)
+    clear_worker_state(f"CutChain.{name}")
+    chain = CutChain.CutChain(name, [
+        FakeCut("keeps_all", lambda events: events >= 0, seconds=1e-3),
+        FakeCut("rejects_most", lambda events: events < 10),
+    ], warmup_chunks=warmup_chunks)
+    return cloudpickle.dumps(chain)
+
+
+def test_reordering_across_unpickled_chunks():
+    payload = chain_payload("test_reordering")
+    events = np.arange(1000)
+    for _ in range(2):
+        chain = cloudpickle.loads(payload)
+        assert [cut.name for cut in chain.order()] == ["keeps_all", "rejects_most"]
+        chain(events)
+    chain = cloudpickle.loads(payload)
+    assert chain.chunks == 2
+    assert [cut.name for cut in chain.order()] == ["rejects_most", "keeps_all"]
+
+
+def test_result_independent_of_order():
+    payload = chain_payload("test_result", warmup_chunks=1)
+    events = np.arange(1000)
+    masks = [cloudpickle.loads(payload)(events) for _ in range(3)]
+    for mask in masks:
+        np.testing.assert_array_equal(mask, events < 10)
+
+
+def test_only_final_mask_cached():
+    clear_worker_state("CutChain.test_cache")
+    # Unpickling the chains shipped by value above rebinds the methods of the
+    # class to their own copy of the module globals
+    chunk_cache = CutChain.CutChain.__call__.__globals__["chunk_cache"]
+    calls = []
+
+    def squares_below(limit):
+        def function(events):
+            calls.append(len(events))
+            return chunk_cache.get(events, ("square",), lambda: events**2) < limit
+        return function
+
+    chain = CutChain.CutChain("test_cache", [
+        FakeCut("below_100", squares_below(100**2)),
+        FakeCut("below_10", squares_below(10**2)),
+    ], reorder=False)
+    events = np.arange(1000)
+    chunk_cache.clear()
+    mask = chain(events)
+    np.testing.assert_array_equal(mask, events < 10)
+    assert calls == [1000, 100]
+    # What the second cut cached for its slice went with the slice
+    assert len(chunk_cache._stores) == 1
+    assert len(chunk_cache) == 2
+    # Asked again in the same chunk, the mask is not evaluated again
+    assert chain(events) is mask
+    assert calls == [1000, 100] and chain.chunks == 1
+    chunk_cache.clear()
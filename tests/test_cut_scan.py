@@ -0,0 +1,76 @@
+import warnings
+
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+
+from CutScan import CutScan, ScanParameter, SparseCells, accumulate_check
+
+
+class FakeCut:
+    def __init__(self, function):
+        self.function = function
+
+    def get_mask(self, events, **kwargs):
+        return self.function(events)
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(7)
+    n = 5000
+    return ak.zip({
+        "mtw": rng.uniform(0, 120, n),
+        "ptratio": rng.uniform(0, 1, n),
+        "nJet": rng.integers(0, 5, n),
+    }), rng.normal(1, 0.2, n)
+
+
+def make_scan(nominal=None):
+    return CutScan(
+        name="test_scan",
+        parameters=[
+            ScanParameter("mtw_min", lambda events: events.mtw, ">", [40, 55, 70]),
+            ScanParameter("ptratio_max", lambda events: events.ptratio, "<", [0.4, 0.6]),
+        ],
+        base_cuts=[FakeCut(lambda events: events.nJet >= 1)],
+        nominal=nominal,
+        category="wc",
+    )
+
+
+def direct_cut(events, mtw_min, ptratio_max):
+    return ak.to_numpy((events.nJet >= 1) & (events.mtw > mtw_min) & (events.ptratio < ptratio_max))
+
+
+def test_scan_cells_match_direct_cuts(events):
+    events, weights = events
+    scan = make_scan()
+    # Two chunks, merged as across the job
+    half = len(events) // 2
+    cells = scan.fill(events[:half], weights[:half])["yields"] + scan.fill(events[half:], weights[half:])["yields"]
+    assert isinstance(cells, SparseCells)
+    sumw, sumw2 = scan.yields(cells)
+    for i, mtw_min in enumerate([40, 55, 70]):
+        for j, ptratio_max in enumerate([0.4, 0.6]):
+            mask = direct_cut(events, mtw_min, ptratio_max)
+            assert sumw[i, j] == pytest.approx(weights[mask].sum(), rel=1e-12)
+            assert sumw2[i, j] == pytest.approx((weights[mask]**2).sum(), rel=1e-12)
+
+
+def test_nominal_check_warns_and_records(events):
+    events, weights = events
+    scan = make_scan(nominal={"mtw_min": 55, "ptratio_max": 0.6})
+    cells = scan.fill(events, weights)
+    category_yield = float(weights[direct_cut(events, 55, 0.6)].sum())
+    output = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        accumulate_check(output, scan, "DY", scan.check_nominal(cells, category_yield))
+    # An event at the threshold counted differently by the category
+    with pytest.warns(UserWarning, match="nominal cell yield"):
+        accumulate_check(output, scan, "DY", scan.check_nominal(cells, category_yield + 1.))
+    check = output["cut_scan_checks"]["test_scan"]["DY"]
+    assert check["chunks"] == 2 and check["chunks_differing"] == 1
+    assert check["category_yield"] - check["scan_yield"] == pytest.approx(1.)
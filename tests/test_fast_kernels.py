@@ -0,0 +1,127 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+pytest.importorskip("numba")
+pytest.importorskip("uproot")
+pytest.importorskip("coffea")
+cloudpickle = pytest.importorskip("cloudpickle")
+
+from coffea.nanoevents.methods import candidate
+
+import FastKernels
+import WorkerState
+from ChunkCache import chunk_cache, leading_sum
+
+NEVENTS = 20_000
+
+# The dilepton mass is computed in double precision by its kernel (see FastKernels)
+MASS_EDGES = (12., 80., 100.)
+MASS_EDGE_RTOL = 1e-5
+
+
+@pytest.fixture(scope="module", params=[0, 1])
+def events(request, tmp_path_factory):
+    pytest.importorskip("pocket_coffea")
+    from Benchmarks import preselected_events
+
+    processor_instance, events = preselected_events(NEVENTS, request.param, str(tmp_path_factory.mktemp("kernels")))
+    yield events
+    processor_instance.finish_ntuples()
+
+
+def near_mass_edge(events):
+    mass = ak.to_numpy(ak.fill_none(leading_sum(events, "MuonGood", "SoftMuonGood").mass, -1.))
+    mass = mass.astype(np.float64)
+    return np.logical_or.reduce([np.abs(mass - edge) <= MASS_EDGE_RTOL * edge for edge in MASS_EDGES])
+
+
+# Benchmarks.FAST_CUTS
+@pytest.mark.parametrize("name", ["mtw", "dilepveto", "MuonSelBTV", "dilepmass"])
+def test_kernel_matches_awkward(events, name):
+    import CommonSelectors
+    from Benchmarks import CUTS, cut_mask
+
+    cut = getattr(CommonSelectors, dict(CUTS)[name])
+    chunk_cache.clear()
+    reference = np.asarray(ak.to_numpy(cut_mask(cut, events)), dtype=bool)
+    fast = np.asarray(ak.to_numpy(cut_mask(cut, events, fast=True)), dtype=bool)
+    assert reference.any() and not reference.all()
+    if name == "dilepmass":
+        tolerated = near_mass_edge(events)
+        fast, reference = fast[~tolerated], reference[~tolerated]
+    np.testing.assert_array_equal(fast, reference)
+
+
+def muons(pt, eta, phi, mass, counts):
+    flat = ak.zip(
+        {
+            "pt": np.asarray(pt, dtype=np.float32),
+            "eta": np.asarray(eta, dtype=np.float32),
+            "phi": np.asarray(phi, dtype=np.float32),
+            "mass": np.asarray(mass, dtype=np.float32),
+            "charge": np.zeros(len(pt), dtype=np.int32),
+        },
+        with_name="PtEtaPhiMCandidate",
+        behavior=candidate.behavior,
+    )
+    return ak.unflatten(flat, counts)
+
+
+def pairs(first, second):
+    return ak.zip({"MuonGood": first, "SoftMuonGood": second}, depth_limit=1)
+
+
+def test_dilepton_mass_window_edges():
+    # At rest, the mass of the pair is exactly the sum of the masses
+    masses = np.array([6., 6.0005, 40., 39.9995, 40.0005, 50., 49.9995, 50.0005, 75.])
+    expected = [False, True, False, True, False, False, False, True, True]
+    n = len(masses)
+    zeros = np.zeros(n)
+    events = pairs(muons(zeros, zeros, zeros, masses, np.ones(n, dtype=np.int64)),
+                   muons(zeros, zeros, zeros, masses, np.ones(n, dtype=np.int64)))
+    np.testing.assert_array_equal(ak.to_numpy(FastKernels.dilepton_mass_cut(events)), expected)
+    # No soft muon: no pair
+    events = pairs(muons([30.], [0.], [0.], [0.1], [1]), muons([], [], [], [], [0]))
+    assert not ak.to_numpy(FastKernels.dilepton_mass_cut(events))[0]
+
+
+def test_dilepton_mass_within_tolerance():
+    rng = np.random.default_rng(5)
+    n = 200_000
+    first, second = [
+        muons(rng.uniform(3, 80, n), rng.uniform(-2.4, 2.4, n), rng.uniform(-np.pi, np.pi, n),
+              np.full(n, 0.10566), np.ones(n, dtype=np.int64))
+        for _ in range(2)
+    ]
+    events = pairs(first, second)
+    chunk_cache.clear()
+    mass = ak.to_numpy(leading_sum(events, "MuonGood", "SoftMuonGood").mass).astype(np.float64)
+    reference = (mass > 12) & ((mass < 80) | (mass > 100))
+    fast = ak.to_numpy(FastKernels.dilepton_mass_cut(events))
+    tolerated = near_mass_edge(events)
+    np.testing.assert_array_equal(fast[~tolerated], reference[~tolerated])
+    assert reference.any() and not reference.all()
+
+
+def test_compiled_once_per_worker():
+    # Shipped by value, as in config_Wc.py: every chunk unpickles a new module
+    cloudpickle.register_pickle_by_value(FastKernels)
+    cloudpickle.register_pickle_by_value(WorkerState)
+    payload = cloudpickle.dumps((FastKernels._transverse_mass_above, FastKernels.dispatcher))
+    offsets = np.array([0, 1, 1, 3], dtype=np.int64)
+    mu_pt = np.array([30., 40., 50.], dtype=np.float32)
+    mu_phi = np.array([np.pi, np.pi, 0.], dtype=np.float32)
+    met_pt = np.array([40., 30., 20.], dtype=np.float32)
+    met_phi = np.zeros(3, dtype=np.float32)
+    dispatchers = []
+    for _ in range(2):
+        kernel, dispatcher = cloudpickle.loads(payload)
+        out = np.empty(3, dtype=np.bool_)
+        kernel(offsets, mu_pt, mu_phi, met_pt, met_phi, np.float32(55), out)
+        np.testing.assert_array_equal(out, [True, False, True])
+        dispatchers.append(dispatcher(kernel))
+    assert dispatchers[0] is dispatchers[1]
+    assert len(dispatchers[0].signatures) == 1
+    # The source file is here, so the on-disk cache is in use
+    assert type(dispatchers[0]._cache).__name__ == "FunctionCache"
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+pytest.importorskip("hist")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from NtupleQuery import parse_cut, run_query
+from NtupleWriter import chunk_writer, compact
+
+
+def axis(field, bins, start, stop, type="regular"):
+    return SimpleNamespace(coll="events", field=field, pos=None, bins=bins, start=start, stop=stop, type=type,
+                           name=None, label=field, transform=None, underflow=True, overflow=True)
+
+
+# Fields of the configuration variables, as in config_Wc.py
+AXES = {
+    "nMuon": axis("nMuonGood", 15, 0, 15, type="int"),
+    "W_mass": axis("W_mass", 100, 0, 150),
+}
+
+
+@pytest.fixture
+def ntuples(tmp_path):
+    rng = np.random.default_rng(3)
+    outdir = str(tmp_path)
+    parts = {}
+    for chunk in range(4):
+        n = 500
+        # The muon multiplicity grows with the chunk, so that the statistics
+        # of the row groups of the first chunks rule out nMuonGood>=2
+        variables = ak.zip({
+            "nMuon": rng.integers(0, 2 + chunk, n),
+            "W_mass": rng.uniform(0, 160, n),
+            "weight": rng.uniform(0.5, 1.5, n),
+        })
+        writer = chunk_writer(f"chunk{chunk}", outdir=outdir, background=False)
+        writer.write("WJets", variables)
+        for dataset, paths in writer.close().items():
+            parts.setdefault(dataset, []).extend(paths)
+    compact(outdir, parts, row_group_size=250)
+    return outdir
+
+
+def full_scan(outdir, cuts):
+    table = pq.read_table(str(outdir) + "/WJets")
+    values = {name: table[name].to_numpy().astype(np.float64) for name in table.column_names}
+    mask = np.ones(table.num_rows, dtype=bool)
+    for column, op, value in cuts:
+        mask &= {">": np.greater, ">=": np.greater_equal, "<": np.less}[op](values[column], value)
+    sums = {}
+    for name, (column, bins) in {"nMuon": ("nMuon", np.arange(0, 16)),
+                                 "W_mass": ("W_mass", np.linspace(0, 150, 101))}.items():
+        sums[name] = np.histogram(values[column][mask], bins=bins, weights=values["weight"][mask])[0]
+    return sums
+
+
+def test_pushdown_matches_full_scan(ntuples):
+    cuts = [parse_cut("nMuonGood>=2"), parse_cut("W_mass<120")]
+    assert cuts[0][0] == "nMuon"
+    histograms, stats = run_query(ntuples, AXES, cuts, workers=2, row_groups_per_task=1)
+    assert stats["row_groups"] == 8
+    assert stats["row_groups_skipped"] == 2
+    assert stats["unweighted"] == []
+    expected = full_scan(ntuples, cuts)
+    for name, h in histograms.items():
+        np.testing.assert_allclose(h["WJets", :].values(), expected[name], rtol=1e-6)
+    assert histograms["nMuon"]["WJets", :].values()[:2].sum() == 0
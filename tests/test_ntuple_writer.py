@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("awkward")
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from NtupleWriter import chunk_writer, compact, consolidate, dataset_parts
+
+
+def test_compact_chunk_parts(tmp_path):
+    outdir = str(tmp_path)
+    parts = {}
+    for chunk in range(5):
+        writer = chunk_writer(f"chunk{chunk}", outdir=outdir, background=False)
+        start = 7 * chunk
+        writer.write_table("DY", pa.table({"nMuon": pa.array(range(start, start + 7), pa.int16())}))
+        for dataset, paths in writer.close().items():
+            parts.setdefault(dataset, []).extend(paths)
+    assert len(parts["DY"]) == 5
+
+    parts = compact(outdir, parts, row_group_size=4, max_rows_per_file=12)
+    consolidate(outdir, parts)
+    paths = dataset_parts(str(tmp_path / "DY"))
+    assert paths == sorted(parts["DY"])
+    assert [pq.read_metadata(path).num_rows for path in paths] == [12, 12, 11]
+    assert all("-job-" in path for path in paths)
+    values = pa.concat_tables([pq.read_table(path) for path in paths])["nMuon"].to_pylist()
+    assert values == list(range(35))
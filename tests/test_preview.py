@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("awkward")
+pytest.importorskip("uproot")
+
+from Preview import PreviewChunker, select_chunks
+
+
+class FakeEntryCounts:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def scan(self, files):
+        return {f: {"entries": self.entries[f], "uuid": f} for f in files}
+
+
+ENTRIES = {f"root://site{i % 2}.example//DY_{i}.root": 150_000 + 10_000 * i for i in range(12)}
+ENTRIES.update({f"root://site0.example//TTbar_{i}.root": 300_000 for i in range(3)})
+
+DATASETS = {
+    "DY": {"metadata": {"isMC": "True"}, "files": sorted(f for f in ENTRIES if "DY_" in f)},
+    "TTbar": {"metadata": {"isMC": "True"}, "files": sorted(f for f in ENTRIES if "TTbar_" in f)},
+}
+
+
+def selection(seed, fraction=0.05):
+    chunker = PreviewChunker(DATASETS, FakeEntryCounts(ENTRIES), fraction=fraction, seed=seed)
+    return [(c.dataset, c.filename, c.entrystart, c.entrystop) for c in chunker], chunker.summary()
+
+
+def test_same_seed_same_selection():
+    first, summary = selection(seed=1)
+    second, _ = selection(seed=1)
+    assert first == second
+    assert selection(seed=2)[0] != first
+    # About 5% of the chunks of every dataset, from files spread over the dataset
+    assert summary["DY"]["chunks"] == round(summary["DY"]["total_entries"] / 20_000 * 0.05)
+    assert summary["DY"]["files"] >= summary["DY"]["chunks"] - 1
+    assert summary["TTbar"]["chunks"] == 2
+    assert all(c[3] - c[2] <= 20_000 for c in first)
+
+
+def test_select_chunks_is_systematic():
+    chunks = list(range(1000))
+    selected = select_chunks(chunks, 0.01, seed=3, key="DY")
+    assert selected == select_chunks(chunks, 0.01, seed=3, key="DY")
+    assert selected != select_chunks(chunks, 0.01, seed=3, key="TTbar")
+    assert len(selected) == 10
+    assert all(90 <= b - a <= 110 for a, b in zip(selected, selected[1:]))
+    assert select_chunks(chunks[:5], 0.01) and select_chunks([], 0.5) == []
@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+ak = pytest.importorskip("awkward")
+uproot = pytest.importorskip("uproot")
+pytest.importorskip("coffea")
+pytest.importorskip("lz4")
+
+from ChunkPlanner import Chunk
+from LocalRunner import load_chunk
+from Prefetch import fetch_chunk
+from ReplicaCache import ReplicaCache
+from SyntheticEvents import write_nanoaod
+
+COLUMNS = ["nMuon", "Muon_pt", "Muon_eta", "MET_pt"]
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("remote") / "nano.root")
+    write_nanoaod(path, 2000, seed=3)
+    return path
+
+
+def test_file_url_miss_then_hit(source, tmp_path):
+    cache = ReplicaCache(str(tmp_path / "cache"))
+    url = "file://" + source
+    chunk = Chunk("DY", url, 500, 1500, cost=1.)
+
+    events = load_chunk(chunk, COLUMNS, cache)
+    assert cache.report()["misses"] == 1 and cache.report()["hits"] == 0
+    assert events.metadata["filename"] == url
+    with uproot.open(source) as f:
+        expected = f["Events"].arrays(["Muon_pt", "MET_pt"], entry_start=500, entry_stop=1500)
+    assert len(events) == 1000
+    assert ak.all(events.Muon.pt == expected.Muon_pt)
+    np.testing.assert_array_equal(ak.to_numpy(events.MET.pt), ak.to_numpy(expected.MET_pt))
+
+    arrays, nbytes = fetch_chunk(chunk, COLUMNS, replica_cache=cache)
+    report = cache.report()
+    assert report["misses"] == 1 and report["hits"] == 1 and report["hit_rate"] == 0.5
+    assert nbytes > 0
+    assert ak.all(arrays["Muon_pt"] == expected.Muon_pt)
+
+    # Another entry range is another replica
+    fetch_chunk(Chunk("DY", url, 0, 500, cost=1.), COLUMNS, replica_cache=cache)
+    assert cache.report()["misses"] == 2 and cache.report()["replicas"] == 2
@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+hist = pytest.importorskip("hist")
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+pytest.importorskip("awkward")
+pytest.importorskip("coffea")
+
+from coffea.processor import accumulate
+
+from ResultStore import ResultStore, chunk_key
+
+
+class Killed(Exception):
+    pass
+
+
+def chunks():
+    return [
+        {"dataset": dataset, "filename": f"{dataset}_{i}.root", "treename": "Events",
+         "entrystart": start, "entrystop": start + 1000}
+        for dataset in ("DY", "WJets") for i in range(3) for start in (0, 1000)
+    ]
+
+
+def process(metadata):
+    # Deterministic stand-in for the processor output of a chunk
+    rng = np.random.default_rng(int(chunk_key(metadata), 16))
+    values = rng.exponential(40, 1000)
+    h = hist.Hist(hist.axis.Regular(20, 0, 200, name="pt"), storage=hist.storage.Weight())
+    h.fill(pt=values, weight=rng.normal(1, 0.1, 1000))
+    table = pa.table({"MuonGood_pt": pa.array(values, pa.float32())})
+    return {"variables": {"pt": {metadata["dataset"]: h}}, "cutflow": {"presel": {metadata["dataset"]: 1000}}}, table
+
+
+def run_job(store, metadatas, kill_after=None):
+    '''
+    What CommBTVBaseProcessor.process does with checkpointing, chunk by chunk.
+    '''
+    outputs = []
+    for n, metadata in enumerate(metadatas):
+        if kill_after is not None and n == kill_after:
+            raise Killed
+        key = chunk_key(metadata)
+        saved = store.load(key)
+        if saved is not None:
+            outputs.append(saved["accumulator"])
+            continue
+        output, table = process(metadata)
+        output["checkpoint"] = {metadata["dataset"]: {key: 1000}}
+        store.save(key, metadata, output, table)
+        outputs.append(output)
+    return accumulate(outputs)
+
+
+def export(store, output, outdir):
+    parts = store.export_ntuples(output.pop("checkpoint"), str(outdir), row_group_size=1500)
+    return {dataset: pa.concat_tables([pq.read_table(p) for p in paths]) for dataset, paths in parts.items()}
+
+
+def test_restart_gives_identical_output(tmp_path):
+    uninterrupted = ResultStore(str(tmp_path / "full"), "hash")
+    expected = run_job(uninterrupted, chunks())
+    expected_ntuples = export(uninterrupted, expected, tmp_path / "full_out")
+
+    store = ResultStore(str(tmp_path / "ckpt"), "hash")
+    with pytest.raises(Killed):
+        run_job(store, chunks(), kill_after=7)
+    assert len(store) == 7
+    # The restarted job meets the chunks in another order
+    output = run_job(store, chunks()[::-1])
+    assert len(store) == len(chunks())
+    ntuples = export(store, output, tmp_path / "out")
+
+    assert output["cutflow"] == expected["cutflow"]
+    for dataset in ("DY", "WJets"):
+        h, reference = output["variables"]["pt"][dataset], expected["variables"]["pt"][dataset]
+        np.testing.assert_allclose(h.values(flow=True), reference.values(flow=True), rtol=1e-12)
+        np.testing.assert_allclose(h.variances(flow=True), reference.variances(flow=True), rtol=1e-12)
+        assert ntuples[dataset].equals(expected_ntuples[dataset])
+
+
+def test_other_configuration_is_not_reused(tmp_path):
+    store = ResultStore(str(tmp_path), "old")
+    run_job(store, chunks()[:2])
+    changed = ResultStore(str(tmp_path), "new")
+    assert changed.load(chunk_key(chunks()[0])) is None
+    assert changed.stale() == {"old": 2}
+    with pytest.warns(UserWarning, match="will be recomputed"):
+        changed.warn_stale()
@@ -0,0 +1,67 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+hist = pytest.importorskip("hist")
+pytest.importorskip("coffea")
+
+from coffea.processor import accumulate
+
+from SharedAccumulator import SlabAccumulator, reduce_slabs
+
+
+def chunk_output(seed, categories=("baseline",)):
+    rng = np.random.default_rng(seed)
+    counts = hist.Hist(hist.axis.Regular(10, 0, 100, name="pt"), storage=hist.storage.Weight())
+    counts.fill(pt=rng.uniform(-10, 110, 500), weight=rng.normal(1, 0.1, 500))
+    categorized = hist.Hist(
+        hist.axis.StrCategory([], growth=True, name="cat"),
+        hist.axis.Regular(5, 0, 5, name="njet"),
+    )
+    for category in categories:
+        categorized.fill(cat=category, njet=rng.integers(0, 6, 100))
+    return {
+        "variables": {"MuonGood_pt": {"DY": counts}, "nJet": {"DY": categorized}},
+        "cutflow": {"presel": {"DY": 500}},
+        "sum_genweights": {"DY": float(seed)},
+    }
+
+
+def assert_same_output(merged, expected):
+    assert merged["cutflow"] == expected["cutflow"]
+    assert merged["sum_genweights"] == expected["sum_genweights"]
+    for name in expected["variables"]:
+        histogram, reference = merged["variables"][name]["DY"], expected["variables"][name]["DY"]
+        assert histogram.axes == reference.axes
+        np.testing.assert_allclose(histogram.values(flow=True), reference.values(flow=True))
+        if reference.variances() is not None:
+            np.testing.assert_allclose(histogram.variances(flow=True), reference.variances(flow=True))
+
+
+def reduce_workers(outputs, nworkers):
+    accumulators = [SlabAccumulator() for _ in range(nworkers)]
+    try:
+        for i, output in enumerate(outputs):
+            accumulators[i % nworkers].add(output)
+        return reduce_slabs([accumulator.describe() for accumulator in accumulators])
+    finally:
+        for accumulator in accumulators:
+            accumulator.close()
+
+
+@pytest.mark.parametrize("nworkers", [1, 3])
+def test_slab_merge_matches_accumulate(nworkers):
+    outputs = [chunk_output(seed) for seed in range(6)]
+    expected = accumulate([chunk_output(seed) for seed in range(6)])
+    assert_same_output(reduce_workers(outputs, nworkers), expected)
+
+
+@pytest.mark.parametrize("nworkers", [1, 2])
+def test_grown_axes_are_merged(nworkers):
+    # The categories of the later chunks differ from those of the slab, so
+    # those chunks go through the small accumulators
+    categories = [("baseline",), ("baseline", "Added cuts Wc"), ("Added cuts Wc",), ("baseline",)]
+    outputs = [chunk_output(seed, cats) for seed, cats in enumerate(categories)]
+    expected = accumulate([chunk_output(seed, cats) for seed, cats in enumerate(categories)])
+    merged = reduce_workers(outputs, nworkers)
+    assert_same_output(merged, expected)
+    assert merged["variables"]["nJet"]["DY"].sum(flow=True) == 500
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("awkward")
+pytest.importorskip("uproot")
+pytest.importorskip("coffea")
+
+from SiteScheduler import run_demo
+
+
+def test_capped_streams_beat_uncapped_on_overloaded_door():
+    # One endpoint serving two streams at full bandwidth, six workers
+    sites = [(0.005, 20 * 2**20, 2)]
+    capped = run_demo(sites, workers=6, nchunks_per_site=8, nevents=1000, max_streams=2,
+                      work_seconds=0.01, affinity=True)
+    uncapped = run_demo(sites, workers=6, nchunks_per_site=8, nevents=1000, max_streams=2,
+                        work_seconds=0.01, affinity=False)
+    assert max(capped["peak_streams"].values()) <= 2
+    assert max(uncapped["peak_streams"].values()) > 2
+    assert sum(capped["dispatched"].values()) == sum(uncapped["dispatched"].values()) == 8
+    assert capped["wall"] < 0.8 * uncapped["wall"]